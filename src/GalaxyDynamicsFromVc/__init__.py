@@ -1,9 +1,18 @@
 __author__ = 'Pablo Fernandez de Salas'
 __email__ = "pabferde@gmail.com"
 
-__all__ = ["galaxymodel", "analysisstatistics", "plots", "datahandling"]
+__all__ = ["galaxymodel", "analysisstatistics", "plots", "datahandling", "parallelcomputing", "onlinestatistics", "batchpipeline", "instrumentation", "kernels", "paralleltempering", "emulator"]
 
-import GalaxyDynamicsFromVc.galaxymodel
-import GalaxyDynamicsFromVc.analysisstatistics
-import GalaxyDynamicsFromVc.plots
-import GalaxyDynamicsFromVc.datahandling
\ No newline at end of file
+import importlib
+
+# Submodules are imported the first time they are used, e.g. with
+# GalaxyDynamicsFromVc.plots, so that only the dependencies of the parts in use
+# are loaded (matplotlib and corner with plots, scipy and emcee when fitting).
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
+import os
+import inspect
+import functools
+import contextlib
 import numpy as np
-import scipy.optimize as optim
-from multiprocessing import Pool
-import emcee
 import time
 
-from GalaxyDynamicsFromVc.datahandling import read_data_from_1810_09466
-from GalaxyDynamicsFromVc.galaxymodel import Galactic_model
+from GalaxyDynamicsFromVc.datahandling import get_data_from_1810_09466, get_rotation_curve_data, Chain_storage, Rotation_curve_data, Stored_results, load_pickle_results
+from GalaxyDynamicsFromVc.galaxymodel import Galactic_model, Potential
+from GalaxyDynamicsFromVc.parallelcomputing import executor_classes, create_executor, choose_executor, split_in_chunks
+from GalaxyDynamicsFromVc.onlinestatistics import Binned_percentiles
+from GalaxyDynamicsFromVc.instrumentation import Instrumentation
+from GalaxyDynamicsFromVc.kernels import Fused_chi2
+from GalaxyDynamicsFromVc.paralleltempering import Parallel_tempering_sampler, get_temperature_ladder
+from GalaxyDynamicsFromVc.emulator import Chi2_emulator
 
 #%%
 
@@ -102,16 +109,199 @@ class Prior:
                 return normalisation - 0.5*((value-self.Gaussian_mean)/self.Gaussian_sigma)**2
         return -np.infty
 
+class Prior_table:
+    # Prior.ln_function's of a list of variables compiled into arrays, evaluated
+    # for a whole batch of values at once. Any other prior function is kept and
+    # called value by value.
+    def __init__(self, list_of_prior_functions):
+        number_of_priors = len(list_of_prior_functions)
+        self._flat_min = np.full(number_of_priors, -np.infty)
+        self._flat_max = np.full(number_of_priors, np.infty)
+        self._Gaussian_mean = np.zeros(number_of_priors)
+        self._Gaussian_sigma = np.ones(number_of_priors)
+        self._Gaussian_normalisation = np.zeros(number_of_priors)
+        self._is_Gaussian = np.zeros(number_of_priors, dtype=bool)
+        self._other_prior_functions = []
+        for index, prior_function in enumerate(list_of_prior_functions):
+            prior = self._get_Prior(prior_function)
+            if prior is None:
+                self._other_prior_functions.append((index, prior_function))
+                continue
+            self._flat_min[index] = prior.flat_min
+            self._flat_max[index] = prior.flat_max
+            if np.isfinite(prior.Gaussian_sigma):
+                self._is_Gaussian[index] = True
+                self._Gaussian_mean[index] = prior.Gaussian_mean
+                self._Gaussian_sigma[index] = prior.Gaussian_sigma
+                with np.errstate(divide='ignore'):
+                    self._Gaussian_normalisation[index] = np.log(1.0/(np.abs(prior.Gaussian_mean)*np.sqrt(2.0*np.pi)))
+
+    @classmethod
+    def from_variables(cls, list_of_variables):
+        return cls([var.prior_function for var in list_of_variables])
+
+    @staticmethod
+    def _get_Prior(prior_function):
+        prior = getattr(prior_function, '__self__', None)
+        if isinstance(prior, Prior) and getattr(prior_function, '__func__', None) is Prior.ln_function:
+            return prior
+        return None
+
+    @property
+    def flat_min(self):
+        return self._flat_min
+
+    @property
+    def flat_max(self):
+        return self._flat_max
+
+    @property
+    def Gaussian_mean(self):
+        return self._Gaussian_mean
+
+    @property
+    def Gaussian_sigma(self):
+        return self._Gaussian_sigma
+
+    @property
+    def is_Gaussian(self):
+        return self._is_Gaussian
+
+    def inside_flat_bounds(self, array_of_values):
+        a = np.atleast_2d(array_of_values)
+        return np.all((self.flat_min < a) & (a < self.flat_max), axis=1)
+
+    def ln_function(self, array_of_values):
+        a = np.atleast_2d(np.asarray(array_of_values, dtype=float))
+        ln_priors = np.full(len(a), -np.infty)
+        inside = self.inside_flat_bounds(a)
+        b = a[inside]
+        Gaussian_terms = self._Gaussian_normalisation - 0.5*((b-self.Gaussian_mean)/self.Gaussian_sigma)**2
+        ln_priors[inside] = np.sum(np.where(self.is_Gaussian, Gaussian_terms, 0.0), axis=1)
+        rows = np.flatnonzero(inside)
+        for index, prior_function in self._other_prior_functions:
+            ln_priors[rows] += [prior_function(value) for value in a[rows, index]]
+        return ln_priors
+
+    @property
+    def can_transform_unit_cube(self):
+        # a proper (normalisable) prior is needed for every variable
+        bounded = np.isfinite(self.flat_min) & np.isfinite(self.flat_max)
+        return not self._other_prior_functions and bool(np.all(bounded | self.is_Gaussian))
+
+    def transform_unit_cube(self, unit_values):
+        # maps values uniform in [0,1] to values distributed as the priors: flat
+        # priors become uniform within their bounds and Gaussian priors become
+        # Gaussians truncated to their flat bounds. NaN where that is not possible.
+        import scipy.special
+        u = np.atleast_2d(np.asarray(unit_values, dtype=float))
+        bounded = np.isfinite(self.flat_min) & np.isfinite(self.flat_max)
+        with np.errstate(invalid='ignore'):
+            flat_values = self.flat_min + u*(self.flat_max - self.flat_min)
+            lower_cdf = scipy.special.ndtr((self.flat_min - self.Gaussian_mean)/self.Gaussian_sigma)
+            upper_cdf = scipy.special.ndtr((self.flat_max - self.Gaussian_mean)/self.Gaussian_sigma)
+            Gaussian_values = self.Gaussian_mean + self.Gaussian_sigma*scipy.special.ndtri(lower_cdf + u*(upper_cdf - lower_cdf))
+        values = np.where(self.is_Gaussian, Gaussian_values, np.where(bounded, flat_values, np.nan))
+        for index, prior_function in self._other_prior_functions:
+            values[:, index] = np.nan
+        return values
+
+    def sample(self, number_of_samples, random_state=None, fallback_values=None, fallback_scale=0.05):
+        # variables whose prior cannot be sampled are drawn around fallback_values
+        random_state = np.random.RandomState(random_state) if not isinstance(random_state, np.random.RandomState) else random_state
+        samples = self.transform_unit_cube(random_state.uniform(size=(number_of_samples, len(self.flat_min))))
+        missing = np.isnan(samples)
+        if missing.any():
+            assert fallback_values is not None, "fallback_values are needed for the priors that cannot be sampled!"
+            fallback_values = np.broadcast_to(np.asarray(fallback_values, dtype=float), samples.shape)
+            samples[missing] = (fallback_values + fallback_scale*random_state.randn(*samples.shape))[missing]
+        return samples
+
+    def ln_function_gradient(self, array_of_values, relative_step=1.0e-6):
+        # derivatives inside the flat bounds; prior functions that are not
+        # Prior.ln_function are differentiated numerically
+        a = np.atleast_2d(np.asarray(array_of_values, dtype=float))
+        gradient = np.where(self.is_Gaussian, -(a-self.Gaussian_mean)/self.Gaussian_sigma**2, 0.0)
+        for index, prior_function in self._other_prior_functions:
+            for row, value in enumerate(a[:, index]):
+                step = relative_step*max(1.0, abs(value))
+                gradient[row, index] = (prior_function(value+step) - prior_function(value-step))/(2.0*step)
+        return gradient
+
+class Parameter_map:
+    # Declares which Variable feeds each parameter of a potential. Every entry in
+    # **parameters is either a Variable name, a (Variable name, factor) tuple or a
+    # fixed number; unlisted parameters keep their default values.
+    def __init__(self, potential_class, **parameters):
+        assert isinstance(potential_class, type) and issubclass(potential_class, Potential), "potential_class must be any derived class of the class Potential"
+        assert hasattr(potential_class, 'squared_circular_velocity_from_parameters_km2_s2'), "potential_class must implement squared_circular_velocity_from_parameters_km2_s2"
+        self._potential_class = potential_class
+        self._parameters = parameters
+
+    @property
+    def potential_class(self):
+        return self._potential_class
+
+    @property
+    def parameters(self):
+        return self._parameters
+
+    def compile(self, variables_dictionary):
+        function = self.potential_class.squared_circular_velocity_from_parameters_km2_s2
+        signature_parameters = list(inspect.signature(function).parameters.values())[1:]
+        parameter_names = [parameter.name for parameter in signature_parameters]
+        for name in self.parameters:
+            assert name in parameter_names, "{} is not a parameter of {}".format(name, self.potential_class.__name__)
+        arguments = []
+        for parameter in signature_parameters:
+            entry = self.parameters.get(parameter.name, parameter.default)
+            assert entry is not inspect.Parameter.empty, "parameter {} of {} must be given in the Parameter_map".format(parameter.name, self.potential_class.__name__)
+            if isinstance(entry, str):
+                entry = (entry, 1.0)
+            if isinstance(entry, tuple):
+                variable_name, factor = entry
+                try:
+                    index = variables_dictionary[variable_name].position_in_list
+                except KeyError:
+                    print("\nADVISE: Check that the Parameter_map of {} only uses the names of your Variables in list_of_variables.\n".format(self.potential_class.__name__))
+                    raise
+                arguments.append((index, float(factor)))
+            else:
+                arguments.append((None, entry))
+        gradient_function = getattr(self.potential_class, 'squared_circular_velocity_gradient_from_parameters_km2_s2', None)
+        return function, tuple(arguments), gradient_function, tuple(parameter_names)
+
 class Analysis:
     def __init__(self, list_of_variables, galaxy_model_creator,
-                 R_sun=Variable('R_sun',prior_function=Prior(Gaussian_mean=8.122, Gaussian_sigma=0.031).ln_function,value=8.122)):
+                 R_sun=Variable('R_sun',prior_function=Prior(Gaussian_mean=8.122, Gaussian_sigma=0.031).ln_function,value=8.122),
+                 parameter_maps=None, executor='process', data=None):
+        # data is a Rotation_curve_data, a loader (e.g. datahandling.Rotation_curve_loader)
+        # or a file name, loaded when first needed; by default the curve of arXiv:1810.09466
         self._variables_list = self._add_Rsun_to_list_of_variables(list_of_variables, R_sun)
         self._variables_key_list = [var.name for var in self.variables_list]
         self._variables_dictionary = self._set_variables_dictionary()
         self._check_galaxy_model_creator(galaxy_model_creator)
         self._galaxy_model_creator = galaxy_model_creator
-        self._data_lists = read_data_from_1810_09466()
+        if data is None:
+            data = get_data_from_1810_09466()
+        assert isinstance(data, (Rotation_curve_data, str)) or hasattr(data, 'get_data'), "data must be a Rotation_curve_data, a loader or a file name!"
+        self._data_source = data
+        self._data = data if isinstance(data, Rotation_curve_data) else None
         self._sampler = None
+        self._chain_storage = None
+        self._adaptive_report = {}
+        self._pool = None
+        self._pool_settings = {'executor': 'process', 'processes': None, 'chunksize': None}
+        self._executor_timings = {}
+        self._set_executor(executor)
+        self._instrumentation = None
+        self._prior_table = Prior_table.from_variables(self.variables_list)
+        self._compiled_parameter_map = None
+        self._has_analytic_gradient = False
+        self._fused_kernel = None
+        self._chi2_emulator = None
+        if parameter_maps is not None:
+            self.compile_parameter_map(*parameter_maps)
 
     @property
     def variables_list(self):
@@ -125,6 +315,108 @@ class Analysis:
     def galaxy_model_creator(self):
         return self._galaxy_model_creator
     
+    @property
+    def prior_table(self):
+        return self._prior_table
+
+    def compile_prior_table(self):
+        # to be called if the Prior objects of the variables are modified
+        self._prior_table = Prior_table.from_variables(self.variables_list)
+        self._restart_pool()
+
+    _executors = tuple(executor_classes) + ('auto',)
+
+    def _set_executor(self, executor):
+        assert executor in self._executors, "executor must be one of {}".format(self._executors)
+        self._pool_settings['executor'] = executor
+
+    @property
+    def executor(self):
+        # 'serial', 'thread', 'process', 'cluster' or 'auto', used by pool
+        return self._pool_settings['executor']
+
+    @property
+    def executor_timings(self):
+        # seconds per likelihood batch of each executor timed by the 'auto' probe
+        return self._executor_timings
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self.data # loaded once, before the workers copy the Analysis
+            settings = self._pool_settings
+            if settings['executor'] == 'auto':
+                self._pool, self._executor_timings = choose_executor(self, processes=settings['processes'], chunksize=settings['chunksize'])
+            else:
+                self._pool = create_executor(settings['executor'], self, processes=settings['processes'], chunksize=settings['chunksize'])
+        return self._pool
+
+    def start_pool(self, processes=None, chunksize=None, executor=None):
+        # the pool lives until close_pool is called or the Analysis is deleted;
+        # executor=None keeps the current kind of executor
+        self.close_pool()
+        if executor is not None:
+            self._set_executor(executor)
+        self._pool_settings.update(processes=processes, chunksize=chunksize)
+        return self.pool
+
+    def close_pool(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    def _restart_pool(self):
+        # workers hold a copy of the Analysis taken when the pool was started
+        if self._pool is not None:
+            self.close_pool()
+            self.pool
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        state['_sampler'] = None
+        state['_chain_storage'] = None
+        state['_instrumentation'] = None
+        return state
+
+    def __del__(self):
+        try:
+            self.close_pool()
+        except Exception:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_pool()
+
+    @property
+    def instrumentation(self):
+        return self._instrumentation
+
+    def start_instrumentation(self, profile=False):
+        # Until stop_instrumentation, the likelihood and the sampler steps are
+        # timed in the returned instrumentation.Instrumentation (profile=True
+        # adds a cProfile of this process). It slows down cheap likelihoods.
+        self.stop_instrumentation()
+        self._instrumentation = Instrumentation(profile=profile)
+        self._instrumentation.start()
+        return self._instrumentation
+
+    def stop_instrumentation(self):
+        instrumentation = self._instrumentation
+        if instrumentation is not None:
+            instrumentation.stop()
+            self._instrumentation = None
+        return instrumentation
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = get_rotation_curve_data(self._data_source)
+        return self._data
+
     @property
     def sampler(self):
         return self._sampler
@@ -167,6 +459,72 @@ class Analysis:
             raise
         assert isinstance(result, Galactic_model), "galaxy_model_creator must return an instance of Galactic_model in galaxymodel module!"
     
+    def compile_parameter_map(self, *parameter_maps, rtol=1.0e-10):
+        # After compilation the likelihood evaluates the potentials directly from
+        # the array of values, without going through galaxy_model_creator.
+        assert len(parameter_maps) > 0, "at least one Parameter_map is needed!"
+        for parameter_map in parameter_maps:
+            assert isinstance(parameter_map, Parameter_map), "parameter_maps must be instances of class Parameter_map!"
+        compiled_parameter_map = tuple(parameter_map.compile(self._variables_dictionary) for parameter_map in parameter_maps)
+        current_values = np.array([var.value for var in self.variables_list], dtype=float)
+        R_kpc = self.data.R_kpc
+        Vc2_from_creator = self.set_galaxy_model(current_values).circular_velocity_km_s(R_kpc)**2
+        Vc2_from_map = self._squared_circular_velocity_from_parameter_map(current_values, R_kpc, compiled_parameter_map)
+        if not np.allclose(Vc2_from_map, Vc2_from_creator, rtol=rtol, atol=0.0):
+            print("\nADVISE: Check that the parameter maps describe the same potentials as your galaxy_model_creator.\n")
+            raise AssertionError("parameter maps and galaxy_model_creator give different circular velocities!")
+        self._compiled_parameter_map = compiled_parameter_map
+        self._has_analytic_gradient = self._check_analytic_gradient(compiled_parameter_map)
+        self._fused_kernel = None
+        self._restart_pool()
+
+    def remove_parameter_map(self):
+        self._compiled_parameter_map = None
+        self._has_analytic_gradient = False
+        self._fused_kernel = None
+        self._restart_pool()
+
+    @property
+    def fused_kernel(self):
+        return self._fused_kernel
+
+    def compile_fused_kernel(self, backend='auto'):
+        # The vectorized likelihood then gets the chi2 from a kernels.Fused_chi2,
+        # which reuses its buffers between calls ('numpy', same result as
+        # without it) or runs a single compiled pass ('numba', if installed).
+        # Needs a compiled parameter map, and is removed when it changes.
+        assert self._compiled_parameter_map is not None, "compile a parameter map before the fused kernel!"
+        data = self.data
+        self._fused_kernel = Fused_chi2(self._compiled_parameter_map, data.R_kpc, data.vc_km_s, data.inverse_variance, backend=backend)
+        self._restart_pool()
+        return self._fused_kernel.backend
+
+    def remove_fused_kernel(self):
+        self._fused_kernel = None
+        self._restart_pool()
+
+    @staticmethod
+    def _squared_circular_velocity_from_parameter_map(array_of_values, R_kpc, compiled_parameter_map):
+        a = np.asarray(array_of_values, dtype=float)
+        if a.ndim == 1:
+            # plain floats are much cheaper than 1-element arrays for a single model
+            a = a.tolist()
+        else:
+            a = np.moveaxis(a, -1, 0)[..., np.newaxis]
+        Vc2 = 0.0
+        for function, arguments, *gradient in compiled_parameter_map:
+            Vc2 = Vc2 + function(R_kpc, *[value if index is None else a[index]*value for index, value in arguments])
+        return Vc2
+
+    def _get_model_circular_velocity_km_s(self, array_of_values, R_kpc=None):
+        if R_kpc is None:
+            R_kpc = self.data.R_kpc
+        if self._compiled_parameter_map is not None:
+            return np.sqrt(self._squared_circular_velocity_from_parameter_map(array_of_values, R_kpc, self._compiled_parameter_map))
+        if np.ndim(array_of_values) == 1:
+            return self.set_galaxy_model(array_of_values).circular_velocity_km_s(R_kpc)
+        return self.set_galaxy_model_vectorized(array_of_values).circular_velocity_km_s(R_kpc)
+
     def set_galaxy_model(self, list_of_values):
         d = self._variables_dictionary
         l = list_of_values
@@ -174,6 +532,20 @@ class Analysis:
             d[key].value = l[d[key].position_in_list]
         return self.galaxy_model_creator(d)
     
+    def set_galaxy_model_vectorized(self, array_of_values):
+        # Variables temporarily hold columns of shape (n_models, 1), so that
+        # the potentials broadcast them against arrays of radii.
+        d = self._variables_dictionary
+        a = np.atleast_2d(array_of_values)
+        previous_values = {key: d[key].value for key in d}
+        for key in d:
+            d[key].value = a[:, d[key].position_in_list, np.newaxis]
+        try:
+            return self.galaxy_model_creator(d)
+        finally:
+            for key in d:
+                d[key].value = previous_values[key]
+
     def get_ln_priors(self, list_of_values):
         d = self._variables_dictionary
         l = list_of_values
@@ -184,58 +556,938 @@ class Analysis:
             prior += prior_function(l[index])
         return prior
     
+    def get_chi2(self, vc_model):
+        # chi2 of every model curve in the last axis of vc_model
+        data = self.data
+        return np.sum((data.vc_km_s - vc_model)**2*data.inverse_variance, axis=-1)
+
+    def _time_section(self, name, number_of_evaluations=1):
+        # section of the likelihood timed while the instrumentation is on
+        if self._instrumentation is None:
+            return contextlib.nullcontext()
+        return self._instrumentation.time_section(name, number_of_evaluations)
+
     def ln_likelihood(self, list_of_values):
-        lp = self.get_ln_priors(list_of_values)
+        if self._instrumentation is not None:
+            self._instrumentation.count_likelihood_call(1)
+        with self._time_section('prior'):
+            lp = self.get_ln_priors(list_of_values)
         if not np.isfinite(lp):
             return -np.infty
-        GM = self.set_galaxy_model(list_of_values)
-        chi2 = sum(((data[1] - GM.circular_velocity_km_s(data[0]))/(np.sqrt(
-                ((data[2]+data[3])/2)**2 # statistical error in the data
-                + (data[4])**2 # systematic error in the data
-                )))**2 for data in self._data_lists)
+        with self._time_section('model'):
+            vc_model = self._get_model_circular_velocity_km_s(list_of_values)
+        with self._time_section('chi2'):
+            chi2 = self.get_chi2(vc_model)
         return lp -chi2/2
+
+    @property
+    def has_analytic_gradient(self):
+        return self._has_analytic_gradient
+
+    def _check_analytic_gradient(self, compiled_parameter_map):
+        # every parameter fed by a Variable needs its derivative
+        for function, arguments, gradient_function, parameter_names in compiled_parameter_map:
+            if gradient_function is None:
+                return False
+            derivatives = gradient_function(self.data.R_kpc[:1], *[value if index is None else 1.0 for index, value in arguments])
+            if any(index is not None and name not in derivatives for (index, value), name in zip(arguments, parameter_names)):
+                return False
+        return True
+
+    def ln_likelihood_and_grad(self, list_of_values):
+        assert self.has_analytic_gradient, "ln_likelihood_and_grad needs a compiled parameter map of potentials with analytic gradients!"
+        values = np.asarray(list_of_values, dtype=float)
+        gradient = np.zeros(len(values))
+        lp = self.get_ln_priors(values)
+        if not np.isfinite(lp):
+            return -np.infty, gradient
+        data = self.data
+        R_kpc = data.R_kpc
+        l = values.tolist()
+        Vc2 = 0.0
+        dVc2 = np.zeros((len(values), len(R_kpc)))
+        for function, arguments, gradient_function, parameter_names in self._compiled_parameter_map:
+            parameters = [value if index is None else l[index]*value for index, value in arguments]
+            Vc2 = Vc2 + function(R_kpc, *parameters)
+            derivatives = gradient_function(R_kpc, *parameters)
+            for (index, factor), name in zip(arguments, parameter_names):
+                if index is not None:
+                    dVc2[index] += factor*derivatives[name]
+        vc_model = np.sqrt(Vc2)
+        residuals = data.vc_km_s - vc_model
+        chi2 = np.sum(residuals**2*data.inverse_variance)
+        # d(-chi2/2)/dVc^2 = w*(vc - V)/(2V)
+        gradient += dVc2 @ (data.inverse_variance*residuals/(2.0*vc_model))
+        gradient += self.prior_table.ln_function_gradient(values)[0]
+        return lp - chi2/2, gradient
+
+    def get_ln_priors_vectorized(self, array_of_values):
+        return self.prior_table.ln_function(array_of_values)
+
+    def ln_likelihood_vectorized(self, array_of_values):
+        a = np.atleast_2d(array_of_values)
+        if self._instrumentation is not None:
+            self._instrumentation.count_likelihood_call(len(a))
+        ln_likelihoods = np.full(len(a), -np.infty)
+        with self._time_section('prior', len(a)):
+            lp = self.get_ln_priors_vectorized(a)
+        finite = np.isfinite(lp)
+        number_of_models = np.count_nonzero(finite)
+        if number_of_models == 0:
+            return ln_likelihoods
+        chi2 = self._get_chi2_vectorized(a[finite])
+        ln_likelihoods[finite] = lp[finite] - chi2/2
+        return ln_likelihoods
+
+    def _get_chi2_vectorized(self, array_of_values):
+        # the fused kernel computes the model and its chi2 in the 'chi2' section
+        number_of_models = len(array_of_values)
+        if self._fused_kernel is not None:
+            with self._time_section('chi2', number_of_models):
+                return self._fused_kernel.chi2(array_of_values)
+        with self._time_section('model', number_of_models):
+            vc_model = np.broadcast_to(self._get_model_circular_velocity_km_s(array_of_values), (number_of_models, len(self.data)))
+        with self._time_section('chi2', number_of_models):
+            return self.get_chi2(vc_model)
+
+    def get_ln_priors_and_ln_data_likelihoods_vectorized(self, array_of_values):
+        # ln priors and -chi2/2 of every row, whose sum is ln_likelihood_vectorized;
+        # -chi2/2 is only computed where the priors are finite, and 0 elsewhere
+        a = np.atleast_2d(array_of_values)
+        lp = self.get_ln_priors_vectorized(a)
+        finite = np.isfinite(lp)
+        ln_data_likelihoods = np.zeros(len(a))
+        if np.any(finite):
+            ln_data_likelihoods[finite] = -self._get_chi2_vectorized(a[finite])/2
+        return lp, ln_data_likelihoods
+
+    def _get_ln_priors_and_ln_data_likelihoods_from_pool(self, array_of_values):
+        pool = self.pool
+        chunks = split_in_chunks(array_of_values, number_of_chunks=pool.processes, chunksize=pool.chunksize)
+        results = pool.map(_ln_priors_and_ln_data_likelihoods_in_worker, chunks)
+        return np.concatenate([result[0] for result in results]), np.concatenate([result[1] for result in results])
     
-    def get_maximum_likelihood_variables(self):
+    _model_quantities = ('circular_velocity_km_s', 'density_GeV_cm3')
+    # rough number of (n_samples, n_R) arrays alive while evaluating a block of models
+    _temporary_arrays_per_block = 8
+
+    def _get_model_quantity(self, array_of_values, R_kpc, quantity):
+        if quantity == 'circular_velocity_km_s':
+            values = self._get_model_circular_velocity_km_s(array_of_values, R_kpc)
+        else:
+            galactic_model = self.set_galaxy_model_vectorized(array_of_values)
+            if quantity == 'density_GeV_cm3':
+                values = galactic_model.density_GeV_cm3(R_kpc)
+            else:
+                values = quantity(galactic_model, R_kpc)
+        return np.broadcast_to(values, (len(array_of_values), len(R_kpc)))
+
+    def iterate_model_curves(self, samples, R_kpc, quantity='circular_velocity_km_s', chunksize=None, memory_limit_MB=4):
+        # Yields (first_row, block) with block the (n_rows, n_R) values of the
+        # quantity for consecutive rows of samples, one row per model. quantity is
+        # one of _model_quantities or a function(galactic_model, R_kpc) that
+        # broadcasts over models built by set_galaxy_model_vectorized. Without a
+        # chunksize, blocks hold as many models as fit in memory_limit_MB; small
+        # blocks that stay in the CPU cache are faster than large ones.
+        assert quantity in self._model_quantities or callable(quantity), "quantity must be one of {} or a function!".format(self._model_quantities)
+        R_kpc = np.atleast_1d(np.asarray(R_kpc, dtype=float))
+        assert R_kpc.ndim == 1, "R_kpc must be a 1D array of radii!"
+        assert np.ndim(samples) == 2 and np.shape(samples)[1] == len(self.variables_list), \
+            "samples must be a (n_samples, {}) array!".format(len(self.variables_list))
+        if chunksize is None:
+            chunksize = max(1, int(memory_limit_MB*2**20/(8*len(R_kpc)*self._temporary_arrays_per_block)))
+        assert isinstance(chunksize, int) and chunksize > 0, "chunksize must be a positive int!"
+        for start in range(0, len(samples), chunksize):
+            block = np.asarray(samples[start:start+chunksize], dtype=float)
+            yield start, np.ascontiguousarray(self._get_model_quantity(block, R_kpc, quantity))
+
+    def get_model_curves(self, samples, R_kpc, quantity='circular_velocity_km_s', chunksize=None, memory_limit_MB=4, out=None):
+        # (n_samples, n_R) array; out may be a preallocated (e.g. memory-mapped) array
+        R_kpc = np.atleast_1d(np.asarray(R_kpc, dtype=float))
+        if out is None:
+            out = np.empty((len(samples), len(R_kpc)))
+        assert out.shape == (len(samples), len(R_kpc)), "out must be a (n_samples, n_R) array!"
+        for start, block in self.iterate_model_curves(samples, R_kpc, quantity, chunksize, memory_limit_MB):
+            out[start:start+len(block)] = block
+        return out
+
+    def get_model_bands(self, samples, R_kpc, quantity='circular_velocity_km_s', percentiles=(2.5, 16.0, 50.0, 84.0, 97.5),
+                        number_of_bins=1000, chunksize=None, memory_limit_MB=4, range_margin=1.0):
+        # Percentile bands of the quantity at each radius over all samples,
+        # without holding the (n_samples, n_R) curves, in a single pass over the
+        # blocks. As in Posterior_summary, the histograms of Binned_percentiles
+        # span the range of the first block widened by range_margin times its
+        # span on each side; later values outside it are only counted.
+        R_kpc = np.atleast_1d(np.asarray(R_kpc, dtype=float))
+        number_of_samples = 0
+        minimum = np.full(len(R_kpc), np.infty)
+        maximum = np.full(len(R_kpc), -np.infty)
+        mean = np.zeros(len(R_kpc))
+        sum_of_squared_deviations = np.zeros(len(R_kpc))
+        binned_percentiles = None
+        for start, block in self.iterate_model_curves(samples, R_kpc, quantity, chunksize, memory_limit_MB):
+            if binned_percentiles is None:
+                block_minimum, block_maximum = np.min(block, axis=0), np.max(block, axis=0)
+                span = np.where(block_maximum > block_minimum, block_maximum - block_minimum, np.maximum(np.abs(block_minimum), 1.0))
+                binned_percentiles = Binned_percentiles(block_minimum - range_margin*span, block_maximum + range_margin*span, number_of_bins=number_of_bins)
+            binned_percentiles.add(block)
+            # pairwise update of mean and variance (Chan et al.), as Running_moments
+            # but without the (n_R, n_R) covariance
+            block_mean = np.mean(block, axis=0)
+            delta = block_mean - mean
+            total = number_of_samples + len(block)
+            mean += delta*len(block)/total
+            sum_of_squared_deviations += np.sum((block - block_mean)**2, axis=0) + delta**2*number_of_samples*len(block)/total
+            number_of_samples = total
+            minimum = np.minimum(minimum, np.min(block, axis=0))
+            maximum = np.maximum(maximum, np.max(block, axis=0))
+        assert number_of_samples > 0, "samples must not be empty!"
+        return {
+                'R_kpc':R_kpc,
+                'percentiles':np.array(percentiles, dtype=float, ndmin=1),
+                'bands':binned_percentiles.get_percentiles(percentiles),
+                'mean':mean,
+                'std':np.sqrt(sum_of_squared_deviations/number_of_samples),
+                'minimum':minimum,
+                'maximum':maximum,
+                'number_of_samples':number_of_samples,
+        }
+
+    def get_current_values(self):
         d = self._variables_dictionary
-        initial_maximum = np.ones(len(self.variables_list))
+        values = np.ones(len(self.variables_list))
         for var in self.variables_key_list:
-            initial_maximum[d[var].position_in_list] = d[var].value
-        loss_function_to_minimise = lambda args: -self.ln_likelihood(args)
-        result = optim.minimize(loss_function_to_minimise, initial_maximum)
+            values[d[var].position_in_list] = d[var].value
+        return values
+
+    def maximise_ln_likelihood(self, initial_values):
+        import scipy.optimize as optim
+        if self.has_analytic_gradient:
+            def loss_function_to_minimise(args):
+                ln_likelihood, gradient = self.ln_likelihood_and_grad(args)
+                return -ln_likelihood, -gradient
+            result = optim.minimize(loss_function_to_minimise, initial_values, jac=True)
+        else:
+            loss_function_to_minimise = lambda args: -self.ln_likelihood(args)
+            result = optim.minimize(loss_function_to_minimise, initial_values)
+        return result
+
+    def get_maximum_likelihood_variables(self):
+        initial_maximum = self.get_current_values()
+        result = self.maximise_ln_likelihood(initial_maximum)
         initial_maximum = result["x"]
         return initial_maximum
+
+    def get_maximum_likelihood_variables_multistart(self, number_of_starts, random_state=None, use_pool=True):
+        # The first start is the current value of the Variables, the others are
+        # drawn from the priors. The optimisations run concurrently in the pool.
+        current_values = self.get_current_values()
+        starts = self.prior_table.sample(number_of_starts, random_state=random_state, fallback_values=current_values)
+        starts[0] = current_values
+        if use_pool:
+            results = self.pool.map(_maximise_ln_likelihood_in_worker, starts)
+        else:
+            results = [_maximise_ln_likelihood_in_worker(self, start) for start in starts]
+        solutions = np.array([result[0] for result in results])
+        ln_likelihoods = np.array([result[1] for result in results])
+        finite = np.isfinite(ln_likelihoods)
+        assert finite.any(), "none of the optimisations found a finite ln likelihood!"
+        best = np.argmax(np.where(finite, ln_likelihoods, -np.infty))
+        return {
+                'x':solutions[best],
+                'ln_likelihood':ln_likelihoods[best],
+                'starts':starts,
+                'solutions':solutions,
+                'ln_likelihoods':ln_likelihoods,
+                'spread':np.std(solutions[finite], axis=0),
+                'number_of_converged':int(np.sum([result[2] for result in results])),
+        }
     
-    def compute_burntin(self, number_of_walkers, number_of_steps):
+    def _get_ln_likelihoods_row_by_row(self, array_of_values):
+        # ln_likelihood of every row, for the galaxy_model_creator's that only
+        # accept scalar values; the Variables keep their values, as with
+        # ln_likelihood_vectorized
+        previous_values = [var.value for var in self.variables_list]
+        try:
+            return np.array([self.ln_likelihood(values) for values in np.atleast_2d(array_of_values)], dtype=float)
+        finally:
+            for var, value in zip(self.variables_list, previous_values):
+                var.value = value
+
+    def _get_ln_likelihoods_from_pool(self, array_of_values):
+        # _get_ln_likelihoods_row_by_row, in the workers
+        pool = self.pool
+        chunks = split_in_chunks(array_of_values, number_of_chunks=pool.processes, chunksize=pool.chunksize)
+        return np.concatenate(pool.map(_ln_likelihoods_row_by_row_in_worker, chunks))
+
+    def _create_sampler(self, number_of_walkers, vectorize=False):
+        # vectorize=True evaluates the whole ensemble in this process, otherwise
+        # it goes through the executor of pool (see start_pool). The workers only
+        # use ln_likelihood_vectorized with a compiled parameter map, which does
+        # not go through galaxy_model_creator; otherwise they call ln_likelihood
+        # row by row.
+        import emcee
+        number_of_dimensions = len(self.variables_list)
+        row_by_row = self._compiled_parameter_map is None
+        if vectorize:
+            ln_likelihood_vectorized = self.ln_likelihood_vectorized
+        elif self._instrumentation is not None:
+            ln_likelihood_vectorized = functools.partial(self._instrumentation.ln_likelihood_vectorized_with_executor, self.pool, row_by_row=row_by_row)
+        elif row_by_row:
+            ln_likelihood_vectorized = self._get_ln_likelihoods_from_pool
+        else:
+            ln_likelihood_vectorized = self.pool.ln_likelihood_vectorized
+        return emcee.EnsembleSampler(number_of_walkers, number_of_dimensions, ln_likelihood_vectorized, vectorize=True)
+
+    def _sample(self, sampler, initial_state, iterations, **kwargs):
+        # sampler.sample, with the steps timed while the instrumentation is on
+        if self._instrumentation is not None:
+            return self._instrumentation.iterate_sampler(sampler, initial_state, iterations, **kwargs)
+        return sampler.sample(initial_state, iterations=iterations, **kwargs)
+
+    def _run_sampler(self, sampler, initial_state, iterations):
+        # as sampler.run_mcmc, returning the last state
+        state = None
+        for state in self._sample(sampler, initial_state, iterations):
+            pass
+        return state
+
+    def compute_burntin(self, number_of_walkers, number_of_steps, vectorize=False, number_of_starts=1, initial_variables=None):
+        # the walkers start around initial_variables, by default the maximum likelihood
         number_of_dimensions = len(self.variables_list)
-        initial_variables = self.get_maximum_likelihood_variables()
+        if initial_variables is not None:
+            initial_variables = np.asarray(initial_variables, dtype=float)
+        elif number_of_starts > 1:
+            initial_variables = self.get_maximum_likelihood_variables_multistart(number_of_starts, use_pool=not vectorize)['x']
+        else:
+            initial_variables = self.get_maximum_likelihood_variables()
         walkers_position = [initial_variables + 0.05*np.random.randn(number_of_dimensions) for i in range(number_of_walkers)]
-        with Pool() as pool:
-            sampler = emcee.EnsembleSampler(number_of_walkers, number_of_dimensions, self.ln_likelihood, pool=pool)
-            start = time.time()
-            walkers_after_burntin, prob, state = sampler.run_mcmc(walkers_position, number_of_steps)
-            end = time.time()
-            multi_time = end - start
-            print("Burntin took {0:.1f} seconds".format(multi_time))
-            sampler.reset()
+        sampler = self._create_sampler(number_of_walkers, vectorize=vectorize)
+        start = time.time()
+        walkers_after_burntin = self._run_sampler(sampler, walkers_position, number_of_steps).coords
+        end = time.time()
+        multi_time = end - start
+        print("Burntin took {0:.1f} seconds".format(multi_time))
+        sampler.reset()
         return walkers_after_burntin
     
-    def compute_mcmc(self, number_of_walkers, number_of_steps, walkers_after_burntin):
-        number_of_dimensions = len(self.variables_list)
-        with Pool() as pool:
-            sampler = emcee.EnsembleSampler(number_of_walkers, number_of_dimensions, self.ln_likelihood, pool=pool)
-            start = time.time()
-            sampler.run_mcmc(walkers_after_burntin, number_of_steps)
-            end = time.time()
-            multi_time = end - start
-            print("MCMC took {0:.1f} seconds".format(multi_time))
+    def compute_mcmc(self, number_of_walkers, number_of_steps, walkers_after_burntin, vectorize=False, storage=None, flush_every=100, summary=None):
+        # storage (a directory or a Chain_storage) streams the chain to disk instead
+        # of keeping it in the sampler; an unfinished run in it is resumed.
+        # summary (an onlinestatistics.Posterior_summary) is updated with the
+        # walkers of every step.
+        sampler = self._create_sampler(number_of_walkers, vectorize=vectorize)
+        start = time.time()
+        if storage is not None:
+            self._run_mcmc_with_storage(sampler, number_of_walkers, number_of_steps, walkers_after_burntin, storage, flush_every, summary)
+        elif summary is not None:
+            for state in self._sample(sampler, np.array(walkers_after_burntin, dtype=float), number_of_steps):
+                summary.update(state.coords)
+        else:
+            self._run_sampler(sampler, walkers_after_burntin, number_of_steps)
+        end = time.time()
+        multi_time = end - start
+        print("MCMC took {0:.1f} seconds".format(multi_time))
         self._sampler = sampler
+        if storage is None:
+            # save_results and pickle_results read the chain of a previous run with storage otherwise
+            self._chain_storage = None
+
+    def _run_mcmc_with_storage(self, sampler, number_of_walkers, number_of_steps, walkers_after_burntin, storage, flush_every, summary=None):
+        import emcee
+        if not isinstance(storage, Chain_storage):
+            storage = Chain_storage(storage, number_of_walkers, number_of_steps, len(self.variables_list),
+                                    variable_names=self.variables_key_list, flush_every=flush_every)
+        self._chain_storage = storage
+        if storage.steps_completed > 0:
+            print("Resuming MCMC from step {0} of {1}".format(storage.steps_completed, storage.number_of_steps))
+            positions, ln_likelihoods = storage.last_positions, storage.last_lnlikelihoods
+            if summary is not None and summary.number_of_samples == 0:
+                summary.update_from_chains(storage.chains[:, :storage.steps_completed])
+        else:
+            positions, ln_likelihoods = np.array(walkers_after_burntin, dtype=float), None
+        remaining_steps = storage.number_of_steps - storage.steps_completed
+        for state in self._sample(sampler, emcee.State(positions, log_prob=ln_likelihoods), remaining_steps, store=False):
+            storage.append(state.coords, state.log_prob, np.any(state.coords != positions, axis=1))
+            if summary is not None:
+                summary.update(state.coords)
+            positions = state.coords
+        storage.flush()
+
+    @property
+    def chain_storage(self):
+        return self._chain_storage
         
-    def compute_mcmc_and_burntin(self, number_of_walkers, number_of_steps_burntin, number_of_steps_mcmc):
-        walkers_after_burntin = self.compute_burntin(number_of_walkers,number_of_steps_burntin)
-        self.compute_mcmc(number_of_walkers,number_of_steps_mcmc,walkers_after_burntin)
+    def _run_until_converged(self, sampler, initial_state, maximum_number_of_steps, check_every, is_converged):
+        # runs the sampler in blocks of check_every steps until is_converged(chain)
+        # returns True or maximum_number_of_steps is reached; returns the last
+        # state and the last result of is_converged
+        state = initial_state
+        converged = False
+        while sampler.iteration < maximum_number_of_steps:
+            number_of_steps = min(check_every, maximum_number_of_steps - sampler.iteration)
+            state = self._run_sampler(sampler, state, number_of_steps)
+            converged = bool(is_converged(sampler.get_chain()))
+            if converged:
+                break
+        return state, converged
+
+    def compute_burntin_adaptive(self, number_of_walkers, maximum_number_of_steps, check_every=100, vectorize=False, number_of_starts=1,
+                                 autocorrelation_tolerance=0.05, Gelman_Rubin_threshold=1.05, minimum_steps_per_autocorrelation_time=10):
+        # The burntin ends when the autocorrelation time estimated on the last half
+        # of the chain changes less than autocorrelation_tolerance between checks,
+        # the chain is minimum_steps_per_autocorrelation_time times longer than it
+        # and the Gelman-Rubin statistic across walkers is below the threshold.
+        number_of_dimensions = len(self.variables_list)
+        if number_of_starts > 1:
+            initial_variables = self.get_maximum_likelihood_variables_multistart(number_of_starts, use_pool=not vectorize)['x']
+        else:
+            initial_variables = self.get_maximum_likelihood_variables()
+        walkers_position = initial_variables + 0.05*np.random.randn(number_of_walkers, number_of_dimensions)
+        sampler = self._create_sampler(number_of_walkers, vectorize=vectorize)
+        diagnostics = {'autocorrelation_time':None, 'Gelman_Rubin':None}
+        def is_converged(chain):
+            last_half = chain[len(chain)//2:]
+            previous_autocorrelation_time = diagnostics['autocorrelation_time']
+            autocorrelation_time = integrated_autocorrelation_time(last_half)
+            Gelman_Rubin = gelman_rubin(np.swapaxes(last_half, 0, 1))
+            diagnostics.update(autocorrelation_time=autocorrelation_time, Gelman_Rubin=Gelman_Rubin)
+            if previous_autocorrelation_time is None:
+                return False
+            return (np.all(np.abs(autocorrelation_time - previous_autocorrelation_time) < autocorrelation_tolerance*autocorrelation_time)
+                    and len(last_half) > minimum_steps_per_autocorrelation_time*np.max(autocorrelation_time)
+                    and np.all(Gelman_Rubin < Gelman_Rubin_threshold))
+        start = time.time()
+        state, converged = self._run_until_converged(sampler, walkers_position, maximum_number_of_steps, check_every, is_converged)
+        end = time.time()
+        self._adaptive_report['burntin'] = self._get_adaptive_report(sampler.iteration, maximum_number_of_steps, converged, **diagnostics)
+        print("Burntin took {0:.1f} seconds and {1} steps ({2} steps saved)".format(end - start, sampler.iteration, maximum_number_of_steps - sampler.iteration))
+        return state.coords
+
+    def compute_mcmc_adaptive(self, number_of_walkers, maximum_number_of_steps, walkers_after_burntin, target_effective_sample_size,
+                              check_every=100, vectorize=False, minimum_steps_per_autocorrelation_time=50):
+        # The MCMC stops once the effective sample size, number of samples over
+        # the largest autocorrelation time, reaches target_effective_sample_size
+        # and the chain is long enough for the autocorrelation time to be reliable.
+        sampler = self._create_sampler(number_of_walkers, vectorize=vectorize)
+        diagnostics = {'autocorrelation_time':None, 'Gelman_Rubin':None, 'effective_sample_size':None}
+        def is_converged(chain):
+            autocorrelation_time = integrated_autocorrelation_time(chain)
+            effective_sample_size = chain.shape[0]*chain.shape[1]/np.max(autocorrelation_time)
+            diagnostics.update(autocorrelation_time=autocorrelation_time, Gelman_Rubin=gelman_rubin(np.swapaxes(chain, 0, 1)),
+                               effective_sample_size=effective_sample_size)
+            return (effective_sample_size >= target_effective_sample_size
+                    and len(chain) > minimum_steps_per_autocorrelation_time*np.max(autocorrelation_time))
+        start = time.time()
+        state, converged = self._run_until_converged(sampler, np.array(walkers_after_burntin, dtype=float), maximum_number_of_steps, check_every, is_converged)
+        end = time.time()
+        self._adaptive_report['mcmc'] = self._get_adaptive_report(sampler.iteration, maximum_number_of_steps, converged, **diagnostics)
+        print("MCMC took {0:.1f} seconds and {1} steps ({2} steps saved)".format(end - start, sampler.iteration, maximum_number_of_steps - sampler.iteration))
+        self._sampler = sampler
+        self._chain_storage = None
+
+    def compute_mcmc_and_burntin_adaptive(self, number_of_walkers, maximum_number_of_steps_burntin, maximum_number_of_steps_mcmc,
+                                          target_effective_sample_size, check_every=100, vectorize=False, number_of_starts=1):
+        walkers_after_burntin = self.compute_burntin_adaptive(number_of_walkers, maximum_number_of_steps_burntin, check_every=check_every,
+                                                              vectorize=vectorize, number_of_starts=number_of_starts)
+        self.compute_mcmc_adaptive(number_of_walkers, maximum_number_of_steps_mcmc, walkers_after_burntin, target_effective_sample_size,
+                                   check_every=check_every, vectorize=vectorize)
+        return self.adaptive_report
+
+    @staticmethod
+    def _get_adaptive_report(number_of_steps, maximum_number_of_steps, converged, **diagnostics):
+        report = {
+                'number_of_steps':number_of_steps,
+                'maximum_number_of_steps':maximum_number_of_steps,
+                'steps_saved':maximum_number_of_steps - number_of_steps,
+                'converged':converged,
+        }
+        report.update(diagnostics)
+        return report
+
+    @property
+    def adaptive_report(self):
+        return self._adaptive_report
+
+    def compute_parallel_tempering(self, number_of_walkers, number_of_steps, walkers_positions=None, number_of_temperatures=4, maximum_temperature=None,
+                                   number_of_steps_burntin=0, vectorize=False, number_of_starts=1, random_state=None):
+        # Samples the posterior with number_of_walkers walkers at each of the
+        # temperatures of paralleltempering.get_temperature_ladder, evaluated all
+        # together in this process (vectorize=True) or through pool. Without
+        # walkers_positions they start around the maximum likelihood. sampler then
+        # holds the chain at temperature 1, after number_of_steps_burntin steps are
+        # discarded. Returns the report of the swaps and the acceptances.
+        number_of_dimensions = len(self.variables_list)
+        rng = np.random.RandomState(random_state) if not isinstance(random_state, np.random.RandomState) else random_state
+        if walkers_positions is None:
+            if number_of_starts > 1:
+                initial_variables = self.get_maximum_likelihood_variables_multistart(number_of_starts, random_state=rng, use_pool=not vectorize)['x']
+            else:
+                initial_variables = self.get_maximum_likelihood_variables()
+            walkers_positions = initial_variables + 0.05*rng.randn(number_of_walkers, number_of_dimensions)
+        if vectorize:
+            ln_priors_and_ln_likelihoods = self.get_ln_priors_and_ln_data_likelihoods_vectorized
+        else:
+            ln_priors_and_ln_likelihoods = self._get_ln_priors_and_ln_data_likelihoods_from_pool
+        betas = get_temperature_ladder(number_of_temperatures, number_of_dimensions, maximum_temperature=maximum_temperature)
+        sampler = Parallel_tempering_sampler(number_of_walkers, number_of_dimensions, ln_priors_and_ln_likelihoods, betas, random_state=rng)
+        start = time.time()
+        if number_of_steps_burntin > 0:
+            sampler.run_mcmc(walkers_positions, number_of_steps_burntin)
+            sampler.reset()
+            walkers_positions = None
+        sampler.run_mcmc(walkers_positions, number_of_steps)
+        end = time.time()
+        report = sampler.get_report()
+        autocorrelation_time = integrated_autocorrelation_time(sampler.get_chain())
+        effective_sample_size = number_of_steps*number_of_walkers/np.max(autocorrelation_time)
+        report.update(autocorrelation_time=autocorrelation_time.tolist(), effective_sample_size=float(effective_sample_size),
+                      likelihood_evaluations_per_effective_sample=sampler.number_of_likelihood_evaluations/effective_sample_size)
+        print("Parallel tempering took {0:.1f} seconds".format(end - start))
+        self._sampler = sampler
+        self._chain_storage = None
+        return report
+
+    def _get_ln_data_likelihoods_of_unit_cube(self, unit_values, vectorize=False):
+        values = self.prior_table.transform_unit_cube(unit_values)
+        if vectorize:
+            ln_priors, ln_data_likelihoods = self.get_ln_priors_and_ln_data_likelihoods_vectorized(values)
+        else:
+            ln_priors, ln_data_likelihoods = self._get_ln_priors_and_ln_data_likelihoods_from_pool(values)
+        return np.where(np.isfinite(ln_priors), ln_data_likelihoods, -np.infty)
+
+    def compute_nested_sampling(self, number_of_live_points=400, dlogz=0.1, batch_size=None, vectorize=False, enlargement=1.25,
+                                maximum_iterations=None, random_state=None):
+        # Evidence and posterior samples of the model with Nested_sampler, using
+        # the priors as the measure. The evidence is that of exp(-chi2/2), without
+        # the normalisation of the errors of the data, which cancels when models
+        # of the same data are compared (see get_ln_Bayes_factor). Without
+        # vectorize the candidates go through pool, and batch_size (by default
+        # the number of workers) live points are replaced per iteration.
+        if not self.prior_table.can_transform_unit_cube:
+            print("\nADVISE: Nested sampling needs every Variable to have a Prior with finite flat bounds or a Gaussian.\n")
+            raise AssertionError("the priors cannot be transformed from the unit cube!")
+        if batch_size is None:
+            batch_size = 1 if vectorize else self.pool.processes
+        def ln_likelihoods_of_unit_cube(unit_values):
+            return self._get_ln_data_likelihoods_of_unit_cube(unit_values, vectorize=vectorize)
+        rng = np.random.RandomState(random_state) if not isinstance(random_state, np.random.RandomState) else random_state
+        sampler = Nested_sampler(len(self.variables_list), ln_likelihoods_of_unit_cube, number_of_live_points=number_of_live_points,
+                                 batch_size=batch_size, enlargement=enlargement, random_state=rng)
+        start = time.time()
+        results = sampler.run(dlogz=dlogz, maximum_iterations=maximum_iterations)
+        end = time.time()
+        results['variable_names'] = self.variables_key_list
+        results['samples'] = self.prior_table.transform_unit_cube(results['unit_cube_samples'])
+        results['equally_weighted_samples'] = resample_equally_weighted(results['samples'], results['weights'], random_state=rng)
+        print("Nested sampling took {0:.1f} seconds and {1} likelihood evaluations: ln(evidence) = {2:.2f} +- {3:.2f}".format(
+                end - start, results['number_of_likelihood_evaluations'], results['ln_evidence'], results['ln_evidence_error']))
+        return results
+
+    @property
+    def chi2_emulator(self):
+        return self._chi2_emulator
+
+    def set_chi2_emulator(self, chi2_emulator):
+        # e.g. an emulator.Chi2_emulator.load'ed from a previous session
+        assert isinstance(chi2_emulator, Chi2_emulator), "chi2_emulator must be an instance of Chi2_emulator in emulator module!"
+        assert chi2_emulator.number_of_dimensions == len(self.variables_list), "chi2_emulator must have one dimension per Variable!"
+        self._chi2_emulator = chi2_emulator
+
+    def remove_chi2_emulator(self):
+        self._chi2_emulator = None
+
+    def _get_exact_chi2(self, array_of_values, vectorize=False):
+        # NaN where the priors are not finite
+        a = np.atleast_2d(array_of_values)
+        if vectorize:
+            ln_priors, ln_data_likelihoods = self.get_ln_priors_and_ln_data_likelihoods_vectorized(a)
+        else:
+            ln_priors, ln_data_likelihoods = self._get_ln_priors_and_ln_data_likelihoods_from_pool(a)
+        return np.where(np.isfinite(ln_priors), -2.0*ln_data_likelihoods, np.nan)
+
+    def _get_Fisher_covariance(self, values, relative_step=1.0e-4):
+        # inverse of the Fisher matrix of the data, from finite differences of the
+        # model curve, plus the curvature of the Gaussian priors and of the flat
+        # priors as if they were Gaussians of the same variance
+        d = len(values)
+        steps = relative_step*np.maximum(np.abs(values), 1.0)
+        vc_model = self._get_model_circular_velocity_km_s(np.concatenate((values + np.diag(steps), values - np.diag(steps))))
+        jacobian = np.broadcast_to(vc_model, (2*d, len(self.data)))
+        jacobian = (jacobian[:d] - jacobian[d:])/(2.0*steps[:, np.newaxis])
+        Fisher_matrix = (jacobian*self.data.inverse_variance) @ jacobian.T
+        table = self.prior_table
+        with np.errstate(divide='ignore', invalid='ignore'):
+            prior_curvature = np.where(table.is_Gaussian, 1.0/table.Gaussian_sigma**2, 12.0/(table.flat_max - table.flat_min)**2)
+        Fisher_matrix += np.diag(np.nan_to_num(prior_curvature, nan=0.0, posinf=0.0))
+        return np.linalg.pinv(Fisher_matrix)
+
+    def ln_likelihood_emulated_vectorized(self, array_of_values):
+        # as ln_likelihood_vectorized, with the chi2 of chi2_emulator; -inf out of its domain
+        a = np.atleast_2d(array_of_values)
+        ln_likelihoods = np.full(len(a), -np.infty)
+        lp = self.get_ln_priors_vectorized(a)
+        finite = np.isfinite(lp) & self._chi2_emulator.is_inside_domain(a)
+        if np.any(finite):
+            ln_likelihoods[finite] = lp[finite] - self._chi2_emulator.predict(a[finite])/2
+        return ln_likelihoods
+
+    def _sample_emulated_posterior(self, initial_positions, number_of_steps, random_state):
+        import emcee
+        sampler = emcee.EnsembleSampler(len(initial_positions), len(self.variables_list), self.ln_likelihood_emulated_vectorized, vectorize=True)
+        sampler.random_state = random_state.get_state()
+        sampler.run_mcmc(initial_positions, number_of_steps)
+        return sampler.get_chain(discard=number_of_steps//2, flat=True)
+
+    def fit_chi2_emulator(self, number_of_initial_points=None, maximum_number_of_points=None, points_per_iteration=None, tolerance=0.5,
+                          width=2.0, number_of_walkers=None, number_of_steps=200, vectorize=False, random_state=None):
+        # Adaptive design of chi2_emulator. The first design points are drawn from
+        # a Gaussian around the maximum likelihood, width times wider than the
+        # Fisher errors. Then, in every iteration, the posterior of the emulator
+        # is sampled and the exact chi2 (vectorized or through pool) is computed
+        # at points_per_iteration random samples, which are added to the design;
+        # so the design follows the posterior, and spurious minima of the
+        # emulator are visited and corrected. It stops when the largest
+        # error of the emulator at those points is below tolerance (in chi2, see
+        # Chi2_emulator.get_errors), or with maximum_number_of_points. An existing
+        # emulator is refined.
+        d = len(self.variables_list)
+        number_of_initial_points = 10*d if number_of_initial_points is None else number_of_initial_points
+        maximum_number_of_points = 60*d if maximum_number_of_points is None else maximum_number_of_points
+        points_per_iteration = 2*d if points_per_iteration is None else points_per_iteration
+        number_of_walkers = 4*d if number_of_walkers is None else number_of_walkers
+        rng = np.random.RandomState(random_state) if not isinstance(random_state, np.random.RandomState) else random_state
+        start = time.time()
+        number_of_exact_evaluations = 0
+        if self._chi2_emulator is None:
+            centre = self.get_maximum_likelihood_variables()
+            covariance = self._get_Fisher_covariance(centre)
+            points = np.concatenate(([centre], rng.multivariate_normal(centre, width**2*covariance, size=number_of_initial_points - 1)))
+            chi2 = self._get_exact_chi2(points, vectorize=vectorize)
+            number_of_exact_evaluations += len(points)
+            finite = np.isfinite(chi2)
+            # masses and scales, with positive priors, vary over orders of magnitude
+            self._chi2_emulator = Chi2_emulator(points[finite], chi2[finite], logarithmic=self.prior_table.flat_min >= 0.0)
+        emulator = self._chi2_emulator
+        maximum_errors = []
+        converged = False
+        while emulator.number_of_points < maximum_number_of_points:
+            ln_posteriors = self.get_ln_priors_vectorized(emulator.design_points) - emulator.chi2_values/2
+            initial_positions = emulator.design_points[np.argsort(-ln_posteriors)[:number_of_walkers]]
+            candidates = np.unique(self._sample_emulated_posterior(initial_positions, number_of_steps, rng), axis=0)
+            selected = candidates[rng.choice(len(candidates), min(points_per_iteration, maximum_number_of_points - emulator.number_of_points), replace=False)]
+            chi2 = self._get_exact_chi2(selected, vectorize=vectorize)
+            number_of_exact_evaluations += len(selected)
+            finite = np.isfinite(chi2)
+            maximum_errors.append(float(np.max(emulator.get_errors(selected[finite], chi2[finite]))) if np.any(finite) else np.infty)
+            emulator.add_points(selected[finite], chi2[finite])
+            if maximum_errors[-1] < tolerance:
+                converged = True
+                break
+        end = time.time()
+        print("Fitting the chi2 emulator took {0:.1f} seconds and {1} evaluations of the exact chi2".format(end - start, number_of_exact_evaluations))
+        return {
+                'converged':converged,
+                'number_of_points':emulator.number_of_points,
+                'number_of_exact_evaluations':number_of_exact_evaluations,
+                'maximum_errors':maximum_errors,
+                'seconds':end - start,
+        }
+
+    def compute_mcmc_with_emulator(self, number_of_walkers, number_of_steps, walkers_positions, validate_every=100, number_of_validation_points=None,
+                                   tolerance=0.5, vectorize=False, random_state=None):
+        # MCMC on the ln likelihood of chi2_emulator, with the current priors.
+        # Every validate_every steps the exact chi2 is computed (vectorized or
+        # through pool) at number_of_validation_points random walkers; where the
+        # emulator misses it by more than tolerance, those points are added to
+        # its design and the rest of the chain uses the refined emulator. The
+        # earlier steps sampled another target, so sampler is reset: it only holds
+        # the steps after the last refit (from report['last_refit_step'] on),
+        # none if the last validation refitted. Returns the report of the
+        # validations.
+        import emcee
+        if self._chi2_emulator is None:
+            print("\nADVISE: Run fit_chi2_emulator, or set_chi2_emulator, before compute_mcmc_with_emulator.\n")
+            raise AssertionError("the Analysis has no chi2 emulator!")
+        number_of_validation_points = min(number_of_walkers, 4) if number_of_validation_points is None else number_of_validation_points
+        rng = np.random.RandomState(random_state) if not isinstance(random_state, np.random.RandomState) else random_state
+        emulator = self._chi2_emulator
+        sampler = emcee.EnsembleSampler(number_of_walkers, len(self.variables_list), self.ln_likelihood_emulated_vectorized, vectorize=True)
+        sampler.random_state = rng.get_state()
+        positions = np.array(walkers_positions, dtype=float)
+        maximum_errors = []
+        number_of_refits = 0
+        last_refit_step = 0
+        start = time.time()
+        for first_step in range(0, number_of_steps, validate_every):
+            # the walkers restart from their positions, to use a refined emulator
+            number_of_block_steps = min(validate_every, number_of_steps - first_step)
+            positions = self._run_sampler(sampler, positions, number_of_block_steps).coords
+            validation_points = positions[rng.choice(number_of_walkers, number_of_validation_points, replace=False)]
+            chi2 = self._get_exact_chi2(validation_points, vectorize=vectorize)
+            finite = np.isfinite(chi2)
+            errors = emulator.get_errors(validation_points[finite], chi2[finite])
+            maximum_errors.append(float(np.max(errors)) if len(errors) else 0.0)
+            if maximum_errors[-1] > tolerance:
+                # the length scales are kept, so that the refit is cheap
+                emulator.add_points(validation_points[finite], chi2[finite], fit_length_scales=False)
+                number_of_refits += 1
+                sampler.reset()
+                last_refit_step = first_step + number_of_block_steps
+        end = time.time()
+        print("MCMC with the chi2 emulator took {0:.1f} seconds".format(end - start))
+        if last_refit_step == number_of_steps and number_of_refits > 0:
+            print("\nADVISE: The last validation refined the chi2 emulator, so sampler has no steps of the final emulator. Run compute_mcmc_with_emulator again from report['walkers_positions'].\n")
+        self._sampler = sampler
+        self._chain_storage = None
+        return {
+                'maximum_errors':maximum_errors,
+                'number_of_exact_evaluations':len(maximum_errors)*number_of_validation_points,
+                'number_of_refits':number_of_refits,
+                'last_refit_step':last_refit_step,
+                'walkers_positions':positions,
+                'number_of_points':emulator.number_of_points,
+                'seconds':end - start,
+        }
+
+    def reweight_results(self, results, old_prior_table, discard=0, thin=1, minimum_effective_sample_size=100,
+                         percentiles=(2.5, 16.0, 50.0, 84.0, 97.5)):
+        # Posterior under the current priors from a chain sampled under
+        # old_prior_table (e.g. prior_table kept before changing the priors and
+        # calling compile_prior_table), without evaluating any likelihood: every
+        # sample is weighted by new prior/old prior. results are those of
+        # load_pickle_results or load_results, or the file or directory they
+        # come from. The effective sample size is Kish's (sum w)^2/sum w^2, which
+        # ignores the autocorrelation of the chain; below
+        # minimum_effective_sample_size a few samples dominate and the
+        # reweighting is refused.
+        if isinstance(results, str):
+            results = Stored_results(results) if os.path.isdir(results) else load_pickle_results(results)
+        if not isinstance(old_prior_table, Prior_table):
+            old_prior_table = Prior_table(old_prior_table)
+        variable_names = results['variable_names']
+        assert variable_names is None or list(variable_names) == self.variables_key_list, "the results do not have the variables of the Analysis!"
+        number_of_dimensions = len(self.variables_list)
+        samples = np.asarray(results['chains'])[:, discard::thin].reshape((-1, number_of_dimensions))
+        ln_posteriors = np.asarray(results['lnlikelihoods'])[:, discard::thin].reshape(-1)
+        ln_old_priors = old_prior_table.ln_function(samples)
+        assert np.all(np.isfinite(ln_old_priors)), "the samples must be inside the support of old_prior_table!"
+        ln_new_priors = self.prior_table.ln_function(samples)
+        if np.any(self.prior_table.flat_min < old_prior_table.flat_min) or np.any(self.prior_table.flat_max > old_prior_table.flat_max):
+            print("\nADVISE: The new flat bounds are wider than the old ones, and the chain has no samples outside the old ones. Run compute_mcmc if the posterior reaches them.\n")
+        ln_weights = ln_new_priors - ln_old_priors
+        if not np.any(np.isfinite(ln_weights)):
+            # refused whatever minimum_effective_sample_size is: there are no weights
+            print("\nADVISE: No sample of the chain is inside the support of the new priors. Run compute_mcmc with them.\n")
+            raise AssertionError("no sample has a finite weight!")
+        weights = np.exp(ln_weights - np.max(ln_weights))
+        weights /= np.sum(weights)
+        effective_sample_size = 1.0/np.sum(weights**2)
+        if effective_sample_size < minimum_effective_sample_size:
+            print("\nADVISE: The effective sample size of the reweighted chain is {0:.1f} out of {1} samples. The new priors are too far from the old ones: run compute_mcmc with them.\n".format(
+                    effective_sample_size, len(samples)))
+            raise AssertionError("the effective sample size is below minimum_effective_sample_size!")
+        mean = np.sum(weights[:, np.newaxis]*samples, axis=0)
+        deviations = samples - mean
+        covariance = np.atleast_2d(np.einsum('i,ij,ik->jk', weights, deviations, deviations)/(1.0 - np.sum(weights**2)))
+        return {
+                'variable_names':self.variables_key_list,
+                'samples':samples,
+                'weights':weights,
+                'ln_posteriors':ln_posteriors - ln_old_priors + ln_new_priors,
+                'number_of_samples':len(samples),
+                'effective_sample_size':effective_sample_size,
+                'mean':mean,
+                'std':np.sqrt(np.diag(covariance)),
+                'covariance':covariance,
+                'percentiles':np.array(percentiles, dtype=float, ndmin=1),
+                'quantiles':weighted_percentiles(samples, weights, percentiles),
+        }
+
+    def compute_mcmc_and_burntin(self, number_of_walkers, number_of_steps_burntin, number_of_steps_mcmc, vectorize=False, storage=None, flush_every=100, number_of_starts=1, summary=None,
+                                 initial_variables=None):
+        if storage is not None and not isinstance(storage, Chain_storage):
+            storage = Chain_storage(storage, number_of_walkers, number_of_steps_mcmc, len(self.variables_list),
+                                    variable_names=self.variables_key_list, flush_every=flush_every)
+        if storage is not None and storage.steps_completed > 0:
+            # the burntin was already done before the stored run started
+            walkers_after_burntin = None
+        else:
+            walkers_after_burntin = self.compute_burntin(number_of_walkers,number_of_steps_burntin,vectorize=vectorize,number_of_starts=number_of_starts,
+                                                         initial_variables=initial_variables)
+        self.compute_mcmc(number_of_walkers,number_of_steps_mcmc,walkers_after_burntin,vectorize=vectorize,storage=storage,flush_every=flush_every,summary=summary)
     
 
 
+def integrated_autocorrelation_time(chain):
+    # chain of shape (steps, walkers, dimensions), as emcee's get_chain()
+    import emcee
+    return emcee.autocorr.integrated_time(chain, tol=0, quiet=True)
+
+def gelman_rubin(chains):
+    # potential scale reduction factor per dimension, chains of shape
+    # (walkers, steps, dimensions) with each walker treated as a chain
+    number_of_steps = chains.shape[1]
+    within_variance = np.mean(np.var(chains, axis=1, ddof=1), axis=0)
+    between_variance_over_steps = np.var(np.mean(chains, axis=1), axis=0, ddof=1)
+    pooled_variance = (number_of_steps-1)/number_of_steps*within_variance + between_variance_over_steps
+    return np.sqrt(pooled_variance/within_variance)
+
+class Nested_sampler:
+    # Nested sampling (Skilling 2006) in the unit cube of the prior transform.
+    # Every iteration the batch_size live points with the lowest likelihood
+    # become dead points, shrinking the prior volume X as the lowest order
+    # statistics of the live points (ln X -= 1/N, 1/(N-1), ...), and are
+    # replaced by points drawn uniformly from the ellipsoid that bounds the
+    # remaining live points, enlarged by enlargement in volume, until their
+    # likelihood is above the new threshold. The candidates of each round are
+    # evaluated in one call of ln_likelihoods_of_unit_cube, e.g. in a pool.
+    def __init__(self, number_of_dimensions, ln_likelihoods_of_unit_cube, number_of_live_points=400, batch_size=1,
+                 enlargement=1.25, random_state=None):
+        assert number_of_live_points - batch_size > number_of_dimensions, "number_of_live_points - batch_size must be larger than the number of dimensions!"
+        assert batch_size > 0, "batch_size must be positive!"
+        self._number_of_dimensions = number_of_dimensions
+        self._ln_likelihoods_of_unit_cube = ln_likelihoods_of_unit_cube
+        self._number_of_live_points = number_of_live_points
+        self._batch_size = batch_size
+        self._enlargement = enlargement
+        self._random_state = np.random.RandomState(random_state) if not isinstance(random_state, np.random.RandomState) else random_state
+        self._number_of_likelihood_evaluations = 0
+
+    @property
+    def number_of_likelihood_evaluations(self):
+        return self._number_of_likelihood_evaluations
+
+    def _evaluate(self, unit_values):
+        self._number_of_likelihood_evaluations += len(unit_values)
+        ln_likelihoods = np.asarray(self._ln_likelihoods_of_unit_cube(unit_values), dtype=float)
+        return np.where(np.isnan(ln_likelihoods), -np.infty, ln_likelihoods)
+
+    def _sample_bounding_ellipsoid(self, live_points, number_of_points):
+        import scipy.special
+        rng = self._random_state
+        d = self._number_of_dimensions
+        mean = np.mean(live_points, axis=0)
+        covariance = np.atleast_2d(np.cov(live_points, rowvar=False)) + 1.0e-12*np.eye(d)
+        deviations = live_points - mean
+        squared_distances = np.einsum('ij,jk,ik->i', deviations, np.linalg.inv(covariance), deviations)
+        covariance = covariance*np.max(squared_distances)*self._enlargement**(2.0/d)
+        sign, ln_determinant = np.linalg.slogdet(covariance)
+        ln_volume = 0.5*d*np.log(np.pi) - scipy.special.gammaln(0.5*d + 1.0) + 0.5*ln_determinant
+        if ln_volume >= 0.0:
+            # the ellipsoid is larger than the unit cube
+            return rng.rand(number_of_points, d)
+        directions = rng.randn(number_of_points, d)
+        directions *= (rng.rand(number_of_points)**(1.0/d)/np.linalg.norm(directions, axis=1))[:, np.newaxis]
+        return mean + directions @ np.linalg.cholesky(covariance).T
+
+    def _replace(self, live_points, threshold, number_of_points, efficiency):
+        # number_of_points new points with ln likelihood > threshold
+        new_points, new_ln_likelihoods = [], []
+        number_missing = number_of_points
+        number_evaluated = 0
+        while number_missing > 0:
+            number_of_candidates = int(min(100*number_of_points, max(number_missing, np.ceil(number_missing/max(efficiency, 1.0e-3)))))
+            candidates = self._sample_bounding_ellipsoid(live_points, number_of_candidates)
+            candidates = candidates[np.all((candidates > 0.0) & (candidates < 1.0), axis=1)]
+            if len(candidates) == 0:
+                continue
+            ln_likelihoods = self._evaluate(candidates)
+            number_evaluated += len(candidates)
+            accepted = np.flatnonzero(ln_likelihoods > threshold)[:number_missing]
+            new_points.append(candidates[accepted])
+            new_ln_likelihoods.append(ln_likelihoods[accepted])
+            number_missing -= len(accepted)
+        return np.concatenate(new_points), np.concatenate(new_ln_likelihoods), number_of_points/number_evaluated
+
+    def run(self, dlogz=0.1, maximum_iterations=None):
+        # stops when the live points could add less than dlogz to ln(evidence)
+        N = self._number_of_live_points
+        d = self._number_of_dimensions
+        live_points = self._random_state.rand(N, d)
+        live_ln_likelihoods = self._evaluate(live_points)
+        dead_points, dead_ln_likelihoods, dead_ln_weights = [], [], []
+        ln_X = 0.0
+        ln_evidence = -np.infty
+        efficiency = 1.0
+        iteration = 0
+        converged = False
+        while maximum_iterations is None or iteration < maximum_iterations:
+            order = np.argsort(live_ln_likelihoods)
+            worst = order[:self._batch_size]
+            for j, index in enumerate(worst):
+                new_ln_X = ln_X - 1.0/(N - j)
+                ln_weight = live_ln_likelihoods[index] + ln_X + np.log1p(-np.exp(new_ln_X - ln_X))
+                ln_evidence = np.logaddexp(ln_evidence, ln_weight)
+                dead_points.append(live_points[index])
+                dead_ln_likelihoods.append(live_ln_likelihoods[index])
+                dead_ln_weights.append(ln_weight)
+                ln_X = new_ln_X
+            kept = order[self._batch_size:]
+            new_points, new_ln_likelihoods, efficiency = self._replace(live_points[kept], live_ln_likelihoods[worst[-1]], len(worst), efficiency)
+            live_points = np.concatenate((live_points[kept], new_points))
+            live_ln_likelihoods = np.concatenate((live_ln_likelihoods[kept], new_ln_likelihoods))
+            iteration += 1
+            if np.logaddexp(ln_evidence, np.max(live_ln_likelihoods) + ln_X) - ln_evidence < dlogz:
+                converged = True
+                break
+        # the remaining live points share the last prior volume
+        live_ln_weights = live_ln_likelihoods + ln_X - np.log(N)
+        points = np.concatenate((np.array(dead_points), live_points))
+        ln_likelihoods = np.concatenate((dead_ln_likelihoods, live_ln_likelihoods))
+        ln_weights = np.concatenate((dead_ln_weights, live_ln_weights))
+        ln_evidence = np.logaddexp(ln_evidence, np.logaddexp.reduce(live_ln_weights))
+        weights = np.exp(ln_weights - ln_evidence)
+        weights /= np.sum(weights)
+        information = np.sum(weights*ln_likelihoods) - ln_evidence
+        return {
+                'ln_evidence':float(ln_evidence),
+                'ln_evidence_error':float(np.sqrt(max(information, 0.0)/N)),
+                'information':float(information),
+                'unit_cube_samples':points,
+                'ln_likelihoods':ln_likelihoods,
+                'weights':weights,
+                'number_of_iterations':iteration,
+                'number_of_likelihood_evaluations':self.number_of_likelihood_evaluations,
+                'converged':converged,
+        }
+
+def resample_equally_weighted(samples, weights, random_state=None):
+    # systematic resampling of weighted samples into equally weighted ones
+    random_state = np.random.RandomState(random_state) if not isinstance(random_state, np.random.RandomState) else random_state
+    number_of_samples = len(weights)
+    positions = (random_state.rand() + np.arange(number_of_samples))/number_of_samples
+    cumulative_weights = np.cumsum(weights)
+    cumulative_weights /= cumulative_weights[-1]
+    return samples[np.minimum(np.searchsorted(cumulative_weights, positions), number_of_samples - 1)]
+
+def weighted_percentiles(samples, weights, percentiles=(2.5, 16.0, 50.0, 84.0, 97.5)):
+    # (n_percentiles, n_dimensions), interpolating the weighted cumulative
+    # distribution at the middle of the weight of every sample
+    samples = np.atleast_2d(samples)
+    weights = np.asarray(weights, dtype=float)
+    order = np.argsort(samples, axis=0)
+    sorted_weights = weights[order]
+    cumulative_weights = np.cumsum(sorted_weights, axis=0) - 0.5*sorted_weights
+    cumulative_weights /= np.sum(weights)
+    fractions = np.array(percentiles, dtype=float, ndmin=1)/100.0
+    return np.stack([np.interp(fractions, cumulative_weights[:, j], samples[order[:, j], j]) for j in range(samples.shape[1])], axis=1)
+
+def get_ln_Bayes_factor(nested_sampling_results_1, nested_sampling_results_2):
+    # ln(Z_1/Z_2) and its error, from two results of Analysis.compute_nested_sampling
+    ln_Bayes_factor = nested_sampling_results_1['ln_evidence'] - nested_sampling_results_2['ln_evidence']
+    return ln_Bayes_factor, float(np.hypot(nested_sampling_results_1['ln_evidence_error'], nested_sampling_results_2['ln_evidence_error']))
+
+def _maximise_ln_likelihood_in_worker(analysis, initial_values):
+    result = analysis.maximise_ln_likelihood(initial_values)
+    return result["x"], -result["fun"], bool(result["success"])
+
+def _ln_likelihoods_row_by_row_in_worker(analysis, array_of_values):
+    return analysis._get_ln_likelihoods_row_by_row(array_of_values)
+
+def _ln_priors_and_ln_data_likelihoods_in_worker(analysis, array_of_values):
+    return analysis.get_ln_priors_and_ln_data_likelihoods_vectorized(array_of_values)
+
 #%%
 if __name__ == '__main__':
     pass
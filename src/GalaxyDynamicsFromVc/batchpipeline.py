@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import os
+import copy
+import json
+import time
+import multiprocessing
+import numpy as np
+
+from GalaxyDynamicsFromVc.analysisstatistics import Analysis
+from GalaxyDynamicsFromVc.datahandling import Rotation_curve_data, Rotation_curve_loader
+from GalaxyDynamicsFromVc.parallelcomputing import get_number_of_available_cores
+
+#%%
+
+# Every worker process keeps the Batch_fit set by the pool initializer, so that
+# (with the 'fork' start method) galaxy_model_creator does not need to be
+# picklable; tasks only carry the name and the data of a galaxy.
+_worker_batch_fit = None
+
+def _initialise_worker(batch_fit):
+    global _worker_batch_fit
+    _worker_batch_fit = batch_fit
+
+def _fit_galaxy_in_worker(task):
+    name, data, output_directory = task
+    return _worker_batch_fit.fit_and_save(name, data, output_directory)
+
+class Batch_fit:
+    # Fits many galaxies with the same model template: every galaxy gets its own
+    # Analysis, built from copies of list_of_variables and R_sun, and its own
+    # data, a Rotation_curve_data or a loader. Each fit finds the maximum
+    # likelihood and, if number_of_walkers > 0, runs a burntin starting around
+    # it and an MCMC stored in a Chain_storage.
+    result_file_name = 'fit.json'
+    chains_directory_name = 'chains'
+
+    def __init__(self, list_of_variables, galaxy_model_creator, R_sun=None, parameter_maps=None,
+                 number_of_walkers=0, number_of_steps_burntin=0, number_of_steps_mcmc=0, number_of_starts=1):
+        if number_of_walkers > 0:
+            assert number_of_steps_mcmc > 0, "number_of_steps_mcmc must be positive to run the MCMC!"
+        self._list_of_variables = list_of_variables
+        self._galaxy_model_creator = galaxy_model_creator
+        self._R_sun = R_sun
+        self._parameter_maps = parameter_maps
+        self._number_of_walkers = number_of_walkers
+        self._number_of_steps_burntin = number_of_steps_burntin
+        self._number_of_steps_mcmc = number_of_steps_mcmc
+        self._number_of_starts = number_of_starts
+
+    def create_analysis(self, data):
+        # the serial executor: the galaxies, not the walkers, are spread over cores
+        list_of_variables, R_sun = copy.deepcopy((self._list_of_variables, self._R_sun))
+        return Analysis(list_of_variables, self._galaxy_model_creator, R_sun=R_sun,
+                        parameter_maps=self._parameter_maps, executor='serial', data=data)
+
+    def fit(self, data, chains_directory=None):
+        start = time.time()
+        analysis = self.create_analysis(data)
+        if self._number_of_starts > 1:
+            maximum_likelihood_variables = analysis.get_maximum_likelihood_variables_multistart(self._number_of_starts, random_state=0, use_pool=False)['x']
+        else:
+            maximum_likelihood_variables = analysis.get_maximum_likelihood_variables()
+        result = {
+                'number_of_data_points':len(analysis.data),
+                'variable_names':analysis.variables_key_list,
+                'maximum_likelihood_variables':maximum_likelihood_variables.tolist(),
+                'maximum_ln_likelihood':float(analysis.ln_likelihood(maximum_likelihood_variables)),
+        }
+        if self._number_of_walkers > 0:
+            analysis.compute_mcmc_and_burntin(self._number_of_walkers, self._number_of_steps_burntin, self._number_of_steps_mcmc,
+                                              vectorize=True, storage=chains_directory, initial_variables=maximum_likelihood_variables)
+            if chains_directory is None:
+                samples = analysis.sampler.get_chain(flat=True)
+                acceptance_fractions = analysis.sampler.acceptance_fraction
+            else:
+                samples = analysis.chain_storage.chains.reshape((-1, len(analysis.variables_list)))
+                acceptance_fractions = analysis.chain_storage.acceptance_fractions
+            result.update({
+                    'mean':np.mean(samples, axis=0).tolist(),
+                    'std':np.std(samples, axis=0).tolist(),
+                    'median':np.median(samples, axis=0).tolist(),
+                    'mean_acceptance_fraction':float(np.mean(acceptance_fractions)),
+            })
+        result['seconds'] = time.time() - start
+        return result
+
+    def fit_and_save(self, name, data, output_directory):
+        # fit.json is written (atomically) only when the fit is complete, so that
+        # an interrupted batch redoes the missing galaxies; the chains resume
+        directory = os.path.join(output_directory, name)
+        os.makedirs(directory, exist_ok=True)
+        try:
+            chains_directory = os.path.join(directory, self.chains_directory_name) if self._number_of_walkers > 0 else None
+            result = self.fit(data, chains_directory=chains_directory)
+        except Exception as error:
+            return name, {'error':repr(error)}
+        result['name'] = name
+        temporary_file = os.path.join(directory, self.result_file_name + '.tmp')
+        with open(temporary_file, 'w') as f:
+            json.dump(result, f, indent=1)
+        os.replace(temporary_file, os.path.join(directory, self.result_file_name))
+        return name, result
+
+    def run(self, galaxies, output_directory, processes=None):
+        # galaxies is a dict {name: Rotation_curve_data or Rotation_curve_loader};
+        # loaders are read by the workers. Galaxies already fitted in
+        # output_directory are skipped. The others are sent one at a time to the
+        # free workers, largest datasets first, and their results are saved as
+        # soon as each of them finishes. Returns {name: result}, where failed fits
+        # only have an 'error'.
+        for name, data in galaxies.items():
+            assert isinstance(data, (Rotation_curve_data, Rotation_curve_loader)), "the data of {} must be a Rotation_curve_data or a Rotation_curve_loader!".format(name)
+            assert name and os.path.basename(name) == name and name not in ('.', '..'), "{} is not a valid galaxy name!".format(name)
+        os.makedirs(output_directory, exist_ok=True)
+        results = load_batch_results(output_directory)
+        results = {name: results[name] for name in results if name in galaxies}
+        tasks = [(name, data, output_directory) for name, data in galaxies.items() if name not in results]
+        tasks.sort(key=lambda task: _get_size(task[1]), reverse=True)
+        if processes is None:
+            processes = get_number_of_available_cores()
+        processes = max(1, min(processes, len(tasks)))
+        if processes == 1:
+            for task in tasks:
+                name, result = self.fit_and_save(*task)
+                results[name] = result
+        else:
+            with multiprocessing.Pool(processes, initializer=_initialise_worker, initargs=(self,)) as pool:
+                for name, result in pool.imap_unordered(_fit_galaxy_in_worker, tasks, chunksize=1):
+                    results[name] = result
+        return results
+
+def _get_size(data):
+    # number of data points, counted in the file of loaders not yet read
+    if isinstance(data, Rotation_curve_loader):
+        return data.get_number_of_points()
+    return len(data)
+
+def load_batch_results(output_directory):
+    # {name: result} of the galaxies with a complete fit in output_directory
+    results = {}
+    if not os.path.isdir(output_directory):
+        return results
+    for name in sorted(os.listdir(output_directory)):
+        result_file = os.path.join(output_directory, name, Batch_fit.result_file_name)
+        if os.path.isfile(result_file):
+            with open(result_file, 'r') as f:
+                results[name] = json.load(f)
+    return results
+
+#%%
+if __name__ == '__main__':
+    pass
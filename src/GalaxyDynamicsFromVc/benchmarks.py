@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+#
+# Performance benchmarks of GalaxyDynamicsFromVc. Run them from the src folder:
+#    $ python -m GalaxyDynamicsFromVc.benchmarks --output benchmarks.json
+# and compare two runs to catch regressions:
+#    $ python -m GalaxyDynamicsFromVc.benchmarks --output new.json --compare old.json
+
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+import argparse
+import contextlib
+import subprocess
+import numpy as np
+
+from GalaxyDynamicsFromVc import galaxymodel
+from GalaxyDynamicsFromVc import analysisstatistics
+from GalaxyDynamicsFromVc.parallelcomputing import get_number_of_available_cores
+
+#%%
+
+def time_function(function, repeat=5, minimum_time=0.2):
+    # best time per call over repeat runs, each run lasting at least minimum_time
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    number = max(1, int(number*minimum_time/0.2))
+    return min(timer.repeat(repeat=repeat, number=number))/number
+
+def _result(benchmark, parameters, seconds_per_call):
+    return {
+            'benchmark':benchmark,
+            'parameters':parameters,
+            'seconds_per_call':seconds_per_call,
+            'calls_per_second':1.0/seconds_per_call,
+    }
+
+def _potentials():
+    return {
+            'NFW':galaxymodel.NFW(),
+            'Miyamoto_Nagai_disk':galaxymodel.Miyamoto_Nagai_disk(),
+            'Plummer':galaxymodel.Plummer(),
+    }
+
+def benchmark_potentials(sizes_of_radius_arrays=(10, 100, 1000, 10000, 100000), repeat=5, minimum_time=0.2):
+    results = []
+    for name, potential in _potentials().items():
+        for size in sizes_of_radius_arrays:
+            R_kpc = np.linspace(0.1, 50.0, size)
+            seconds = time_function(lambda: potential.circular_velocity_km_s(R_kpc), repeat, minimum_time)
+            results.append(_result('circular_velocity_km_s', {'potential':name, 'number_of_radii':size}, seconds))
+    return results
+
+def benchmark_galactic_model(numbers_of_components=range(1, 11), number_of_radii=1000, repeat=5, minimum_time=0.2):
+    results = []
+    R_kpc = np.linspace(0.1, 50.0, number_of_radii)
+    for number_of_components in numbers_of_components:
+        potentials = list(_potentials().values())
+        components = [potentials[k % len(potentials)] for k in range(number_of_components)]
+        GM = galaxymodel.Galactic_model(*components)
+        seconds = time_function(lambda: GM.circular_velocity_km_s(R_kpc), repeat, minimum_time)
+        results.append(_result('Galactic_model.circular_velocity_km_s', {'number_of_components':number_of_components, 'number_of_radii':number_of_radii}, seconds))
+    return results
+
+def _list_of_variables():
+    Variable = analysisstatistics.Variable
+    Prior = analysisstatistics.Prior
+    return [
+        Variable('Mvir_1e11Msun', prior_function=Prior(flat_min=0.0,flat_max=1.0e3).ln_function, value=7.05),
+        Variable('cvir', prior_function=Prior(flat_min=1.0e-3,flat_max=100.0).ln_function, value=11.5),
+        Variable('Mthin_1e10Msun', prior_function=Prior(flat_min=0.1,flat_max=1.0e2,Gaussian_mean=3.944,Gaussian_sigma=0.59).ln_function, value=3.9),
+        Variable('Rd_thin_kpc', prior_function=Prior(flat_min=0.01,flat_max=10.0,Gaussian_mean=5.3,Gaussian_sigma=0.53).ln_function, value=5.4),
+        Variable('zd_thin_kpc', prior_function=Prior(flat_min=0.01,flat_max=1.5,Gaussian_mean=0.25,Gaussian_sigma=0.025).ln_function, value=0.25),
+        Variable('Mbulge_1e10Msun', prior_function=Prior(flat_min=0.01,flat_max=1.0e2,Gaussian_mean=1.07,Gaussian_sigma=0.16).ln_function, value=1.1),
+        Variable('rd_bulge_kpc', prior_function=Prior(flat_min=0.01,flat_max=1.5,Gaussian_mean=0.3,Gaussian_sigma=0.03).ln_function, value=0.3),
+    ]
+
+def _galaxy_model_creator(d):
+    halo = galaxymodel.NFW(Mvir_in_1e11Msun=d['Mvir_1e11Msun'].value, cvir=d['cvir'].value)
+    disk = galaxymodel.Miyamoto_Nagai_disk(total_mass_Msun=d['Mthin_1e10Msun'].value*1.0e10,
+                                           a_kpc=d['Rd_thin_kpc'].value, b_kpc=d['zd_thin_kpc'].value)
+    bulge = galaxymodel.Plummer(total_mass_Msun=d['Mbulge_1e10Msun'].value*1.0e10, b_kpc=d['rd_bulge_kpc'].value)
+    return galaxymodel.Galactic_model(halo, disk, bulge)
+
+def _parameter_maps():
+    Parameter_map = analysisstatistics.Parameter_map
+    return [
+        Parameter_map(galaxymodel.NFW, Mvir_in_1e11Msun='Mvir_1e11Msun', cvir='cvir'),
+        Parameter_map(galaxymodel.Miyamoto_Nagai_disk, total_mass_Msun=('Mthin_1e10Msun',1.0e10), a_kpc='Rd_thin_kpc', b_kpc='zd_thin_kpc'),
+        Parameter_map(galaxymodel.Plummer, total_mass_Msun=('Mbulge_1e10Msun',1.0e10), b_kpc='rd_bulge_kpc'),
+    ]
+
+def make_benchmark_analysis(parameter_map=False):
+    return analysisstatistics.Analysis(_list_of_variables(), _galaxy_model_creator,
+                                       parameter_maps=_parameter_maps() if parameter_map else None)
+
+def _walkers_positions(analysis, number_of_walkers, seed=0):
+    values = np.array([var.value for var in analysis.variables_list])
+    return values + 1.0e-3*np.random.RandomState(seed).randn(number_of_walkers, len(values))
+
+def benchmark_likelihood(numbers_of_walkers=(1, 32, 256), repeat=5, minimum_time=0.2):
+    results = []
+    for parameter_map in (False, True):
+        analysis = make_benchmark_analysis(parameter_map=parameter_map)
+        values = _walkers_positions(analysis, 1)[0]
+        seconds = time_function(lambda: analysis.ln_likelihood(values), repeat, minimum_time)
+        results.append(_result('Analysis.ln_likelihood', {'parameter_map':parameter_map}, seconds))
+        for number_of_walkers in numbers_of_walkers:
+            positions = _walkers_positions(analysis, number_of_walkers)
+            seconds = time_function(lambda: analysis.ln_likelihood_vectorized(positions), repeat, minimum_time)
+            result = _result('Analysis.ln_likelihood_vectorized', {'parameter_map':parameter_map, 'number_of_walkers':number_of_walkers}, seconds)
+            result['likelihoods_per_second'] = number_of_walkers/seconds
+            results.append(result)
+    analysis = make_benchmark_analysis(parameter_map=True)
+    backend = analysis.compile_fused_kernel()
+    for number_of_walkers in numbers_of_walkers:
+        positions = _walkers_positions(analysis, number_of_walkers)
+        seconds = time_function(lambda: analysis.ln_likelihood_vectorized(positions), repeat, minimum_time)
+        result = _result('Analysis.ln_likelihood_vectorized', {'parameter_map':True, 'fused_kernel':backend, 'number_of_walkers':number_of_walkers}, seconds)
+        result['likelihoods_per_second'] = number_of_walkers/seconds
+        results.append(result)
+    return results
+
+def benchmark_mcmc(numbers_of_processes=None, number_of_walkers=32, number_of_steps=200):
+    if numbers_of_processes is None:
+        numbers_of_processes = sorted({1, get_number_of_available_cores()})
+    results = []
+    analysis = make_benchmark_analysis()
+    positions = _walkers_positions(analysis, number_of_walkers)
+    # 'pool' is the process pool; 'thread' and 'cluster' the other executors
+    configurations = [('vectorize', None)] + [(mode, processes) for mode in ('pool', 'thread', 'cluster') for processes in numbers_of_processes]
+    for mode, processes in configurations:
+        if mode != 'vectorize':
+            analysis.start_pool(processes=processes, executor='process' if mode == 'pool' else mode)
+        start = time.perf_counter()
+        # the prints of compute_mcmc would corrupt the JSON written to stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            analysis.compute_mcmc(number_of_walkers, number_of_steps, positions, vectorize=(mode == 'vectorize'))
+        seconds = time.perf_counter() - start
+        analysis.close_pool()
+        result = _result('Analysis.compute_mcmc', {'mode':mode, 'processes':processes, 'number_of_walkers':number_of_walkers,
+                                                   'number_of_steps':number_of_steps}, seconds)
+        result['steps_per_second'] = number_of_steps/seconds
+        results.append(result)
+    return results
+
+# seconds allowed to import each module in a fresh interpreter, and the
+# plotting and sampling dependencies that none of them may load on import
+import_time_budget_seconds = {
+        'GalaxyDynamicsFromVc':0.1,
+        'GalaxyDynamicsFromVc.galaxymodel':0.5,
+        'GalaxyDynamicsFromVc.analysisstatistics':0.8,
+}
+deferred_dependencies = ('scipy', 'emcee', 'matplotlib', 'corner')
+
+_import_code = '''import json, sys, time
+start = time.perf_counter()
+import {0}
+seconds = time.perf_counter() - start
+print(json.dumps([seconds, [name for name in {1} if name in sys.modules]]))'''
+
+def measure_import(module, repeat=5):
+    # best time of importing module in a fresh interpreter, and the deferred
+    # dependencies that it loaded
+    environment = dict(os.environ)
+    src_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment['PYTHONPATH'] = os.pathsep.join([src_directory] + [path for path in [environment.get('PYTHONPATH')] if path])
+    times = []
+    for k in range(repeat):
+        output = subprocess.run([sys.executable, '-c', _import_code.format(module, list(deferred_dependencies))],
+                                env=environment, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        seconds, loaded_dependencies = json.loads(output.splitlines()[-1])
+        times.append(seconds)
+    return min(times), loaded_dependencies
+
+def benchmark_import(modules=tuple(import_time_budget_seconds), repeat=5):
+    results = []
+    for module in modules:
+        seconds, loaded_dependencies = measure_import(module, repeat=repeat)
+        result = _result('import', {'module':module}, seconds)
+        result['budget_seconds'] = import_time_budget_seconds.get(module)
+        result['loaded_deferred_dependencies'] = loaded_dependencies
+        results.append(result)
+    return results
+
+def check_import_budget(results):
+    # list of the import benchmarks over their budget or loading deferred dependencies
+    return [result for result in results if result['benchmark'] == 'import' and
+            (result['loaded_deferred_dependencies'] or
+             (result['budget_seconds'] is not None and result['seconds_per_call'] > result['budget_seconds']))]
+
+def get_metadata():
+    return {
+            'python':platform.python_version(),
+            'numpy':np.__version__,
+            'platform':platform.platform(),
+            'processor':platform.processor(),
+            'available_cores':get_number_of_available_cores(),
+            'time':time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+def run_benchmarks(quick=False):
+    if quick:
+        settings = {'repeat':3, 'minimum_time':0.02}
+        results = (benchmark_import(repeat=3)
+                   + benchmark_potentials(sizes_of_radius_arrays=(10, 1000), **settings)
+                   + benchmark_galactic_model(numbers_of_components=(1, 5, 10), **settings)
+                   + benchmark_likelihood(numbers_of_walkers=(32,), **settings)
+                   + benchmark_mcmc(number_of_steps=20))
+    else:
+        results = benchmark_import() + benchmark_potentials() + benchmark_galactic_model() + benchmark_likelihood() + benchmark_mcmc()
+    return {'metadata':get_metadata(), 'results':results}
+
+def _key(result):
+    return (result['benchmark'], json.dumps(result['parameters'], sort_keys=True))
+
+def compare_benchmarks(reference, new, tolerance=0.2):
+    # list of the benchmarks of new that are slower than reference by more than tolerance
+    reference_times = {_key(result):result['seconds_per_call'] for result in reference['results']}
+    regressions = []
+    for result in new['results']:
+        key = _key(result)
+        if key in reference_times and result['seconds_per_call'] > (1.0+tolerance)*reference_times[key]:
+            regressions.append({
+                    'benchmark':result['benchmark'],
+                    'parameters':result['parameters'],
+                    'reference_seconds_per_call':reference_times[key],
+                    'seconds_per_call':result['seconds_per_call'],
+                    'slowdown':result['seconds_per_call']/reference_times[key],
+            })
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of GalaxyDynamicsFromVc")
+    parser.add_argument('--output', default='', help="JSON file where the results are written")
+    parser.add_argument('--compare', default='', help="JSON file of a previous run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative slowdown before reporting a regression")
+    parser.add_argument('--quick', action='store_true', help="run a reduced set of benchmarks")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(quick=args.quick)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    else:
+        json.dump(results, sys.stdout, indent=1)
+        print()
+    # the diagnostics go to stderr, so that stdout stays valid JSON
+    status = 0
+    for result in check_import_budget(results['results']):
+        print("IMPORT BUDGET: importing {} took {:.3f} s (budget {} s) and loaded {}".format(result['parameters']['module'], result['seconds_per_call'],
+                                                                                        result['budget_seconds'], result['loaded_deferred_dependencies']), file=sys.stderr)
+        status = 1
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            reference = json.load(f)
+        regressions = compare_benchmarks(reference, results, tolerance=args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: {benchmark} {parameters} is {slowdown:.2f} times slower".format(**regression), file=sys.stderr)
+        if regressions:
+            status = 1
+    return status
+
+#%%
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,90 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
 import pickle
+import hashlib
+import numpy as np
 
 #%%
 
+class Rotation_curve_data:
+    def __init__(self, R_kpc, vc_km_s, sigma_minus_km_s, sigma_plus_km_s, syst_km_s):
+        self._R_kpc = self._as_read_only_array(R_kpc)
+        self._vc_km_s = self._as_read_only_array(vc_km_s)
+        self._sigma_minus_km_s = self._as_read_only_array(sigma_minus_km_s)
+        self._sigma_plus_km_s = self._as_read_only_array(sigma_plus_km_s)
+        self._syst_km_s = self._as_read_only_array(syst_km_s)
+        for column in (self.vc_km_s, self.sigma_minus_km_s, self.sigma_plus_km_s, self.syst_km_s):
+            assert column.shape == self.R_kpc.shape, "all the columns of the rotation curve must have the same length!"
+        self._inverse_variance = self._as_read_only_array(1.0/(
+                ((self.sigma_minus_km_s+self.sigma_plus_km_s)/2)**2 # statistical error in the data
+                + self.syst_km_s**2 # systematic error in the data
+                ))
+
+    @staticmethod
+    def _as_read_only_array(values):
+        array = np.array(values, dtype=float, order='C', ndmin=1)
+        array.setflags(write=False)
+        return array
+
+    @classmethod
+    def from_data_lists(cls, data_lists):
+        return cls(*np.array(data_lists, dtype=float).T)
+
+    @classmethod
+    def from_table(cls, table):
+        # rows of (R, vc, sigma), (R, vc, sigma-, sigma+) or (R, vc, sigma-, sigma+, syst)
+        table = np.array(table, dtype=float, ndmin=2)
+        number_of_columns = table.shape[1]
+        assert number_of_columns in (3, 4, 5), "a rotation curve table must have 3, 4 or 5 columns!"
+        if number_of_columns == 3:
+            table = table[:, [0, 1, 2, 2]]
+        if table.shape[1] == 4:
+            table = np.column_stack((table, np.zeros(len(table))))
+        return cls(*table.T)
+
+    @property
+    def R_kpc(self):
+        return self._R_kpc
+
+    @property
+    def vc_km_s(self):
+        return self._vc_km_s
+
+    @property
+    def sigma_minus_km_s(self):
+        return self._sigma_minus_km_s
+
+    @property
+    def sigma_plus_km_s(self):
+        return self._sigma_plus_km_s
+
+    @property
+    def syst_km_s(self):
+        return self._syst_km_s
+
+    @property
+    def inverse_variance(self):
+        return self._inverse_variance
+
+    def __len__(self):
+        return len(self.R_kpc)
+
+    def to_data_lists(self):
+        return np.column_stack((self.R_kpc, self.vc_km_s, self.sigma_minus_km_s, self.sigma_plus_km_s, self.syst_km_s)).tolist()
+
+    def save_npz(self, file_name):
+        np.savez(file_name, R_kpc=self.R_kpc, vc_km_s=self.vc_km_s, sigma_minus_km_s=self.sigma_minus_km_s,
+                 sigma_plus_km_s=self.sigma_plus_km_s, syst_km_s=self.syst_km_s)
+
+    @classmethod
+    def load_npz(cls, file_name):
+        with np.load(file_name) as f:
+            return cls(f['R_kpc'], f['vc_km_s'], f['sigma_minus_km_s'], f['sigma_plus_km_s'], f['syst_km_s'])
+
+_rotation_curve_data_cache = {}
+
 def read_data_from_1810_09466():
     # elements in datalist: 
     #    element[0] = R (kpc)
@@ -48,12 +128,431 @@ def read_data_from_1810_09466():
 
     return data_lists
 
+def _load_1810_09466():
+    # same as Rotation_curve_data.from_data_lists(read_data_from_1810_09466()),
+    # parsing the files with numpy
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    table = np.loadtxt(dir_path+'/1810_09466.dat', comments='#', ndmin=2)
+    relative_syst = np.loadtxt(dir_path+'/1810_09466-sys-data.dat', comments='#', ndmin=2)[:, 1]
+    return Rotation_curve_data(table[:,0], table[:,1], table[:,2], table[:,3], relative_syst*table[:,1])
+
+def get_data_from_1810_09466():
+    # parsed only once per process, later calls share the same read-only arrays
+    if '1810_09466' not in _rotation_curve_data_cache:
+        _rotation_curve_data_cache['1810_09466'] = _load_1810_09466()
+    return _rotation_curve_data_cache['1810_09466']
+
+#%%
+
+# Loaders of rotation curve tables: every file format has a function
+# (file_name, **options) -> Rotation_curve_data.
+
+def _load_delimited_table(file_name, delimiter=None, usecols=None, skiprows=0):
+    # numpy's C parser; lines starting with '#' are comments
+    return Rotation_curve_data.from_table(np.loadtxt(file_name, delimiter=delimiter, comments='#', usecols=usecols, skiprows=skiprows, ndmin=2))
+
+def _load_csv(file_name, usecols=None, skiprows=0):
+    return _load_delimited_table(file_name, delimiter=',', usecols=usecols, skiprows=skiprows)
+
+def _load_whitespace(file_name, usecols=None, skiprows=0):
+    return _load_delimited_table(file_name, usecols=usecols, skiprows=skiprows)
+
+def _load_npy(file_name, usecols=None):
+    table = np.load(file_name)
+    return Rotation_curve_data.from_table(table if usecols is None else table[:, usecols])
+
+def _load_npz(file_name):
+    return Rotation_curve_data.load_npz(file_name)
+
+loaders = {
+        'csv':_load_csv,
+        'whitespace':_load_whitespace,
+        'npy':_load_npy,
+        'npz':_load_npz,
+}
+
+def _count_table_rows(file_name, skiprows=0, **options):
+    # rows of a text table, without parsing them
+    with open(file_name, 'r') as f:
+        lines = f.readlines()[skiprows:]
+    return sum(1 for line in lines if line.strip() and not line.lstrip().startswith('#'))
+
+def _count_npy_rows(file_name, **options):
+    return len(np.load(file_name, mmap_mode='r'))
+
+def _count_npz_rows(file_name, **options):
+    with np.load(file_name) as f:
+        return len(f['R_kpc'])
+
+# number of data points of a file, cheaper than loading it
+row_counters = {
+        'csv':_count_table_rows,
+        'whitespace':_count_table_rows,
+        'npy':_count_npy_rows,
+        'npz':_count_npz_rows,
+}
+
+loader_extensions = {
+        '.csv':'csv',
+        '.dat':'whitespace',
+        '.txt':'whitespace',
+        '.npy':'npy',
+        '.npz':'npz',
+}
+
+# formats that are already binary and are not cached
+_binary_formats = ('npy', 'npz')
+
+def register_loader(file_format, function, extensions=(), row_counter=None):
+    # function(file_name, **options) must return a Rotation_curve_data;
+    # row_counter(file_name, **options), if given, its number of data points
+    assert callable(function), "the loader must be a function!"
+    loaders[file_format] = function
+    if row_counter is not None:
+        row_counters[file_format] = row_counter
+    else:
+        row_counters.pop(file_format, None)
+    for extension in extensions:
+        loader_extensions[extension.lower()] = file_format
+
+def get_file_format(file_name):
+    extension = os.path.splitext(file_name)[1].lower()
+    assert extension in loader_extensions, "unknown extension {}: give the file_format of {}".format(extension, file_name)
+    return loader_extensions[extension]
+
+def get_file_hash(file_name, block_size=2**20):
+    file_hash = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+default_cache_directory = os.path.join(os.path.expanduser('~'), '.cache', 'GalaxyDynamicsFromVc')
+
+class Rotation_curve_loader:
+    # Reads a rotation curve table the first time its data is needed. Text
+    # tables are also saved as .npz in cache_directory, under a key made of the
+    # hash of the file contents, the format and the options, so that later loads
+    # of the same file skip the parsing. cache_directory=None disables the cache.
+    def __init__(self, file_name, file_format=None, cache_directory=default_cache_directory, **options):
+        if file_format is None:
+            file_format = get_file_format(file_name)
+        assert file_format in loaders, "file_format must be one of {}".format(list(loaders))
+        self._file_name = file_name
+        self._file_format = file_format
+        self._cache_directory = cache_directory
+        self._options = options
+        self._data = None
+
+    @property
+    def file_name(self):
+        return self._file_name
+
+    @property
+    def file_format(self):
+        return self._file_format
+
+    @property
+    def is_loaded(self):
+        return self._data is not None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self._load()
+        return self._data
+
+    def get_data(self):
+        return self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def get_number_of_points(self):
+        # without loading the data, if its format has a row counter
+        if self._data is None and self.file_format in row_counters:
+            return row_counters[self.file_format](self.file_name, **self._options)
+        return len(self)
+
+    def _get_cache_file(self):
+        key = hashlib.sha1(json.dumps([get_file_hash(self.file_name), self.file_format, self._options], sort_keys=True, default=str).encode()).hexdigest()
+        return os.path.join(self._cache_directory, key + '.npz')
+
+    def _load(self):
+        if self._cache_directory is None or self.file_format in _binary_formats:
+            return loaders[self.file_format](self.file_name, **self._options)
+        cache_file = self._get_cache_file()
+        if os.path.isfile(cache_file):
+            try:
+                return Rotation_curve_data.load_npz(cache_file)
+            except Exception:
+                pass # unreadable cache, parsed again below
+        data = loaders[self.file_format](self.file_name, **self._options)
+        os.makedirs(self._cache_directory, exist_ok=True)
+        temporary_file = cache_file + '.{}.tmp.npz'.format(os.getpid())
+        data.save_npz(temporary_file)
+        os.replace(temporary_file, cache_file)
+        return data
+
+    def __getstate__(self):
+        # pickled loaders (e.g. sent to worker processes) load in their process
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+def get_rotation_curve_data(data):
+    # Rotation_curve_data from a Rotation_curve_data, a loader (any object with
+    # get_data()) or the name of a file with a registered format
+    if isinstance(data, str):
+        data = Rotation_curve_loader(data)
+    if not isinstance(data, Rotation_curve_data) and hasattr(data, 'get_data'):
+        data = data.get_data()
+    assert isinstance(data, Rotation_curve_data), "data must be a Rotation_curve_data, a loader or a file name!"
+    return data
+
+class Chain_storage:
+    # Chains and ln likelihoods are written step by step into memory-mapped .npy
+    # files of shape (walkers, steps, dimensions) and (walkers, steps). The JSON
+    # manifest only counts the steps that have been flushed to disk, so after a
+    # crash the run can be resumed from the last flushed step.
+    manifest_file_name = 'manifest.json'
+    chains_file_name = 'chains.npy'
+    lnlikelihoods_file_name = 'lnlikelihoods.npy'
+
+    def __init__(self, directory, number_of_walkers=None, number_of_steps=None, number_of_dimensions=None,
+                 variable_names=None, flush_every=100):
+        assert isinstance(flush_every, int) and flush_every > 0, "flush_every must be a positive int!"
+        self._directory = directory
+        self._flush_every = flush_every
+        self._pending_steps = 0
+        self._pending_accepted = 0
+        if os.path.exists(self._get_path(self.manifest_file_name)):
+            self._open_existing(number_of_walkers, number_of_steps, number_of_dimensions, variable_names)
+        else:
+            self._create_new(number_of_walkers, number_of_steps, number_of_dimensions, variable_names)
+
+    def _get_path(self, file_name):
+        return os.path.join(self._directory, file_name)
+
+    def _create_new(self, number_of_walkers, number_of_steps, number_of_dimensions, variable_names):
+        for number in (number_of_walkers, number_of_steps, number_of_dimensions):
+            assert isinstance(number, int) and number > 0, "a new Chain_storage needs the number of walkers, steps and dimensions!"
+        os.makedirs(self._directory, exist_ok=True)
+        self._manifest = {
+                'number_of_walkers':number_of_walkers,
+                'number_of_steps':number_of_steps,
+                'number_of_dimensions':number_of_dimensions,
+                'variable_names':list(variable_names) if variable_names is not None else None,
+                'steps_completed':0,
+                'accepted':[0]*number_of_walkers,
+        }
+        self._chains = np.lib.format.open_memmap(self._get_path(self.chains_file_name), mode='w+',
+                                                 dtype=float, shape=(number_of_walkers, number_of_steps, number_of_dimensions))
+        self._lnlikelihoods = np.lib.format.open_memmap(self._get_path(self.lnlikelihoods_file_name), mode='w+',
+                                                        dtype=float, shape=(number_of_walkers, number_of_steps))
+        self._write_manifest()
+
+    def _open_existing(self, number_of_walkers, number_of_steps, number_of_dimensions, variable_names):
+        with open(self._get_path(self.manifest_file_name), 'r') as f:
+            self._manifest = json.load(f)
+        requested = {'number_of_walkers':number_of_walkers, 'number_of_steps':number_of_steps,
+                     'number_of_dimensions':number_of_dimensions,
+                     'variable_names':list(variable_names) if variable_names is not None else None}
+        for key, value in requested.items():
+            if value is not None and value != self._manifest[key]:
+                print("\nADVISE: {} already contains a run with a different {}; use another directory to start a new run.\n".format(self._directory, key))
+                raise AssertionError("{} does not match the stored run!".format(key))
+        self._chains = np.load(self._get_path(self.chains_file_name), mmap_mode='r+')
+        self._lnlikelihoods = np.load(self._get_path(self.lnlikelihoods_file_name), mmap_mode='r+')
+
+    def _write_manifest(self):
+        temporary_file = self._get_path(self.manifest_file_name + '.tmp')
+        with open(temporary_file, 'w') as f:
+            json.dump(self._manifest, f, indent=1)
+        os.replace(temporary_file, self._get_path(self.manifest_file_name))
+
+    @property
+    def directory(self):
+        return self._directory
+
+    @property
+    def flush_every(self):
+        return self._flush_every
+
+    @property
+    def number_of_walkers(self):
+        return self._manifest['number_of_walkers']
+
+    @property
+    def number_of_steps(self):
+        return self._manifest['number_of_steps']
+
+    @property
+    def number_of_dimensions(self):
+        return self._manifest['number_of_dimensions']
+
+    @property
+    def variable_names(self):
+        return self._manifest['variable_names']
+
+    @property
+    def steps_completed(self):
+        return self._manifest['steps_completed']
+
+    @property
+    def is_complete(self):
+        return self.steps_completed == self.number_of_steps
+
+    @property
+    def chains(self):
+        return self._chains[:, :self.steps_completed]
+
+    @property
+    def lnlikelihoods(self):
+        return self._lnlikelihoods[:, :self.steps_completed]
+
+    @property
+    def acceptance_fractions(self):
+        return np.array(self._manifest['accepted'], dtype=float)/max(1, self.steps_completed)
+
+    @property
+    def last_positions(self):
+        assert self.steps_completed > 0, "there are no stored steps yet!"
+        return np.array(self._chains[:, self.steps_completed-1])
+
+    @property
+    def last_lnlikelihoods(self):
+        assert self.steps_completed > 0, "there are no stored steps yet!"
+        return np.array(self._lnlikelihoods[:, self.steps_completed-1])
+
+    def append(self, positions, lnlikelihoods, accepted):
+        assert not self.is_complete, "all the steps of this Chain_storage have already been stored!"
+        step = self._pending_steps + self.steps_completed
+        self._chains[:, step] = positions
+        self._lnlikelihoods[:, step] = lnlikelihoods
+        self._pending_accepted += np.asarray(accepted, dtype=int)
+        self._pending_steps += 1
+        if self._pending_steps == self.flush_every or step + 1 == self.number_of_steps:
+            self.flush()
+
+    def extend(self, chains, lnlikelihoods, number_of_accepted):
+        # stores a block of steps, chains of shape (walkers, steps, dimensions)
+        number_of_new_steps = np.shape(lnlikelihoods)[1]
+        step = self._pending_steps + self.steps_completed
+        assert step + number_of_new_steps <= self.number_of_steps, "the block does not fit in this Chain_storage!"
+        self._chains[:, step:step+number_of_new_steps] = chains
+        self._lnlikelihoods[:, step:step+number_of_new_steps] = lnlikelihoods
+        self._pending_accepted += np.asarray(number_of_accepted, dtype=int)
+        self._pending_steps += number_of_new_steps
+        self.flush()
+
+    def flush(self):
+        if self._pending_steps == 0:
+            return
+        self._chains.flush()
+        self._lnlikelihoods.flush()
+        self._manifest['steps_completed'] += self._pending_steps
+        self._manifest['accepted'] = (np.array(self._manifest['accepted']) + self._pending_accepted).tolist()
+        self._pending_steps = 0
+        self._pending_accepted = 0
+        self._write_manifest()
+
+class Stored_results:
+    # Read-only, memory-mapped access to a Chain_storage directory. Burntin
+    # discard, thinning and walker selection return views of the files on disk,
+    # so nothing is read until it is used. Indexing with the keys of
+    # pickle_results (results['chains'], ...) is also supported.
+    def __init__(self, directory):
+        self._directory = directory
+        with open(os.path.join(directory, Chain_storage.manifest_file_name), 'r') as f:
+            self._manifest = json.load(f)
+        steps_completed = self._manifest['steps_completed']
+        self._chains = np.load(os.path.join(directory, Chain_storage.chains_file_name), mmap_mode='r')[:, :steps_completed]
+        self._lnlikelihoods = np.load(os.path.join(directory, Chain_storage.lnlikelihoods_file_name), mmap_mode='r')[:, :steps_completed]
+
+    @property
+    def directory(self):
+        return self._directory
+
+    @property
+    def variable_names(self):
+        return self._manifest['variable_names']
+
+    @property
+    def number_of_walkers(self):
+        return self._chains.shape[0]
+
+    @property
+    def number_of_steps(self):
+        return self._chains.shape[1]
+
+    @property
+    def number_of_dimensions(self):
+        return self._chains.shape[2]
+
+    @property
+    def acceptance_fractions(self):
+        return np.array(self._manifest['accepted'], dtype=float)/max(1, self.number_of_steps)
+
+    def get_chains(self, discard=0, thin=1, walkers=slice(None)):
+        return self._chains[walkers, discard::thin]
+
+    def get_lnlikelihoods(self, discard=0, thin=1, walkers=slice(None)):
+        return self._lnlikelihoods[walkers, discard::thin]
+
+    def get_walker(self, walker, discard=0, thin=1):
+        return self.get_chains(discard=discard, thin=thin, walkers=walker)
+
+    def get_flat_samples(self, discard=0, thin=1):
+        # only the selected steps are copied into memory
+        return self.get_chains(discard=discard, thin=thin).reshape((-1, self.number_of_dimensions))
+
+    def __getitem__(self, key):
+        return {
+                'lnlikelihoods':self.get_lnlikelihoods,
+                'chains':self.get_chains,
+                'acceptance_fractions':lambda: self.acceptance_fractions,
+                'variable_names':lambda: self.variable_names,
+        }[key]()
+
+def save_results(Analysis, directory, block_size=1000):
+    # same content as pickle_results, in the format read by load_results
+    source = Analysis.chain_storage
+    if source is None:
+        chains = np.swapaxes(Analysis.sampler.get_chain(), 0, 1)
+        lnlikelihoods = np.swapaxes(Analysis.sampler.get_log_prob(), 0, 1)
+        acceptance_fractions = Analysis.sampler.acceptance_fraction
+    else:
+        chains = source.chains
+        lnlikelihoods = source.lnlikelihoods
+        acceptance_fractions = source.acceptance_fractions
+    number_of_walkers, number_of_steps, number_of_dimensions = chains.shape
+    number_of_accepted = np.rint(acceptance_fractions*number_of_steps).astype(int)
+    storage = Chain_storage(directory, number_of_walkers, number_of_steps, number_of_dimensions,
+                            variable_names=Analysis.variables_key_list, flush_every=block_size)
+    for step in range(storage.steps_completed, number_of_steps, block_size):
+        storage.extend(chains[:, step:step+block_size], lnlikelihoods[:, step:step+block_size],
+                       number_of_accepted if step == 0 else 0)
+
+def load_results(directory):
+    return Stored_results(directory)
+
 def pickle_results(Analysis, file_name):
+    # after a run with storage the sampler keeps no chain: it is read from disk
+    source = Analysis.chain_storage
+    if source is None:
+        lnlikelihoods = Analysis.sampler.lnprobability
+        chains = Analysis.sampler.chain
+        acceptance_fractions = Analysis.sampler.acceptance_fraction
+    else:
+        lnlikelihoods = np.array(source.lnlikelihoods)
+        chains = np.array(source.chains)
+        acceptance_fractions = source.acceptance_fractions
 
     data_to_pickle = {
-                'lnlikelihoods':Analysis.sampler.lnprobability,
-                'chains':Analysis.sampler.chain, 
-                'acceptance_fractions':Analysis.sampler.acceptance_fraction,
+                'lnlikelihoods':lnlikelihoods,
+                'chains':chains, 
+                'acceptance_fractions':acceptance_fractions,
                 'variable_names':Analysis.variables_key_list,
     }
 
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+#%%
+
+# Surrogate of chi2(variables) for cheap re-analyses (see
+# Analysis.fit_chi2_emulator): a Gaussian process with a squared-exponential
+# kernel through the chi2 of a design of points. The chi2 of the design points
+# is capped at maximum_chi2, maximum_delta_chi2 above their minimum, since the
+# posterior is negligible beyond it and the huge values far from the minimum
+# would spoil the fit close to it. maximum_chi2 is also the mean of the
+# process, so that away from the design points the emulator tends to a bad fit
+# instead of extrapolating to spurious minima. The variables are whitened with
+# the covariance of the design points (after taking the logarithm of the
+# logarithmic ones), so that correlated directions get their own length
+# scales. These maximise the marginal likelihood, from a few starting points
+# since it often has a poor local maximum at short length scales, and the
+# amplitude is profiled out. The emulator only knows chi2, so the priors can
+# change between runs without refitting it. Outside the box of its design
+# points (enlarged by domain_margin) it is not trusted.
+
+class Chi2_emulator:
+    def __init__(self, design_points, chi2_values, length_scales=None, nugget=1.0e-8, maximum_delta_chi2=100.0,
+                 logarithmic=None, domain_margin=0.1):
+        # length_scales (in whitened units) are fitted if not given; logarithmic
+        # tells which variables, all positive, are emulated in logarithm
+        number_of_dimensions = np.shape(design_points)[-1]
+        self._nugget = nugget
+        self._maximum_delta_chi2 = maximum_delta_chi2
+        self._logarithmic = np.zeros(number_of_dimensions, dtype=bool) if logarithmic is None else np.array(logarithmic, dtype=bool)
+        self._domain_margin = domain_margin
+        self._design_points = np.empty((0, number_of_dimensions))
+        self._chi2_values = np.empty(0)
+        self._length_scales = None if length_scales is None else np.array(length_scales, dtype=float)
+        self.add_points(design_points, chi2_values, fit_length_scales=length_scales is None)
+
+    @property
+    def number_of_dimensions(self):
+        return self._design_points.shape[1]
+
+    @property
+    def number_of_points(self):
+        return len(self._chi2_values)
+
+    @property
+    def design_points(self):
+        return self._design_points
+
+    @property
+    def chi2_values(self):
+        return self._chi2_values
+
+    @property
+    def maximum_chi2(self):
+        return np.min(self._chi2_values) + self._maximum_delta_chi2
+
+    @property
+    def logarithmic(self):
+        return self._logarithmic
+
+    @property
+    def length_scales(self):
+        return self._length_scales
+
+    @property
+    def domain(self):
+        # lower and upper corners of the box where the emulator is used
+        return self._domain
+
+    def is_inside_domain(self, array_of_values):
+        lower, upper = self._domain
+        a = np.atleast_2d(array_of_values)
+        return np.all((lower <= a) & (a <= upper), axis=1)
+
+    def add_points(self, design_points, chi2_values, fit_length_scales=True):
+        # without fit_length_scales the refit only costs a Cholesky decomposition
+        design_points = np.atleast_2d(np.asarray(design_points, dtype=float))
+        chi2_values = np.asarray(chi2_values, dtype=float).reshape(-1)
+        assert len(design_points) == len(chi2_values), "design_points and chi2_values must have the same length!"
+        assert np.all(np.isfinite(chi2_values)), "chi2_values must be finite!"
+        assert np.all(design_points[:, self._logarithmic] > 0.0), "the logarithmic variables must be positive!"
+        self._design_points = np.concatenate((self._design_points, design_points))
+        self._chi2_values = np.concatenate((self._chi2_values, chi2_values))
+        assert self.number_of_points > self.number_of_dimensions, "the emulator needs more design points than dimensions!"
+        self._fit(fit_length_scales)
+
+    def _transform(self, array_of_values):
+        a = np.atleast_2d(array_of_values)
+        return np.where(self._logarithmic, np.log(np.where(self._logarithmic, a, 1.0)), a)
+
+    def _normalise(self, array_of_values):
+        return (self._transform(array_of_values) - self._centre) @ self._whitening.T
+
+    @staticmethod
+    def _get_correlations(u_1, u_2, length_scales):
+        squared_distances = np.sum(((u_1[:, np.newaxis, :] - u_2[np.newaxis, :, :])/length_scales)**2, axis=-1)
+        return np.exp(-0.5*squared_distances)
+
+    def _negative_ln_marginal_likelihood_and_gradient(self, ln_length_scales):
+        # with the amplitude profiled out, and its gradient in ln(length scales)
+        import scipy.linalg
+        length_scales = np.exp(ln_length_scales)
+        squared_differences = (self._u[:, np.newaxis, :] - self._u[np.newaxis, :, :])**2
+        correlations = np.exp(-0.5*np.sum(squared_differences/length_scales**2, axis=-1))
+        try:
+            cholesky = np.linalg.cholesky(correlations + self._nugget*np.eye(len(correlations)))
+        except np.linalg.LinAlgError:
+            return np.infty, np.zeros(len(length_scales))
+        number_of_points = len(self._residuals)
+        weights = scipy.linalg.cho_solve((cholesky, True), self._residuals)
+        squared_norm = np.dot(self._residuals, weights)
+        value = 0.5*number_of_points*np.log(squared_norm/number_of_points) + np.sum(np.log(np.diag(cholesky)))
+        # dC/dln(l_k) = C*(u_ik - u_jk)^2/l_k^2
+        inverse = scipy.linalg.cho_solve((cholesky, True), np.eye(number_of_points))
+        derivatives = correlations[..., np.newaxis]*squared_differences/length_scales**2
+        gradient = (-0.5*number_of_points*np.einsum('i,ijk,j->k', weights, derivatives, weights)/squared_norm
+                    + 0.5*np.einsum('ij,ijk->k', inverse, derivatives))
+        return value, gradient
+
+    def _fit(self, fit_length_scales=True):
+        import scipy.linalg
+        import scipy.optimize as optim
+        lower, upper = np.min(self._design_points, axis=0), np.max(self._design_points, axis=0)
+        self._domain = (lower - self._domain_margin*(upper - lower), upper + self._domain_margin*(upper - lower))
+        a = self._transform(self._design_points)
+        self._centre = np.mean(a, axis=0)
+        covariance = np.atleast_2d(np.cov(a, rowvar=False))
+        cholesky = np.linalg.cholesky(covariance + 1.0e-12*np.max(np.diag(covariance))*np.eye(self.number_of_dimensions))
+        self._whitening = scipy.linalg.solve_triangular(cholesky, np.eye(self.number_of_dimensions), lower=True)
+        self._u = self._normalise(self._design_points)
+        self._mean = self.maximum_chi2
+        self._residuals = np.minimum(self._chi2_values, self._mean) - self._mean
+        if fit_length_scales or self._length_scales is None:
+            # once fitted, from the previous length scales and the default ones
+            values = (0.3, 1.0, 3.0) if self._length_scales is None else (1.0,)
+            starts = [np.full(self.number_of_dimensions, value) for value in values]
+            if self._length_scales is not None:
+                starts.append(self._length_scales)
+            results = [optim.minimize(self._negative_ln_marginal_likelihood_and_gradient, np.log(start), method='L-BFGS-B', jac=True,
+                                      bounds=[(np.log(0.05), np.log(20.0))]*self.number_of_dimensions) for start in starts]
+            self._length_scales = np.exp(min(results, key=lambda result: result.fun).x)
+        correlations = self._get_correlations(self._u, self._u, self._length_scales)
+        self._cholesky = np.linalg.cholesky(correlations + self._nugget*np.eye(self.number_of_points))
+        self._weights = scipy.linalg.cho_solve((self._cholesky, True), self._residuals)
+        self._variance = np.dot(self._residuals, self._weights)/self.number_of_points
+
+    def predict(self, array_of_values, return_std=False):
+        # emulated chi2 of every row, and its standard deviation if return_std
+        import scipy.linalg
+        correlations = self._get_correlations(self._normalise(array_of_values), self._u, self._length_scales)
+        chi2 = self._mean + correlations @ self._weights
+        if not return_std:
+            return chi2
+        whitened_correlations = scipy.linalg.solve_triangular(self._cholesky, correlations.T, lower=True)
+        variances = self._variance*(1.0 + self._nugget - np.sum(whitened_correlations**2, axis=0))
+        return chi2, np.sqrt(np.maximum(variances, 0.0))
+
+    def get_errors(self, array_of_values, chi2_values):
+        # |emulated - exact chi2|, both capped at maximum_chi2
+        maximum_chi2 = self.maximum_chi2
+        return np.abs(np.minimum(self.predict(array_of_values), maximum_chi2) - np.minimum(chi2_values, maximum_chi2))
+
+    def save(self, file_name):
+        np.savez(file_name, design_points=self._design_points, chi2_values=self._chi2_values, length_scales=self._length_scales,
+                 nugget=self._nugget, maximum_delta_chi2=self._maximum_delta_chi2, logarithmic=self._logarithmic,
+                 domain_margin=self._domain_margin)
+
+    @classmethod
+    def load(cls, file_name):
+        with np.load(file_name) as f:
+            return cls(f['design_points'], f['chi2_values'], length_scales=f['length_scales'], nugget=float(f['nugget']),
+                       maximum_delta_chi2=float(f['maximum_delta_chi2']), logarithmic=f['logarithmic'], domain_margin=float(f['domain_margin']))
+
+#%%
+if __name__ == '__main__':
+    pass
@@ -1,12 +1,53 @@
 # -*- coding: utf-8 -*-
 
+import os
+import json
+import hashlib
+import functools
 import numpy as np
 
 from GalaxyDynamicsFromVc import units
+from GalaxyDynamicsFromVc.datahandling import default_cache_directory
 
 
 #%%
 
+def _cached_for_scalars(maxsize):
+    # lru_cache that is bypassed for unhashable (array) arguments, as those
+    # used by the vectorized likelihood
+    def decorator(function):
+        cached_function = functools.lru_cache(maxsize=maxsize)(function)
+        @functools.wraps(function)
+        def wrapper(*args):
+            try:
+                hash(args)
+            except TypeError:
+                return function(*args)
+            return cached_function(*args)
+        wrapper.cache_info = cached_function.cache_info
+        wrapper.cache_clear = cached_function.cache_clear
+        return wrapper
+    return decorator
+
+@_cached_for_scalars(maxsize=1024)
+def _halo_derived_quantities(Mvir_in_1e11Msun, cvir, Delta_vir, h_cosmo):
+    # (rvir_kpc, rs_kpc, mass_factor, density_normalisation_Msun_kpc3, Vc2_normalisation_km2_kpc_s2)
+    # with mass_factor = ln(1+cvir) - cvir/(1+cvir), the enclosed mass of the NFW
+    # profile at rvir in units of 4*pi*rho_s*rs^3
+    Mvir_in_Msun = Mvir_in_1e11Msun*1.0e11
+    rho_critical_Msun_kpc3 = 2.77536627e2*h_cosmo**2
+    rvir_kpc = (Mvir_in_Msun/4.0/np.pi*3.0/Delta_vir/rho_critical_Msun_kpc3)**(1./3.)
+    rs_kpc = rvir_kpc/cvir
+    mass_factor = 1.0/(cvir+1.0)+np.log(cvir+1.0)-1.0
+    density_normalisation = Mvir_in_Msun/(4.0*np.pi*(rs_kpc**3)*mass_factor)
+    Grav_constant = 1.0 # gravitational cte, with masses in units of 2.32e7 Msun
+    convFactor = 100.0
+    Vc2_normalisation = convFactor*Grav_constant*(Mvir_in_Msun/2.32e7)/mass_factor
+    return rvir_kpc, rs_kpc, mass_factor, density_normalisation, Vc2_normalisation
+
+def clear_cache():
+    _halo_derived_quantities.cache_clear()
+
 class Potential:
     pass
 
@@ -18,6 +59,7 @@ class DM_halo(Potential):
         self._Delta_vir = Delta_vir
         self._h_cosmo = h_cosmo
         self._rho_critical_Msun_kpc3 = 2.77536627e2*h_cosmo**2
+        self._derived_quantities = self._get_derived_quantities()
         self._rvir_kpc = self._set_rvir_kpc()
         self._rs_kpc = self._set_rs_kpc()
 
@@ -49,20 +91,25 @@ class DM_halo(Potential):
     def rs_kpc(self):
         return self._rs_kpc
 
+    def _get_derived_quantities(self):
+        return _halo_derived_quantities(self.Mvir_in_1e11Msun, self.cvir, self.Delta_vir, self.h_cosmo)
+
     def _set_rvir_kpc(self):
-        return (self.Mvir_in_Msun/4.0/np.pi*3.0/self.Delta_vir/self._rho_critical_Msun_kpc3)**(1./3.)
+        return self._derived_quantities[0]
 
     def _set_rs_kpc(self):
-        return self.rvir_kpc/self.cvir
+        return self._derived_quantities[1]
     
     def update_Mvir_in_1e11Msun(self, value):
         self._Mvir_in_1e11Msun = value
         self._Mvir_in_Msun = self.Mvir_in_1e11Msun*1.0e11
+        self._derived_quantities = self._get_derived_quantities()
         self._rvir_kpc = self._set_rvir_kpc()
         self._rs_kpc = self._set_rs_kpc()
         
     def update_cvir(self, value):
         self._cvir = value
+        self._derived_quantities = self._get_derived_quantities()
         self._rs_kpc = self._set_rs_kpc()
 
 class NFW(DM_halo):
@@ -70,7 +117,7 @@ class NFW(DM_halo):
         super().__init__(Mvir_in_1e11Msun, cvir, Delta_vir=Delta_vir, h_cosmo=h_cosmo)
         
     def density_Msun_kpc3(self, r_kpc):
-        normalisation = self.Mvir_in_Msun/(4.0*np.pi*((self.rs_kpc)**3)*(1.0/(self.cvir+1.0)+np.log(self.cvir+1.0)-1.0))
+        normalisation = self._derived_quantities[3]
         rs_over_r = self.rs_kpc/r_kpc
         return normalisation*(rs_over_r)/(1.0+1.0/rs_over_r)**2
 
@@ -78,30 +125,49 @@ class NFW(DM_halo):
         return units._Msun_kpc3_to_GeV_cm3_factor*self.density_Msun_kpc3(r_kpc)
     
     def enclosed_mass_in_Msun(self, r_kpc):
-        normalisation = self.Mvir_in_Msun/((1.0/(self.cvir+1.0)+np.log(self.cvir+1.0)-1.0))
+        normalisation = self.Mvir_in_Msun/self._derived_quantities[2]
         r_over_rs = r_kpc/self.rs_kpc
         return normalisation*(1.0/(r_over_rs+1.0)+np.log(r_over_rs+1.0)-1.0)
     
     def circular_velocity_km_s(self, r_kpc):
-        Mv = self.Mvir_in_Msun/2.32e7 # 2.32e7 Msun
-        Grav_constant = 1.0 # gravitational cte
-        rs_3 = self.rs_kpc**3
-        normalisation = Mv/(4.0*np.pi*(rs_3)*(1.0/(self.cvir+1.0)+np.log(self.cvir+1.0)-1.0))
-        inner_factor = 4.0*np.pi*Grav_constant*normalisation
-        convFactor = 10.0
-        r_over_rs = r_kpc/self.rs_kpc
-        return convFactor*np.sqrt(inner_factor*(rs_3)*(1.0/(r_over_rs+1.0)+np.log(1.0+r_over_rs)-1.0)/r_kpc)
+        return np.sqrt(self.squared_circular_velocity_km2_s2(r_kpc))
 
     def squared_circular_velocity_km2_s2(self, r_kpc):
-        Mv = self.Mvir_in_Msun/2.32e7 # to transform it in units of 2.32e7 Msun
-        Grav_constant = 1.0 # gravitational cte
-        rs_3 = self.rs_kpc**3
-        normalisation = Mv/(4.0*np.pi*(rs_3)*(1.0/(self.cvir+1.0)+np.log(self.cvir+1.0)-1.0))
-        inner_factor = 4.0*np.pi*Grav_constant*normalisation
-        convFactor = 100.0
-        r_over_rs = r_kpc/self.rs_kpc
-        return convFactor*(inner_factor*(rs_3)*(1.0/(r_over_rs+1.0)+np.log(1.0+r_over_rs)-1.0)/r_kpc)        
+        return self._squared_circular_velocity_km2_s2(r_kpc, self.rs_kpc, self._derived_quantities[4])
+
+    @staticmethod
+    def _squared_circular_velocity_km2_s2(r_kpc, rs_kpc, Vc2_normalisation):
+        r_over_rs = r_kpc/rs_kpc
+        return Vc2_normalisation*(1.0/(r_over_rs+1.0)+np.log(1.0+r_over_rs)-1.0)/r_kpc
+
+    @staticmethod
+    def squared_circular_velocity_from_parameters_km2_s2(r_kpc, Mvir_in_1e11Msun=11.2, cvir=12.8, Delta_vir=200.0, h_cosmo=0.678):
+        # same as building NFW(...) and calling squared_circular_velocity_km2_s2, without allocating the halo
+        rvir_kpc, rs_kpc, mass_factor, density_normalisation, Vc2_normalisation = _halo_derived_quantities(Mvir_in_1e11Msun, cvir, Delta_vir, h_cosmo)
+        return NFW._squared_circular_velocity_km2_s2(r_kpc, rs_kpc, Vc2_normalisation)
+
+    def squared_circular_velocity_gradient_km2_s2(self, r_kpc):
+        return self.squared_circular_velocity_gradient_from_parameters_km2_s2(r_kpc, self.Mvir_in_1e11Msun, self.cvir,
+                                                                              Delta_vir=self.Delta_vir, h_cosmo=self.h_cosmo)
+
+    @staticmethod
+    def squared_circular_velocity_gradient_from_parameters_km2_s2(r_kpc, Mvir_in_1e11Msun=11.2, cvir=12.8, Delta_vir=200.0, h_cosmo=0.678):
+        # Vc^2 = const*Mvir*f(r/rs)/(r*f(cvir)), with f(y) = ln(1+y) - y/(1+y),
+        # f'(y) = y/(1+y)^2 and rs proportional to Mvir^(1/3)/(cvir*Delta_vir^(1/3)*h^(2/3))
+        rvir_kpc, rs_kpc, mass_factor, density_normalisation, Vc2_normalisation = _halo_derived_quantities(Mvir_in_1e11Msun, cvir, Delta_vir, h_cosmo)
+        x = r_kpc/rs_kpc
+        f_x = 1.0/(x+1.0)+np.log(1.0+x)-1.0
+        Vc2 = Vc2_normalisation*f_x/r_kpc
+        x_dlnf_dx = x*x/(1.0+x)**2/f_x
+        dlnf_dc = cvir/(1.0+cvir)**2/mass_factor
+        return {
+                'Mvir_in_1e11Msun':Vc2*(1.0 - x_dlnf_dx/3.0)/Mvir_in_1e11Msun,
+                'cvir':Vc2*(x_dlnf_dx/cvir - dlnf_dc),
+                'Delta_vir':Vc2*x_dlnf_dx/(3.0*Delta_vir),
+                'h_cosmo':Vc2*2.0*x_dlnf_dx/(3.0*h_cosmo),
+        }
         
+
 class Miyamoto_Nagai_disk(Potential):
     def __init__(self, total_mass_Msun=3.944e10, a_kpc=5.3, b_kpc=0.25):
         self.total_mass_Msun = total_mass_Msun
@@ -146,11 +212,29 @@ class Miyamoto_Nagai_disk(Potential):
         return convFactor*R_kpc*np.sqrt(Grav_constant*M)/(R_kpc**2 + (self.a_kpc + np.sqrt(z_kpc**2 + self.b_kpc**2))**2)**(3./4.)
 
     def squared_circular_velocity_km2_s2(self, R_kpc, z_kpc=0):
+        return self.squared_circular_velocity_from_parameters_km2_s2(R_kpc, self.total_mass_Msun, self.a_kpc, self.b_kpc, z_kpc=z_kpc)
+
+    @staticmethod
+    def squared_circular_velocity_from_parameters_km2_s2(R_kpc, total_mass_Msun=3.944e10, a_kpc=5.3, b_kpc=0.25, z_kpc=0):
         Grav_constant = 1 # gravitational cte.
-        M = self.total_mass_Msun/2.32e7
+        M = total_mass_Msun/2.32e7
         convFactor = 100.0
         R_2 = R_kpc**2
-        return convFactor*R_2*Grav_constant*M/(R_2 + (self.a_kpc + np.sqrt(z_kpc**2 + self.b_kpc**2))**2)**(3./2.)
+        return convFactor*R_2*Grav_constant*M/(R_2 + (a_kpc + np.sqrt(z_kpc**2 + b_kpc**2))**2)**(3./2.)
+
+    def squared_circular_velocity_gradient_km2_s2(self, R_kpc, z_kpc=0):
+        return self.squared_circular_velocity_gradient_from_parameters_km2_s2(R_kpc, self.total_mass_Msun, self.a_kpc, self.b_kpc, z_kpc=z_kpc)
+
+    @classmethod
+    def squared_circular_velocity_gradient_from_parameters_km2_s2(cls, R_kpc, total_mass_Msun=3.944e10, a_kpc=5.3, b_kpc=0.25, z_kpc=0):
+        Vc2 = cls.squared_circular_velocity_from_parameters_km2_s2(R_kpc, total_mass_Msun, a_kpc, b_kpc, z_kpc=z_kpc)
+        sqrzb = np.sqrt(z_kpc**2 + b_kpc**2)
+        dVc2_da = -3.0*Vc2*(a_kpc + sqrzb)/(R_kpc**2 + (a_kpc + sqrzb)**2)
+        return {
+                'total_mass_Msun':Vc2/total_mass_Msun,
+                'a_kpc':dVc2_da,
+                'b_kpc':dVc2_da*b_kpc/sqrzb,
+        }
 
 class Plummer(Potential):
     def __init__(self, total_mass_Msun=1.0672e10, b_kpc=0.3):
@@ -171,6 +255,12 @@ class Plummer(Potential):
     def b_kpc(self, value):
         self._b_kpc = value
         
+    def density_Msun_kpc3(self, r_kpc):
+        return 3.0*self.total_mass_Msun/(4.0*np.pi*self.b_kpc**3)*(1.0 + r_kpc**2/self.b_kpc**2)**(-5.0/2.0)
+
+    def density_GeV_cm3(self, r_kpc):
+        return units._Msun_kpc3_to_GeV_cm3_factor*self.density_Msun_kpc3(r_kpc)
+
     def enclosed_mass_in_Msun(self, r_kpc):
         return self.total_mass_Msun*r_kpc**3*(self.b_kpc**2 + r_kpc**2)**(-3.0/2.0)
     
@@ -181,11 +271,252 @@ class Plummer(Potential):
         return convFactor*r_kpc*np.sqrt(Grav_constant*M)/(r_kpc**2 + self.b_kpc**2)**(3./4.)
     
     def squared_circular_velocity_km2_s2(self, r_kpc):
+        return self.squared_circular_velocity_from_parameters_km2_s2(r_kpc, self.total_mass_Msun, self.b_kpc)
+
+    @staticmethod
+    def squared_circular_velocity_from_parameters_km2_s2(r_kpc, total_mass_Msun=1.0672e10, b_kpc=0.3):
         Grav_constant = 1
-        M = self.total_mass_Msun/2.32e7
+        M = total_mass_Msun/2.32e7
         convFactor = 100.0
         r_2 = r_kpc**2
-        return convFactor*r_2*Grav_constant*M/(r_2+self.b_kpc**2)**(3./2.)
+        return convFactor*r_2*Grav_constant*M/(r_2+b_kpc**2)**(3./2.)
+
+    def squared_circular_velocity_gradient_km2_s2(self, r_kpc):
+        return self.squared_circular_velocity_gradient_from_parameters_km2_s2(r_kpc, self.total_mass_Msun, self.b_kpc)
+
+    @classmethod
+    def squared_circular_velocity_gradient_from_parameters_km2_s2(cls, r_kpc, total_mass_Msun=1.0672e10, b_kpc=0.3):
+        Vc2 = cls.squared_circular_velocity_from_parameters_km2_s2(r_kpc, total_mass_Msun, b_kpc)
+        return {
+                'total_mass_Msun':Vc2/total_mass_Msun,
+                'b_kpc':-3.0*Vc2*b_kpc/(r_kpc**2 + b_kpc**2),
+        }
+
+class Enclosed_mass_table:
+    # Dimensionless enclosed mass m(x, shape) = int_0^x f(y, shape)*y^2 dy of a
+    # spherical density profile f, tabulated as ln m on a regular grid of ln x
+    # and shape. It is interpolated bilinearly, i.e. as a piecewise power law in
+    # x, which is extrapolated beyond the range of x; shapes out of their range
+    # give NaN. The table is saved as .npz in cache_directory (None disables it)
+    # under a key made of name and the grid settings.
+    version = 1
+
+    def __init__(self, dimensionless_density, name, shape_min, shape_max, number_of_shapes=101,
+                 x_min=1.0e-5, x_max=1.0e4, number_of_radii=2048, cache_directory=default_cache_directory):
+        assert x_min > 0.0 and x_max > x_min, "0 < x_min < x_max is required!"
+        assert shape_max > shape_min and number_of_shapes > 1, "the table needs at least two shapes in shape_min < shape_max!"
+        self._dimensionless_density = dimensionless_density
+        self._name = name
+        self._settings = {'shape_min':float(shape_min), 'shape_max':float(shape_max), 'number_of_shapes':int(number_of_shapes),
+                          'x_min':float(x_min), 'x_max':float(x_max), 'number_of_radii':int(number_of_radii)}
+        self._ln_x = np.linspace(np.log(x_min), np.log(x_max), number_of_radii)
+        self._shapes = np.linspace(shape_min, shape_max, number_of_shapes)
+        self._cache_directory = cache_directory
+        self._ln_m = self._load()
+        self._last_row = (None, None)
+
+    @property
+    def ln_x(self):
+        return self._ln_x
+
+    @property
+    def shapes(self):
+        return self._shapes
+
+    @property
+    def ln_m(self):
+        return self._ln_m
+
+    def _build(self, number_of_nodes=4):
+        # Gauss-Legendre in ln y within every interval of the grid, plus a power
+        # law, with the local slope of f, from 0 to x_min
+        f = self._dimensionless_density
+        shapes = self.shapes[:, np.newaxis, np.newaxis]
+        nodes, weights = np.polynomial.legendre.leggauss(number_of_nodes)
+        half_step = 0.5*(self.ln_x[1] - self.ln_x[0])
+        y = np.exp(0.5*(self.ln_x[:-1] + self.ln_x[1:])[:, np.newaxis] + half_step*nodes)
+        increments = half_step*np.sum(weights*f(y, shapes)*y**3, axis=-1)
+        x_min = np.exp(self.ln_x[0])
+        f_min = f(x_min, self.shapes)
+        inner_slope = np.log(f(x_min*1.0001, self.shapes)/f_min)/np.log(1.0001)
+        m_min = f_min*x_min**3/(3.0 + inner_slope)
+        m = m_min[:, np.newaxis] + np.concatenate((np.zeros((len(self.shapes), 1)), np.cumsum(increments, axis=1)), axis=1)
+        return np.log(m)
+
+    def _get_cache_file(self):
+        key = hashlib.sha1(json.dumps([self._name, self.version, self._settings], sort_keys=True).encode()).hexdigest()
+        return os.path.join(self._cache_directory, 'table_' + key + '.npz')
+
+    def _load(self):
+        if self._cache_directory is None:
+            return self._build()
+        cache_file = self._get_cache_file()
+        if os.path.isfile(cache_file):
+            try:
+                with np.load(cache_file) as f:
+                    ln_m = f['ln_m']
+                if ln_m.shape == (len(self.shapes), len(self.ln_x)):
+                    return ln_m
+            except Exception:
+                pass # unreadable cache, built again below
+        ln_m = self._build()
+        os.makedirs(self._cache_directory, exist_ok=True)
+        temporary_file = cache_file + '.{}.tmp.npz'.format(os.getpid())
+        np.savez(temporary_file, ln_m=ln_m)
+        os.replace(temporary_file, cache_file)
+        return ln_m
+
+    def _get_shape_weights(self, shape):
+        # cubic Lagrange interpolation in shape through the rows j-1, j, j+1, j+2
+        v = (np.asarray(shape, dtype=float) - self.shapes[0])/(self.shapes[1] - self.shapes[0])
+        in_range = (v >= 0.0) & (v <= len(self.shapes)-1)
+        j = np.clip(np.floor(np.nan_to_num(v)), 1, len(self.shapes)-3).astype(int)
+        t = np.where(in_range, v - j, np.nan)
+        weights = (-t*(t-1.0)*(t-2.0)/6.0, (t+1.0)*(t-1.0)*(t-2.0)/2.0, -(t+1.0)*t*(t-2.0)/2.0, (t+1.0)*t*(t-1.0)/6.0)
+        return j, weights
+
+    def _get_row(self, shape):
+        # ln m(ln_x, shape) of a single shape, kept until another one is asked for.
+        # The table is shared by the threads of a Thread_pool, so the cached
+        # (shape, row) pair is read and replaced as a whole.
+        last_shape, row = self._last_row
+        if last_shape != shape:
+            j, weights = self._get_shape_weights(shape)
+            T = self.ln_m
+            row = weights[0]*T[j-1] + weights[1]*T[j] + weights[2]*T[j+1] + weights[3]*T[j+2]
+            self._last_row = (shape, row)
+        return row
+
+    def ln_enclosed_mass(self, ln_x, shape):
+        # ln_x and shape broadcast against each other, e.g. (n_models, n_radii)
+        # and (n_models, 1); linear interpolation in ln x
+        u = (ln_x - self.ln_x[0])/(self.ln_x[1] - self.ln_x[0])
+        i = np.clip(np.floor(u), 0, len(self.ln_x)-2).astype(int)
+        t = u - i
+        if np.ndim(shape) == 0:
+            row = self._get_row(float(shape))
+            return row[i] + t*(row[i+1] - row[i])
+        j, weights = self._get_shape_weights(shape)
+        T = self.ln_m
+        ln_m = 0.0
+        for k, weight in enumerate(weights):
+            row_j = j + (k-1)
+            ln_m = ln_m + weight*(T[row_j, i] + t*(T[row_j, i+1] - T[row_j, i]))
+        return ln_m
+
+    def enclosed_mass(self, x, shape):
+        return np.exp(self.ln_enclosed_mass(np.log(x), shape))
+
+class Tabulated_halo(DM_halo):
+    # Halo with density rho_s*f(r/rs, shape) and enclosed mass Mvir within rvir,
+    # for profiles whose mass has no closed form. Vc^2 = 100*G*Mvir*m(r/rs)/(r*m(cvir))
+    # keeps the amplitude and the scale radius analytic; only the dimensionless
+    # m(x, shape) is interpolated from the Enclosed_mass_table of the class,
+    # built (or read from table_cache_directory) the first time it is needed.
+    # Subclasses define dimensionless_density(x, shape) and the shape range.
+    shape_min = 0.0
+    shape_max = 1.0
+    number_of_shapes = 101
+    table_cache_directory = default_cache_directory
+    _tables = {}
+
+    def __init__(self, Mvir_in_1e11Msun, cvir, shape, Delta_vir=200.0, h_cosmo=0.678):
+        assert type(self).dimensionless_density is not Tabulated_halo.dimensionless_density, \
+            "{} must define dimensionless_density(x, shape)!".format(type(self).__name__)
+        super().__init__(Mvir_in_1e11Msun, cvir, Delta_vir=Delta_vir, h_cosmo=h_cosmo)
+        self._shape = shape
+
+    @staticmethod
+    def dimensionless_density(x, shape):
+        """rho/rho_s at x = r/rs for the given shape; defined by subclasses such as Generalised_NFW and Einasto."""
+        raise NotImplementedError("subclasses of Tabulated_halo, such as Generalised_NFW and Einasto, must define dimensionless_density(x, shape)!")
+
+    @classmethod
+    def get_table(cls):
+        key = (cls.__name__, cls.shape_min, cls.shape_max, cls.number_of_shapes, cls.table_cache_directory)
+        if key not in Tabulated_halo._tables:
+            Tabulated_halo._tables[key] = Enclosed_mass_table(cls.dimensionless_density, cls.__name__, cls.shape_min, cls.shape_max,
+                                                              number_of_shapes=cls.number_of_shapes, cache_directory=cls.table_cache_directory)
+        return Tabulated_halo._tables[key]
+
+    def _get_density_normalisation(self):
+        table = self.get_table()
+        return self.Mvir_in_Msun/(4.0*np.pi*self.rs_kpc**3*table.enclosed_mass(self.cvir, self._shape))
+
+    def density_Msun_kpc3(self, r_kpc):
+        return self._get_density_normalisation()*self.dimensionless_density(r_kpc/self.rs_kpc, self._shape)
+
+    def density_GeV_cm3(self, r_kpc):
+        return units._Msun_kpc3_to_GeV_cm3_factor*self.density_Msun_kpc3(r_kpc)
+
+    def enclosed_mass_in_Msun(self, r_kpc):
+        table = self.get_table()
+        return self.Mvir_in_Msun*np.exp(table.ln_enclosed_mass(np.log(r_kpc/self.rs_kpc), self._shape) - table.ln_enclosed_mass(np.log(self.cvir), self._shape))
+
+    def circular_velocity_km_s(self, r_kpc):
+        return np.sqrt(self.squared_circular_velocity_km2_s2(r_kpc))
+
+    def squared_circular_velocity_km2_s2(self, r_kpc):
+        return self._squared_circular_velocity_km2_s2(r_kpc, self.Mvir_in_1e11Msun, self.cvir, self._shape, self.rs_kpc)
+
+    @classmethod
+    def _squared_circular_velocity_km2_s2(cls, r_kpc, Mvir_in_1e11Msun, cvir, shape, rs_kpc):
+        table = cls.get_table()
+        Grav_constant = 1.0 # gravitational cte, with masses in units of 2.32e7 Msun
+        convFactor = 100.0
+        ln_mass_ratio = table.ln_enclosed_mass(np.log(r_kpc/rs_kpc), shape) - table.ln_enclosed_mass(np.log(cvir), shape)
+        return convFactor*Grav_constant*(Mvir_in_1e11Msun*1.0e11/2.32e7)*np.exp(ln_mass_ratio)/r_kpc
+
+class Generalised_NFW(Tabulated_halo):
+    # rho = rho_s/((r/rs)^gamma*(1+r/rs)^(3-gamma)); gamma = 1 is the NFW profile
+    shape_min = 0.0
+    shape_max = 2.0
+    number_of_shapes = 101
+
+    def __init__(self, Mvir_in_1e11Msun=11.2, cvir=12.8, gamma=1.0, Delta_vir=200.0, h_cosmo=0.678):
+        super().__init__(Mvir_in_1e11Msun, cvir, gamma, Delta_vir=Delta_vir, h_cosmo=h_cosmo)
+
+    @property
+    def gamma(self):
+        return self._shape
+
+    def update_gamma(self, value):
+        self._shape = value
+
+    @staticmethod
+    def dimensionless_density(x, gamma):
+        return x**(-gamma)*(1.0 + x)**(gamma - 3.0)
+
+    @classmethod
+    def squared_circular_velocity_from_parameters_km2_s2(cls, r_kpc, Mvir_in_1e11Msun=11.2, cvir=12.8, gamma=1.0, Delta_vir=200.0, h_cosmo=0.678):
+        rs_kpc = _halo_derived_quantities(Mvir_in_1e11Msun, cvir, Delta_vir, h_cosmo)[1]
+        return cls._squared_circular_velocity_km2_s2(r_kpc, Mvir_in_1e11Msun, cvir, gamma, rs_kpc)
+
+class Einasto(Tabulated_halo):
+    # rho = rho_-2*exp(-2/alpha*((r/rs)^alpha - 1)), with rs the radius where the
+    # logarithmic slope is -2 and cvir = rvir/rs
+    shape_min = 0.05
+    shape_max = 1.0
+    number_of_shapes = 96
+
+    def __init__(self, Mvir_in_1e11Msun=11.2, cvir=12.8, alpha=0.17, Delta_vir=200.0, h_cosmo=0.678):
+        super().__init__(Mvir_in_1e11Msun, cvir, alpha, Delta_vir=Delta_vir, h_cosmo=h_cosmo)
+
+    @property
+    def alpha(self):
+        return self._shape
+
+    def update_alpha(self, value):
+        self._shape = value
+
+    @staticmethod
+    def dimensionless_density(x, alpha):
+        return np.exp(-2.0/alpha*(x**alpha - 1.0))
+
+    @classmethod
+    def squared_circular_velocity_from_parameters_km2_s2(cls, r_kpc, Mvir_in_1e11Msun=11.2, cvir=12.8, alpha=0.17, Delta_vir=200.0, h_cosmo=0.678):
+        rs_kpc = _halo_derived_quantities(Mvir_in_1e11Msun, cvir, Delta_vir, h_cosmo)[1]
+        return cls._squared_circular_velocity_km2_s2(r_kpc, Mvir_in_1e11Msun, cvir, alpha, rs_kpc)
     
 class Galactic_model:
     def __init__(self, *potentials):
@@ -193,11 +524,28 @@ class Galactic_model:
         for pot in potentials:
             assert isinstance(pot, Potential), "input *potentials must be any derived class of the class Potential"
 
-    def circular_velocity_km_s(self, R_kpc):
+    @property
+    def potentials(self):
+        return self._potentials
+
+    def squared_circular_velocity_km2_s2(self, R_kpc):
         Vc2 = 0.0
         for pot in self._potentials:
             Vc2 += pot.squared_circular_velocity_km2_s2(R_kpc)
-        return np.sqrt(Vc2)
+        return Vc2
+
+    def circular_velocity_km_s(self, R_kpc):
+        return np.sqrt(self.squared_circular_velocity_km2_s2(R_kpc))
+
+    def density_Msun_kpc3(self, R_kpc):
+        # total density in the galactic plane
+        rho = 0.0
+        for pot in self._potentials:
+            rho += pot.density_Msun_kpc3(R_kpc)
+        return rho
+
+    def density_GeV_cm3(self, R_kpc):
+        return units._Msun_kpc3_to_GeV_cm3_factor*self.density_Msun_kpc3(R_kpc)
         
 #%%
 if __name__ == '__main__':
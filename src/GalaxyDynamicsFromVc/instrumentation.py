@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import pstats
+import cProfile
+import contextlib
+import numpy as np
+
+from GalaxyDynamicsFromVc.parallelcomputing import split_in_chunks
+
+#%%
+
+# Opt-in timing of an Analysis (see Analysis.start_instrumentation). While it is
+# active the likelihood of the Analysis times its three sections here: 'prior',
+# 'model' (building the galaxy model, or evaluating the parameter map, and its
+# circular velocity) and 'chi2' (which includes the model with a fused kernel).
+# With an executor the sections are timed in the workers and sent back with
+# every chunk, and the time the workers wait for the slowest chunk of each batch
+# is counted as idle.
+
+_sections = ('prior', 'model', 'chi2')
+
+def _run_instrumented(analysis, ln_likelihood_function, array_of_values):
+    # the worker's Analysis times its sections in a new Instrumentation while
+    # ln_likelihood_function(array_of_values) runs
+    instrumentation = Instrumentation()
+    previous_instrumentation, analysis._instrumentation = analysis._instrumentation, instrumentation
+    start = time.perf_counter()
+    try:
+        ln_likelihoods = ln_likelihood_function(array_of_values)
+    finally:
+        analysis._instrumentation = previous_instrumentation
+    return ln_likelihoods, instrumentation.sections, time.perf_counter() - start
+
+def _instrumented_ln_likelihood_of_chunk(analysis, array_of_values):
+    return _run_instrumented(analysis, analysis.ln_likelihood_vectorized, array_of_values)
+
+def _instrumented_ln_likelihood_of_chunk_row_by_row(analysis, array_of_values):
+    return _run_instrumented(analysis, analysis._get_ln_likelihoods_row_by_row, array_of_values)
+
+class Instrumentation:
+    def __init__(self, profile=False):
+        # profile=True also runs cProfile in this process between start and stop
+        self._sections = {name: {'calls':0, 'evaluations':0, 'seconds':0.0} for name in _sections}
+        self._likelihood_calls = 0
+        self._likelihood_evaluations = 0
+        self._step_seconds = []
+        self._batches = []
+        self._workers = 1
+        self._profiler = cProfile.Profile() if profile else None
+
+    @property
+    def sections(self):
+        return self._sections
+
+    @property
+    def likelihood_calls(self):
+        return self._likelihood_calls
+
+    @property
+    def likelihood_evaluations(self):
+        return self._likelihood_evaluations
+
+    @property
+    def step_seconds(self):
+        return np.array(self._step_seconds)
+
+    @property
+    def profiler(self):
+        return self._profiler
+
+    def start(self):
+        if self._profiler is not None:
+            self._profiler.enable()
+
+    def stop(self):
+        if self._profiler is not None:
+            self._profiler.disable()
+
+    @contextlib.contextmanager
+    def time_section(self, name, number_of_evaluations=1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            section = self._sections[name]
+            section['seconds'] += time.perf_counter() - start
+            section['calls'] += 1
+            section['evaluations'] += number_of_evaluations
+
+    def add_sections(self, sections):
+        for name, section in sections.items():
+            for key in section:
+                self._sections[name][key] += section[key]
+
+    def count_likelihood_call(self, number_of_evaluations):
+        self._likelihood_calls += 1
+        self._likelihood_evaluations += number_of_evaluations
+
+    def ln_likelihood_vectorized_with_executor(self, executor, array_of_values, row_by_row=False):
+        # the executor's ln_likelihood_vectorized, one chunk per worker; with
+        # row_by_row the workers call ln_likelihood for every row of their chunk
+        chunks = split_in_chunks(array_of_values, number_of_chunks=executor.processes, chunksize=executor.chunksize)
+        start = time.perf_counter()
+        results = executor.map(_instrumented_ln_likelihood_of_chunk_row_by_row if row_by_row else _instrumented_ln_likelihood_of_chunk, chunks)
+        wall_seconds = time.perf_counter() - start
+        busy_seconds = 0.0
+        for ln_likelihoods, sections, seconds in results:
+            self.add_sections(sections)
+            busy_seconds += seconds
+        self._likelihood_calls += 1
+        self._likelihood_evaluations += sum(len(chunk) for chunk in chunks)
+        self._workers = executor.processes
+        self._batches.append((wall_seconds, busy_seconds))
+        return np.concatenate([result[0] for result in results])
+
+    def iterate_sampler(self, sampler, initial_state, iterations, **kwargs):
+        # sampler.sample(initial_state, iterations, **kwargs), recording the wall
+        # time of every step (including the work done by the caller on each state)
+        last_time = time.perf_counter()
+        for state in sampler.sample(initial_state, iterations=iterations, **kwargs):
+            now = time.perf_counter()
+            self._step_seconds.append(now - last_time)
+            last_time = now
+            yield state
+
+    def get_report(self):
+        step_seconds = self.step_seconds
+        report = {
+                'likelihood_calls':self.likelihood_calls,
+                'likelihood_evaluations':self.likelihood_evaluations,
+                'sections':{name: dict(section) for name, section in self.sections.items()},
+                'steps':{
+                        'number_of_steps':len(step_seconds),
+                        'total_seconds':float(np.sum(step_seconds)),
+                        'mean_seconds':float(np.mean(step_seconds)) if len(step_seconds) else None,
+                        'minimum_seconds':float(np.min(step_seconds)) if len(step_seconds) else None,
+                        'maximum_seconds':float(np.max(step_seconds)) if len(step_seconds) else None,
+                },
+        }
+        total_seconds = sum(section['seconds'] for section in self.sections.values())
+        for section in report['sections'].values():
+            section['fraction'] = section['seconds']/total_seconds if total_seconds > 0.0 else None
+        if self._batches:
+            wall_seconds, busy_seconds = np.sum(self._batches, axis=0)
+            idle_seconds = max(0.0, self._workers*wall_seconds - busy_seconds)
+            report['executor'] = {
+                    'workers':self._workers,
+                    'batches':len(self._batches),
+                    'wall_seconds':float(wall_seconds),
+                    'busy_seconds':float(busy_seconds),
+                    'idle_seconds':float(idle_seconds),
+                    'idle_fraction':float(idle_seconds/(self._workers*wall_seconds)) if wall_seconds > 0.0 else None,
+            }
+        return report
+
+    def save_json(self, file_name):
+        # the report plus the trace of every step and every executor batch
+        trace = self.get_report()
+        trace['step_seconds'] = self._step_seconds
+        trace['batches'] = [{'wall_seconds':wall_seconds, 'busy_seconds':busy_seconds} for wall_seconds, busy_seconds in self._batches]
+        with open(file_name, 'w') as f:
+            json.dump(trace, f, indent=1)
+
+    def get_profile_stats(self):
+        assert self._profiler is not None, "start the instrumentation with profile=True to get the profile!"
+        return pstats.Stats(self._profiler)
+
+    def save_profile(self, file_name):
+        # pstats dump, e.g. for python -m pstats file_name or snakeviz
+        self.get_profile_stats().dump_stats(file_name)
+
+#%%
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from GalaxyDynamicsFromVc.galaxymodel import NFW, Miyamoto_Nagai_disk, Plummer, _halo_derived_quantities
+
+#%%
+
+# Fused evaluation of the chi2 of arrays of models described by a compiled
+# parameter map (see Analysis.compile_fused_kernel). The 'numpy' backend
+# computes every component into preallocated (n_models, n_radii) buffers with
+# out= arguments, in the same order of operations as the potentials, so that it
+# gives exactly the same chi2 as the reference path without allocating any
+# (n_models, n_radii) temporary. The 'numba' backend, available when numba is
+# installed and the model only has NFW, Miyamoto-Nagai and Plummer components,
+# evaluates Vc^2 and accumulates the chi2 radius by radius in a single pass;
+# it agrees with the reference path up to rounding.
+
+def _get_NFW_parameters(Mvir_in_1e11Msun=11.2, cvir=12.8, Delta_vir=200.0, h_cosmo=0.678):
+    rvir_kpc, rs_kpc, mass_factor, density_normalisation, Vc2_normalisation = _halo_derived_quantities(Mvir_in_1e11Msun, cvir, Delta_vir, h_cosmo)
+    return rs_kpc, Vc2_normalisation
+
+def _add_NFW(Vc2, scratch, R_kpc, parameters):
+    # Vc2_normalisation*(1/(x+1) + ln(1+x) - 1)/r, with x = r/rs
+    rs_kpc, Vc2_normalisation = parameters
+    x, term = scratch
+    np.divide(R_kpc, rs_kpc, out=x)
+    np.add(x, 1.0, out=term)
+    np.divide(1.0, term, out=term)
+    np.add(1.0, x, out=x)
+    np.log(x, out=x)
+    np.add(term, x, out=term)
+    np.subtract(term, 1.0, out=term)
+    np.multiply(Vc2_normalisation, term, out=term)
+    np.divide(term, R_kpc, out=term)
+    np.add(Vc2, term, out=Vc2)
+
+def _get_Miyamoto_Nagai_parameters(total_mass_Msun=3.944e10, a_kpc=5.3, b_kpc=0.25, z_kpc=0):
+    return total_mass_Msun/2.32e7, (a_kpc + np.sqrt(z_kpc**2 + b_kpc**2))**2
+
+def _get_Plummer_parameters(total_mass_Msun=1.0672e10, b_kpc=0.3):
+    return total_mass_Msun/2.32e7, b_kpc**2
+
+def _add_Plummer_like(Vc2, scratch, R_kpc, parameters, scaled_R_2, R_2):
+    # 100*G*M*R^2/(R^2 + s)^(3/2), with s = (a + sqrt(z^2 + b^2))^2 for a
+    # Miyamoto-Nagai disk and s = b^2 for a Plummer sphere
+    M, s = parameters
+    numerator, denominator = scratch
+    np.multiply(scaled_R_2, M, out=numerator)
+    np.add(R_2, s, out=denominator)
+    np.power(denominator, 3./2., out=denominator)
+    np.divide(numerator, denominator, out=numerator)
+    np.add(Vc2, numerator, out=Vc2)
+
+# parameters and in-place kernel of every potential with a fused version
+_component_kernels = {
+        NFW.squared_circular_velocity_from_parameters_km2_s2:('NFW', _get_NFW_parameters),
+        Miyamoto_Nagai_disk.squared_circular_velocity_from_parameters_km2_s2:('Plummer_like', _get_Miyamoto_Nagai_parameters),
+        Plummer.squared_circular_velocity_from_parameters_km2_s2:('Plummer_like', _get_Plummer_parameters),
+}
+
+def _fused_chi2_loops(R_kpc, vc_km_s, inverse_variance, NFW_rs, NFW_normalisation, Plummer_like_M, Plummer_like_s, chi2):
+    # single pass over models and radii; compiled with numba.njit when available
+    number_of_models = chi2.shape[0]
+    for k in range(number_of_models):
+        total = 0.0
+        for i in range(R_kpc.shape[0]):
+            r = R_kpc[i]
+            r_2 = r*r
+            Vc2 = 0.0
+            for c in range(NFW_rs.shape[1]):
+                x = r/NFW_rs[k, c]
+                Vc2 += NFW_normalisation[k, c]*(1.0/(x+1.0) + np.log(1.0+x) - 1.0)/r
+            for c in range(Plummer_like_M.shape[1]):
+                Vc2 += 100.0*r_2*Plummer_like_M[k, c]/(r_2 + Plummer_like_s[k, c])**1.5
+            residual = vc_km_s[i] - np.sqrt(Vc2)
+            total += residual*residual*inverse_variance[i]
+        chi2[k] = total
+    return chi2
+
+_numba_kernel = None
+
+def _get_numba_kernel():
+    # None if numba is not installed
+    global _numba_kernel
+    if _numba_kernel is None:
+        try:
+            import numba
+        except ImportError:
+            return None
+        _numba_kernel = numba.njit(cache=True)(_fused_chi2_loops)
+    return _numba_kernel
+
+class Fused_chi2:
+    backends = ('auto', 'numpy', 'numba')
+
+    def __init__(self, compiled_parameter_map, R_kpc, vc_km_s, inverse_variance, backend='auto'):
+        assert backend in self.backends, "backend must be one of {}".format(self.backends)
+        self._components = [(_component_kernels.get(function), function, arguments) for function, arguments, *gradient in compiled_parameter_map]
+        self._R_kpc = np.ascontiguousarray(R_kpc, dtype=float)
+        self._vc_km_s = np.ascontiguousarray(vc_km_s, dtype=float)
+        self._inverse_variance = np.ascontiguousarray(inverse_variance, dtype=float)
+        # same as R_2 and convFactor*R_2*Grav_constant in the potentials
+        self._R_2 = self._R_kpc**2
+        self._scaled_R_2 = 100.0*self._R_2*1
+        self._buffers = (0, None)
+        supported_by_numba = all(kernel is not None for kernel, function, arguments in self._components)
+        if backend == 'numba':
+            assert supported_by_numba, "the numba backend only supports NFW, Miyamoto_Nagai_disk and Plummer components!"
+            assert _get_numba_kernel() is not None, "the numba backend needs numba to be installed!"
+        elif backend == 'auto':
+            backend = 'numba' if supported_by_numba and _get_numba_kernel() is not None else 'numpy'
+        self._backend = backend
+
+    @property
+    def backend(self):
+        return self._backend
+
+    def _get_buffers(self, number_of_models):
+        # Vc^2 and two scratch arrays, kept while the number of models is the same
+        if self._buffers[0] != number_of_models:
+            shape = (number_of_models, len(self._R_kpc))
+            self._buffers = (number_of_models, (np.empty(shape), np.empty(shape), np.empty(shape)))
+        return self._buffers[1]
+
+    def _get_component_parameters(self, array_of_values):
+        # as Analysis._squared_circular_velocity_from_parameter_map, with (n_models, 1) columns
+        a = np.moveaxis(np.asarray(array_of_values, dtype=float), -1, 0)[..., np.newaxis]
+        return [[value if index is None else a[index]*value for index, value in arguments] for kernel, function, arguments in self._components]
+
+    def chi2(self, array_of_values):
+        array_of_values = np.atleast_2d(array_of_values)
+        parameters = self._get_component_parameters(array_of_values)
+        if self.backend == 'numba':
+            return self._chi2_numba(len(array_of_values), parameters)
+        return self._chi2_numpy(len(array_of_values), parameters)
+
+    def _chi2_numpy(self, number_of_models, parameters):
+        Vc2, *scratch = self._get_buffers(number_of_models)
+        Vc2.fill(0.0)
+        for (kernel, function, arguments), component_parameters in zip(self._components, parameters):
+            if kernel is None:
+                np.add(Vc2, function(self._R_kpc, *component_parameters), out=Vc2)
+            elif kernel[0] == 'NFW':
+                _add_NFW(Vc2, scratch, self._R_kpc, kernel[1](*component_parameters))
+            else:
+                _add_Plummer_like(Vc2, scratch, self._R_kpc, kernel[1](*component_parameters), self._scaled_R_2, self._R_2)
+        # (vc - sqrt(Vc^2))^2*inverse_variance, summed over radii
+        np.sqrt(Vc2, out=Vc2)
+        np.subtract(self._vc_km_s, Vc2, out=Vc2)
+        np.square(Vc2, out=Vc2)
+        np.multiply(Vc2, self._inverse_variance, out=Vc2)
+        return np.sum(Vc2, axis=-1)
+
+    def _chi2_numba(self, number_of_models, parameters):
+        columns = {'NFW':([], []), 'Plummer_like':([], [])}
+        for (kernel, function, arguments), component_parameters in zip(self._components, parameters):
+            for column, value in zip(columns[kernel[0]], kernel[1](*component_parameters)):
+                column.append(np.broadcast_to(value, (number_of_models, 1)))
+        NFW_rs, NFW_normalisation, Plummer_like_M, Plummer_like_s = [np.hstack(column) if column else np.zeros((number_of_models, 0))
+                                                                     for name in ('NFW', 'Plummer_like') for column in columns[name]]
+        return _get_numba_kernel()(self._R_kpc, self._vc_km_s, self._inverse_variance, NFW_rs, NFW_normalisation,
+                                   Plummer_like_M, Plummer_like_s, np.empty(number_of_models))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_buffers'] = (0, None)
+        return state
+
+#%%
+if __name__ == '__main__':
+    pass
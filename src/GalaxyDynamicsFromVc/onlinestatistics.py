@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+#%%
+
+# Summaries of a stream of (n_samples, n_dimensions) blocks, e.g. the walkers of
+# every MCMC step, that take constant memory whatever the number of samples.
+
+class Running_moments:
+    # Mean and covariance of every column, merging each block with the pairwise
+    # update of Chan et al. (Welford's algorithm for blocks of samples).
+    def __init__(self, number_of_dimensions):
+        self._number_of_values = 0
+        self._mean = np.zeros(number_of_dimensions)
+        self._sum_of_products_of_deviations = np.zeros((number_of_dimensions, number_of_dimensions))
+
+    @property
+    def number_of_values(self):
+        return self._number_of_values
+
+    @property
+    def mean(self):
+        return self._mean.copy()
+
+    @property
+    def covariance(self):
+        # unbiased estimate, as numpy.cov
+        assert self.number_of_values > 1, "at least two values are needed for the covariance!"
+        return self._sum_of_products_of_deviations/(self.number_of_values - 1)
+
+    @property
+    def std(self):
+        return np.sqrt(np.diag(self.covariance))
+
+    def update(self, block):
+        block = np.atleast_2d(np.asarray(block, dtype=float))
+        assert block.shape[1] == len(self._mean), "blocks must have {} columns!".format(len(self._mean))
+        if len(block) == 0:
+            return
+        block_mean = np.mean(block, axis=0)
+        deviations = block - block_mean
+        delta = block_mean - self._mean
+        total = self.number_of_values + len(block)
+        self._mean += delta*len(block)/total
+        self._sum_of_products_of_deviations += deviations.T @ deviations + np.outer(delta, delta)*self.number_of_values*len(block)/total
+        self._number_of_values = total
+
+class P2_quantiles:
+    # P^2 algorithm (Jain & Chlamtac 1985): every quantile of every column is
+    # tracked with five markers whose heights are adjusted with a piecewise
+    # parabolic interpolation as values arrive. The markers of all quantiles
+    # and columns are updated together, one row at a time.
+    def __init__(self, percentiles, number_of_dimensions):
+        p = np.array(percentiles, dtype=float, ndmin=1)/100.0
+        assert np.all((0.0 < p) & (p < 1.0)), "percentiles must be between 0 and 100!"
+        self._percentiles = 100.0*p
+        shape = (len(p), number_of_dimensions, 5)
+        p = p[:, np.newaxis, np.newaxis]
+        self._heights = np.zeros(shape)
+        self._positions = np.broadcast_to(np.arange(1.0, 6.0), shape).copy()
+        self._desired_positions = np.broadcast_to(np.array([1.0, 1.0, 1.0, 3.0, 5.0]) + np.array([0.0, 2.0, 4.0, 2.0, 0.0])*p, shape).copy()
+        self._increments = np.broadcast_to(np.array([0.0, 0.0, 0.0, 0.5, 1.0]) + np.array([0.0, 0.5, 1.0, 0.5, 0.0])*p, shape)
+        self._first_values = []
+        self._number_of_values = 0
+
+    @property
+    def percentiles(self):
+        return self._percentiles
+
+    @property
+    def number_of_values(self):
+        return self._number_of_values
+
+    def update(self, block):
+        for values in np.atleast_2d(np.asarray(block, dtype=float)):
+            self._add(values)
+
+    def _add(self, values):
+        self._number_of_values += 1
+        if self.number_of_values <= 5:
+            self._first_values.append(values)
+            if self.number_of_values == 5:
+                self._heights[:] = np.sort(self._first_values, axis=0).T
+            return
+        q, n = self._heights, self._positions
+        x = np.broadcast_to(values, q.shape[:2])
+        cell = np.sum(x[..., np.newaxis] >= q[..., 1:4], axis=-1)
+        q[..., 0] = np.minimum(q[..., 0], x)
+        q[..., 4] = np.maximum(q[..., 4], x)
+        n += np.arange(5) > cell[..., np.newaxis]
+        self._desired_positions += self._increments
+        for i in (1, 2, 3):
+            d = self._desired_positions[..., i] - n[..., i]
+            step = np.where((d >= 1.0) & (n[..., i+1] - n[..., i] > 1.0), 1.0,
+                            np.where((d <= -1.0) & (n[..., i-1] - n[..., i] < -1.0), -1.0, 0.0))
+            if not step.any():
+                continue
+            q_below, q_i, q_above = q[..., i-1], q[..., i].copy(), q[..., i+1]
+            n_below, n_i, n_above = n[..., i-1], n[..., i].copy(), n[..., i+1]
+            parabolic = q_i + step/(n_above - n_below)*((n_i - n_below + step)*(q_above - q_i)/(n_above - n_i)
+                                                        + (n_above - n_i - step)*(q_i - q_below)/(n_i - n_below))
+            linear = q_i + step*(np.where(step > 0, q_above, q_below) - q_i)/(np.where(step > 0, n_above, n_below) - n_i)
+            new_heights = np.where((q_below < parabolic) & (parabolic < q_above), parabolic, linear)
+            q[..., i] = np.where(step != 0.0, new_heights, q_i)
+            n[..., i] = n_i + step
+
+    def get_quantiles(self):
+        # (n_percentiles, n_dimensions); exact percentiles of the first five values
+        assert self.number_of_values > 0, "no values were added!"
+        if self.number_of_values < 5:
+            return np.percentile(self._first_values, self.percentiles, axis=0)
+        return self._heights[..., 2].copy()
+
+class Binned_percentiles:
+    # Percentiles of every column of a stream of (n_rows, n_columns) blocks,
+    # read from histograms of number_of_bins bins spanning the given minimum
+    # and maximum of each column. The error of each percentile is below the
+    # width of one bin, (maximum-minimum)/number_of_bins. Values outside the
+    # range are only counted, as below or above it.
+    def __init__(self, minimum, maximum, number_of_bins=1000):
+        assert isinstance(number_of_bins, int) and number_of_bins > 0, "number_of_bins must be a positive int!"
+        self._minimum = np.array(minimum, dtype=float, ndmin=1)
+        self._maximum = np.array(maximum, dtype=float, ndmin=1)
+        assert self._minimum.shape == self._maximum.shape, "minimum and maximum must have the same shape!"
+        assert np.all(self._minimum <= self._maximum), "minimum must not be larger than maximum!"
+        self._number_of_bins = number_of_bins
+        self._bin_width = (self._maximum - self._minimum)/number_of_bins
+        self._counts = np.zeros((len(self._minimum), number_of_bins), dtype=np.int64)
+        self._number_below = np.zeros(len(self._minimum), dtype=np.int64)
+        self._number_above = np.zeros(len(self._minimum), dtype=np.int64)
+        self._number_of_values = 0
+
+    @property
+    def minimum(self):
+        return self._minimum
+
+    @property
+    def maximum(self):
+        return self._maximum
+
+    @property
+    def number_of_bins(self):
+        return self._number_of_bins
+
+    @property
+    def bin_width(self):
+        return self._bin_width
+
+    @property
+    def edges(self):
+        return self._minimum[:, np.newaxis] + np.arange(self.number_of_bins+1)*self._bin_width[:, np.newaxis]
+
+    @property
+    def counts(self):
+        return self._counts
+
+    @property
+    def number_below(self):
+        return self._number_below
+
+    @property
+    def number_above(self):
+        # NaN values are counted as above the range
+        return self._number_above
+
+    @property
+    def number_of_values(self):
+        return self._number_of_values
+
+    def _get_bins(self, block):
+        # bin of every value and whether it is inside the range
+        below = block < self._minimum
+        inside = (block >= self._minimum) & (block <= self._maximum)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bins = np.floor((block - self._minimum)/self._bin_width)
+        bins = np.clip(np.nan_to_num(bins, nan=0.0, posinf=0.0, neginf=0.0), 0, self.number_of_bins-1).astype(np.int64)
+        return bins, inside, below
+
+    def add(self, block):
+        block = np.atleast_2d(block)
+        assert block.shape[1] == len(self._minimum), "blocks must have one column per minimum and maximum!"
+        bins, inside, below = self._get_bins(block)
+        bins += np.arange(block.shape[1])*self.number_of_bins
+        self._counts += np.bincount(bins[inside], minlength=self._counts.size).reshape(self._counts.shape)
+        self._number_below += np.sum(below, axis=0)
+        self._number_above += np.sum(~(inside | below), axis=0)
+        self._number_of_values += len(block)
+
+    def get_percentiles(self, percentiles):
+        # linear interpolation of the cumulative histogram within each bin;
+        # percentiles falling outside the range are given its limits
+        assert self.number_of_values > 0, "no values were added!"
+        percentiles = np.array(percentiles, dtype=float, ndmin=1)
+        cumulative_counts = self._number_below[:, np.newaxis] + np.cumsum(self._counts, axis=1)
+        columns = np.arange(len(self._minimum))
+        results = np.empty((len(percentiles), len(columns)))
+        for k, percentile in enumerate(percentiles):
+            target = percentile/100.0*self.number_of_values
+            bins = np.minimum(np.sum(cumulative_counts < target, axis=1), self.number_of_bins-1)
+            counts_below = np.where(bins > 0, cumulative_counts[columns, bins-1], self._number_below)
+            counts_in_bin = self._counts[columns, bins]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                fraction = np.where(counts_in_bin > 0, (target - counts_below)/counts_in_bin, 0.0)
+            fraction = np.where(cumulative_counts[:, -1] < target, 1.0, fraction)
+            results[k] = self._minimum + (bins + np.clip(fraction, 0.0, 1.0))*self._bin_width
+        return results
+
+class Histograms_2d(Binned_percentiles):
+    # Histograms of every pair of columns (i, j) with i < j, on the bins of
+    # Binned_percentiles. Values outside the range of either column are skipped.
+    def __init__(self, minimum, maximum, number_of_bins=50):
+        super().__init__(minimum, maximum, number_of_bins=number_of_bins)
+        self._pairs = np.triu_indices(len(self._minimum), 1)
+        self._pair_counts = np.zeros((len(self._pairs[0]), number_of_bins, number_of_bins), dtype=np.int64)
+
+    def add(self, block):
+        block = np.atleast_2d(block)
+        super().add(block)
+        bins, inside, below = self._get_bins(block)
+        first, second = self._pairs
+        pair_bins = (np.arange(len(first))*self.number_of_bins + bins[:, first])*self.number_of_bins + bins[:, second]
+        pair_inside = inside[:, first] & inside[:, second]
+        self._pair_counts += np.bincount(pair_bins[pair_inside], minlength=self._pair_counts.size).reshape(self._pair_counts.shape)
+
+    def get_counts(self, i, j):
+        # (number_of_bins, number_of_bins) counts, first index along column i
+        assert i != j, "i and j must be different columns!"
+        pair = np.flatnonzero((self._pairs[0] == min(i, j)) & (self._pairs[1] == max(i, j)))[0]
+        return self._pair_counts[pair] if i < j else self._pair_counts[pair].T
+
+class Posterior_summary:
+    # Running mean and covariance, quantiles and 1D/2D histograms of the samples
+    # of a chain. Quantiles come from fine 1D histograms (quantile_method=
+    # 'histogram', accurate to a fraction of their bin width) or from the P^2
+    # algorithm ('P2', free of ranges but slower, as it goes row by row). The
+    # ranges of the histograms are either given or set by the first block of
+    # samples, widened by range_margin times its span on each side.
+    _quantile_methods = ('histogram', 'P2')
+
+    def __init__(self, number_of_dimensions, variable_names=None, percentiles=(2.5, 16.0, 50.0, 84.0, 97.5),
+                 number_of_bins=50, number_of_quantile_bins=2000, minimum=None, maximum=None, range_margin=1.0,
+                 quantile_method='histogram'):
+        if variable_names is not None:
+            assert len(variable_names) == number_of_dimensions, "there must be a variable name per dimension!"
+        assert quantile_method in self._quantile_methods, "quantile_method must be one of {}".format(self._quantile_methods)
+        self._number_of_dimensions = number_of_dimensions
+        self._variable_names = list(variable_names) if variable_names is not None else None
+        self._percentiles = np.array(percentiles, dtype=float, ndmin=1)
+        self._running_moments = Running_moments(number_of_dimensions)
+        self._quantile_method = quantile_method
+        self._P2_quantiles = P2_quantiles(percentiles, number_of_dimensions) if quantile_method == 'P2' else None
+        self._number_of_bins = number_of_bins
+        self._number_of_quantile_bins = number_of_quantile_bins
+        self._range_margin = range_margin
+        self._histograms_1d = None
+        self._histograms_2d = None
+        if minimum is not None and maximum is not None:
+            self._create_histograms(minimum, maximum)
+
+    def _create_histograms(self, minimum, maximum):
+        self._histograms_1d = Binned_percentiles(minimum, maximum, number_of_bins=self._number_of_quantile_bins)
+        self._histograms_2d = Histograms_2d(minimum, maximum, number_of_bins=self._number_of_bins)
+
+    @property
+    def number_of_dimensions(self):
+        return self._number_of_dimensions
+
+    @property
+    def variable_names(self):
+        return self._variable_names
+
+    @property
+    def number_of_samples(self):
+        return self._running_moments.number_of_values
+
+    @property
+    def running_moments(self):
+        return self._running_moments
+
+    @property
+    def mean(self):
+        return self._running_moments.mean
+
+    @property
+    def covariance(self):
+        return self._running_moments.covariance
+
+    @property
+    def std(self):
+        return self._running_moments.std
+
+    @property
+    def percentiles(self):
+        return self._percentiles
+
+    @property
+    def quantile_method(self):
+        return self._quantile_method
+
+    @property
+    def histograms_1d(self):
+        return self._histograms_1d
+
+    @property
+    def histograms_2d(self):
+        return self._histograms_2d
+
+    def get_quantiles(self):
+        # (n_percentiles, n_dimensions)
+        if self.quantile_method == 'P2':
+            return self._P2_quantiles.get_quantiles()
+        assert self._histograms_1d is not None, "no samples were added!"
+        return self._histograms_1d.get_percentiles(self.percentiles)
+
+    def update(self, samples):
+        samples = np.atleast_2d(np.asarray(samples, dtype=float))
+        assert samples.shape[1] == self.number_of_dimensions, "samples must have {} columns!".format(self.number_of_dimensions)
+        if len(samples) == 0:
+            return
+        if self._histograms_1d is None:
+            minimum, maximum = np.min(samples, axis=0), np.max(samples, axis=0)
+            span = np.where(maximum > minimum, maximum - minimum, np.maximum(np.abs(minimum), 1.0))
+            self._create_histograms(minimum - self._range_margin*span, maximum + self._range_margin*span)
+        self._running_moments.update(samples)
+        if self._P2_quantiles is not None:
+            self._P2_quantiles.update(samples)
+        self._histograms_1d.add(samples)
+        self._histograms_2d.add(samples)
+
+    def update_from_chains(self, chains, discard=0, thin=1, steps_per_block=1000):
+        # chains is a (walkers, steps, dimensions) array, e.g. memory-mapped from
+        # Chain_storage or Stored_results, read steps_per_block steps at a time
+        number_of_steps = np.shape(chains)[1]
+        for start in range(discard, number_of_steps, steps_per_block*thin):
+            block = np.asarray(chains[:, start:min(start+steps_per_block*thin, number_of_steps):thin])
+            self.update(block.reshape((-1, self.number_of_dimensions)))
+
+    def get_table(self):
+        return {
+                'variable_names':self.variable_names,
+                'number_of_samples':self.number_of_samples,
+                'mean':self.mean,
+                'std':self.std,
+                'percentiles':self.percentiles,
+                'quantiles':self.get_quantiles(),
+                'number_outside_histograms':self._histograms_1d.number_below + self._histograms_1d.number_above,
+        }
+
+#%%
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+import os
+import copy
+import time
+import threading
+import multiprocessing
+import concurrent.futures
+import numpy as np
+
+#%%
+
+# Each worker process keeps its own reference to the Analysis, set once by the
+# pool initializer. With the default 'fork' start method on Linux the Analysis
+# (and its read-only data arrays) is inherited from the parent process without
+# being pickled; tasks only carry arrays of parameter values.
+_worker_analysis = None
+
+def _initialise_worker(analysis):
+    global _worker_analysis
+    _worker_analysis = analysis
+
+def _ln_likelihood_vectorized_in_worker(array_of_values):
+    return _worker_analysis.ln_likelihood_vectorized(array_of_values)
+
+def _call_with_worker_analysis(function_and_item):
+    function, item = function_and_item
+    return function(_worker_analysis, item)
+
+def _ln_likelihood_vectorized_of_chunk(analysis, array_of_values):
+    return analysis.ln_likelihood_vectorized(array_of_values)
+
+# environment variables with the number of cores granted by batch schedulers
+_scheduler_core_variables = ('SLURM_CPUS_PER_TASK', 'NSLOTS')
+
+def get_number_of_available_cores():
+    try:
+        number_of_cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        number_of_cores = os.cpu_count()
+    for variable in _scheduler_core_variables:
+        if os.environ.get(variable, '').isdigit() and int(os.environ[variable]) > 0:
+            number_of_cores = min(number_of_cores, int(os.environ[variable]))
+    return number_of_cores
+
+def split_in_chunks(array_of_values, number_of_chunks=None, chunksize=None):
+    a = np.atleast_2d(array_of_values)
+    if chunksize is None:
+        chunksize = -(-len(a)//max(1, number_of_chunks))
+    return [a[k:k+chunksize] for k in range(0, len(a), max(1, chunksize))]
+
+# All executors share the interface of Process_pool: ln_likelihood_vectorized,
+# map(function(analysis, item), iterable) and close, with processes being the
+# number of workers.
+
+class Serial_executor:
+    # runs everything in the calling process, with no start-up or IPC costs
+    def __init__(self, analysis, processes=1, chunksize=None):
+        self._analysis = analysis
+        self._chunksize = chunksize
+
+    @property
+    def processes(self):
+        return 1
+
+    @property
+    def chunksize(self):
+        return self._chunksize
+
+    def ln_likelihood_vectorized(self, array_of_values):
+        return self._analysis.ln_likelihood_vectorized(array_of_values)
+
+    def map(self, function, iterable):
+        return [function(self._analysis, item) for item in iterable]
+
+    def close(self):
+        self._analysis = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class _Executor_with_workers:
+    def __init__(self, processes=None, chunksize=None):
+        if processes is None:
+            processes = get_number_of_available_cores()
+        assert isinstance(processes, int) and processes > 0, "processes must be a positive int!"
+        if chunksize is not None:
+            assert isinstance(chunksize, int) and chunksize > 0, "chunksize must be a positive int!"
+        self._processes = processes
+        self._chunksize = chunksize
+
+    @property
+    def processes(self):
+        return self._processes
+
+    @property
+    def chunksize(self):
+        return self._chunksize
+
+    def _split_in_chunks(self, array_of_values):
+        return split_in_chunks(array_of_values, number_of_chunks=self.processes, chunksize=self.chunksize)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class Thread_pool(_Executor_with_workers):
+    # Threads only run in parallel while NumPy releases the GIL, i.e. for large
+    # arrays of walkers or radii. Each thread works on its own copy of the
+    # Analysis, because galaxy_model_creator goes through the shared Variables.
+    def __init__(self, analysis, processes=None, chunksize=None):
+        super().__init__(processes, chunksize)
+        self._local = threading.local()
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.processes, initializer=self._initialise_thread, initargs=(analysis,))
+
+    def _initialise_thread(self, analysis):
+        self._local.analysis = copy.deepcopy(analysis)
+
+    def _call_with_thread_analysis(self, function, item):
+        return function(self._local.analysis, item)
+
+    def ln_likelihood_vectorized(self, array_of_values):
+        return np.concatenate(self.map(_ln_likelihood_vectorized_of_chunk, self._split_in_chunks(array_of_values)))
+
+    def map(self, function, iterable):
+        items = list(iterable)
+        return list(self._executor.map(self._call_with_thread_analysis, [function]*len(items), items))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+class Process_pool(_Executor_with_workers):
+    def __init__(self, analysis, processes=None, chunksize=None):
+        super().__init__(processes, chunksize)
+        self._pool = multiprocessing.Pool(self.processes, initializer=_initialise_worker, initargs=(analysis,))
+
+    def ln_likelihood_vectorized(self, array_of_values):
+        chunks = self._split_in_chunks(array_of_values)
+        return np.concatenate(self._pool.map(_ln_likelihood_vectorized_in_worker, chunks, chunksize=1))
+
+    def map(self, function, iterable):
+        # function must be defined at module level and accept (analysis, item)
+        return self._pool.map(_call_with_worker_analysis, [(function, item) for item in iterable], chunksize=1)
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+def _run_cluster_rank(analysis, connection):
+    # loop of a worker rank: receives (function, items), sends back the results
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        function, items = message
+        try:
+            connection.send((True, [function(analysis, item) for item in items]))
+        except Exception as error:
+            connection.send((False, error))
+    connection.close()
+
+class Local_cluster(_Executor_with_workers):
+    # Stand-in for an MPI communicator on a single machine: long-lived worker
+    # ranks, each with its own copy of the Analysis, receive their share of the
+    # work through a pipe (scatter) and send back their results (gather).
+    def __init__(self, analysis, processes=None, chunksize=None):
+        super().__init__(processes, chunksize)
+        self._connections = []
+        self._ranks = []
+        for rank in range(self.processes):
+            connection, rank_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_run_cluster_rank, args=(analysis, rank_connection), daemon=True)
+            process.start()
+            rank_connection.close()
+            self._connections.append(connection)
+            self._ranks.append(process)
+
+    def scatter_gather(self, function, items):
+        # item k goes to rank k % processes; the results keep the order of items
+        items = list(items)
+        for rank, connection in enumerate(self._connections):
+            connection.send((function, items[rank::self.processes]))
+        results = [None]*len(items)
+        errors = []
+        for rank, connection in enumerate(self._connections):
+            succeeded, value = connection.recv()
+            if succeeded:
+                results[rank::self.processes] = value
+            else:
+                errors.append(value)
+        if errors:
+            raise errors[0]
+        return results
+
+    def ln_likelihood_vectorized(self, array_of_values):
+        return np.concatenate(self.scatter_gather(_ln_likelihood_vectorized_of_chunk, self._split_in_chunks(array_of_values)))
+
+    def map(self, function, iterable):
+        return self.scatter_gather(function, iterable)
+
+    def close(self):
+        for connection, process in zip(self._connections, self._ranks):
+            try:
+                connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+            connection.close()
+        self._connections = []
+        self._ranks = []
+
+executor_classes = {
+        'serial':Serial_executor,
+        'thread':Thread_pool,
+        'process':Process_pool,
+        'cluster':Local_cluster,
+}
+
+def create_executor(executor, analysis, processes=None, chunksize=None):
+    assert executor in executor_classes, "executor must be one of {}".format(list(executor_classes))
+    return executor_classes[executor](analysis, processes=processes, chunksize=chunksize)
+
+def choose_executor(analysis, number_of_walkers=32, executors=('serial', 'thread', 'process'), processes=None, chunksize=None, repeat=3):
+    # Timing probe: evaluates the likelihood of number_of_walkers positions drawn
+    # around the current values with every executor and keeps the fastest one.
+    # Returns the executor and the best time of each kind.
+    current_values = analysis.get_current_values()
+    positions = analysis.prior_table.sample(number_of_walkers, random_state=0, fallback_values=current_values)
+    positions = 0.5*(positions + current_values)
+    timings = {}
+    best_executor = None
+    for executor in executors:
+        candidate = create_executor(executor, analysis, processes=processes, chunksize=chunksize)
+        candidate.ln_likelihood_vectorized(positions) # warm-up
+        times = []
+        for k in range(repeat):
+            start = time.perf_counter()
+            candidate.ln_likelihood_vectorized(positions)
+            times.append(time.perf_counter() - start)
+        timings[executor] = min(times)
+        if best_executor is None or timings[executor] < timings[best_executor[0]]:
+            if best_executor is not None:
+                best_executor[1].close()
+            best_executor = (executor, candidate)
+        else:
+            candidate.close()
+    return best_executor[1], timings
+
+#%%
+if __name__ == '__main__':
+    pass
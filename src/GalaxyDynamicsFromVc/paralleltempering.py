@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+#%%
+
+# Parallel tempering: one ensemble of walkers per inverse temperature beta,
+# each sampling prior*likelihood^beta with the affine-invariant stretch move of
+# emcee, plus swaps of walkers between neighbouring temperatures after every
+# step. The hot ensembles cross the barriers between modes and hand their
+# walkers down to beta = 1, the posterior. The proposals of all temperatures
+# are evaluated together, so one call of ln_priors_and_ln_likelihoods (e.g.
+# through the worker pool) serves the whole ladder.
+
+def get_temperature_ladder(number_of_temperatures, number_of_dimensions, maximum_temperature=None):
+    # inverse temperatures 1 > beta_1 > ... > beta_(n-1), geometric in the
+    # temperature; without maximum_temperature the ratio between neighbours is
+    # 1 + sqrt(2/number_of_dimensions), which keeps the swap acceptance roughly
+    # constant for Gaussian-like posteriors
+    assert number_of_temperatures > 0, "number_of_temperatures must be positive!"
+    if maximum_temperature is None:
+        ratio = 1.0 + np.sqrt(2.0/number_of_dimensions)
+    else:
+        assert maximum_temperature >= 1.0, "maximum_temperature must be at least 1!"
+        ratio = maximum_temperature**(1.0/max(1, number_of_temperatures - 1))
+    return 1.0/ratio**np.arange(number_of_temperatures)
+
+class Parallel_tempering_sampler:
+    def __init__(self, number_of_walkers, number_of_dimensions, ln_priors_and_ln_likelihoods, betas, random_state=None, stretch_scale=2.0):
+        # ln_priors_and_ln_likelihoods(array of shape (n, number_of_dimensions))
+        # returns the ln priors and the ln likelihoods of the data (0 is fine
+        # where the prior is -inf); the ensemble at betas[0] = 1 is the posterior
+        betas = np.array(betas, dtype=float, ndmin=1)
+        assert number_of_walkers % 2 == 0 and number_of_walkers >= 4, "number_of_walkers must be even and at least 4!"
+        assert betas[0] == 1.0 and np.all(np.diff(betas) < 0.0) and betas[-1] > 0.0, "betas must decrease from 1 and be positive!"
+        self._number_of_walkers = number_of_walkers
+        self._number_of_dimensions = number_of_dimensions
+        self._ln_priors_and_ln_likelihoods = ln_priors_and_ln_likelihoods
+        self._betas = betas
+        self._random_state = np.random.RandomState(random_state) if not isinstance(random_state, np.random.RandomState) else random_state
+        self._stretch_scale = stretch_scale
+        self._positions = None
+        self.reset()
+
+    @property
+    def betas(self):
+        return self._betas
+
+    @property
+    def number_of_temperatures(self):
+        return len(self._betas)
+
+    @property
+    def iteration(self):
+        return self._iteration
+
+    @property
+    def positions(self):
+        # (temperatures, walkers, dimensions)
+        return self._positions
+
+    @property
+    def number_of_likelihood_evaluations(self):
+        return self._number_of_likelihood_evaluations
+
+    @property
+    def acceptance_fractions(self):
+        # (temperatures, walkers)
+        return self._accepted/max(1, self.iteration)
+
+    @property
+    def acceptance_fraction(self):
+        # of the walkers at beta = 1, as emcee's
+        return self.acceptance_fractions[0]
+
+    @property
+    def swap_acceptance_fractions(self):
+        # between the temperatures k and k+1
+        return self._swaps_accepted/np.maximum(1, self._swaps_proposed)
+
+    def reset(self):
+        # forgets the chain and the statistics, but not the current positions
+        self._iteration = 0
+        self._chain = np.empty((0, self._number_of_walkers, self._number_of_dimensions))
+        self._log_prob = np.empty((0, self._number_of_walkers))
+        self._accepted = np.zeros((self.number_of_temperatures, self._number_of_walkers))
+        self._swaps_accepted = np.zeros(self.number_of_temperatures - 1)
+        self._swaps_proposed = np.zeros(self.number_of_temperatures - 1)
+        self._number_of_likelihood_evaluations = 0
+
+    def _evaluate(self, positions):
+        shape = positions.shape[:-1]
+        ln_priors, ln_likelihoods = self._ln_priors_and_ln_likelihoods(positions.reshape((-1, self._number_of_dimensions)))
+        self._number_of_likelihood_evaluations += len(ln_priors)
+        ln_priors = np.reshape(ln_priors, shape)
+        ln_likelihoods = np.where(np.isfinite(ln_priors), np.reshape(ln_likelihoods, shape), 0.0)
+        ln_priors = np.where(np.isnan(ln_likelihoods), -np.infty, ln_priors)
+        return ln_priors, np.nan_to_num(ln_likelihoods, nan=0.0)
+
+    def _set_initial_positions(self, initial_positions):
+        positions = np.array(initial_positions, dtype=float)
+        if positions.ndim == 2:
+            positions = np.broadcast_to(positions, (self.number_of_temperatures,) + positions.shape).copy()
+        assert positions.shape == (self.number_of_temperatures, self._number_of_walkers, self._number_of_dimensions), "initial_positions must have shape (walkers, dimensions) or (temperatures, walkers, dimensions)!"
+        self._positions = positions
+        self._ln_priors, self._ln_likelihoods = self._evaluate(positions)
+        assert np.all(np.isfinite(self._ln_priors)), "all the initial positions must be inside the priors!"
+
+    def _stretch_move(self):
+        rng = self._random_state
+        a = self._stretch_scale
+        number_of_temperatures = self.number_of_temperatures
+        half = self._number_of_walkers//2
+        betas = self.betas[:, np.newaxis]
+        temperatures = np.arange(number_of_temperatures)[:, np.newaxis]
+        for moving, complementary in ((slice(0, half), slice(half, None)), (slice(half, None), slice(0, half))):
+            positions = self._positions[:, moving]
+            partners = self._positions[:, complementary][temperatures, rng.randint(half, size=(number_of_temperatures, half))]
+            z = ((a - 1.0)*rng.rand(number_of_temperatures, half) + 1.0)**2/a
+            proposals = partners + z[..., np.newaxis]*(positions - partners)
+            ln_priors, ln_likelihoods = self._evaluate(proposals)
+            with np.errstate(invalid='ignore'):
+                ln_acceptance = ((self._number_of_dimensions - 1)*np.log(z) + ln_priors + betas*ln_likelihoods
+                                 - self._ln_priors[:, moving] - betas*self._ln_likelihoods[:, moving])
+            accepted = np.log(rng.rand(number_of_temperatures, half)) < ln_acceptance
+            self._positions[:, moving][accepted] = proposals[accepted]
+            self._ln_priors[:, moving][accepted] = ln_priors[accepted]
+            self._ln_likelihoods[:, moving][accepted] = ln_likelihoods[accepted]
+            self._accepted[:, moving] += accepted
+
+    def _swap_temperatures(self):
+        # pairs of random walkers of neighbouring temperatures exchange places with
+        # probability min(1, exp((beta_k - beta_(k+1))*(lnL_(k+1) - lnL_k)))
+        rng = self._random_state
+        for k in range(self.number_of_temperatures - 2, -1, -1):
+            walkers_k = rng.permutation(self._number_of_walkers)
+            walkers_k1 = rng.permutation(self._number_of_walkers)
+            ln_acceptance = (self.betas[k] - self.betas[k+1])*(self._ln_likelihoods[k+1, walkers_k1] - self._ln_likelihoods[k, walkers_k])
+            swapped = np.log(rng.rand(self._number_of_walkers)) < ln_acceptance
+            walkers_k, walkers_k1 = walkers_k[swapped], walkers_k1[swapped]
+            for values in (self._positions, self._ln_priors, self._ln_likelihoods):
+                values[k, walkers_k], values[k+1, walkers_k1] = values[k+1, walkers_k1], values[k, walkers_k]
+            self._swaps_accepted[k] += np.count_nonzero(swapped)
+            self._swaps_proposed[k] += self._number_of_walkers
+
+    def run_mcmc(self, initial_positions, number_of_steps):
+        # initial_positions of shape (walkers, dimensions), the same for every
+        # temperature, or (temperatures, walkers, dimensions); None continues
+        # from the current positions. Returns the positions of all temperatures.
+        if initial_positions is not None:
+            self._set_initial_positions(initial_positions)
+        assert self._positions is not None, "initial_positions are needed in the first run!"
+        chain = np.empty((number_of_steps, self._number_of_walkers, self._number_of_dimensions))
+        log_prob = np.empty((number_of_steps, self._number_of_walkers))
+        for step in range(number_of_steps):
+            self._stretch_move()
+            self._swap_temperatures()
+            chain[step] = self._positions[0]
+            log_prob[step] = self._ln_priors[0] + self._ln_likelihoods[0]
+            self._iteration += 1
+        self._chain = np.concatenate((self._chain, chain))
+        self._log_prob = np.concatenate((self._log_prob, log_prob))
+        return self.positions
+
+    def get_chain(self, flat=False, thin=1, discard=0):
+        # chain at beta = 1, (steps, walkers, dimensions) as emcee's
+        chain = self._chain[discard::thin]
+        return chain.reshape((-1, self._number_of_dimensions)) if flat else chain
+
+    def get_log_prob(self, flat=False, thin=1, discard=0):
+        log_prob = self._log_prob[discard::thin]
+        return log_prob.reshape(-1) if flat else log_prob
+
+    @property
+    def chain(self):
+        # chain at beta = 1, (walkers, steps, dimensions) as emcee's (used by pickle_results)
+        return np.swapaxes(self._chain, 0, 1)
+
+    @property
+    def lnprobability(self):
+        # (walkers, steps)
+        return np.swapaxes(self._log_prob, 0, 1)
+
+    def get_report(self):
+        return {
+                'betas':self.betas.tolist(),
+                'number_of_steps':self.iteration,
+                'number_of_likelihood_evaluations':self.number_of_likelihood_evaluations,
+                'mean_acceptance_fractions':np.mean(self.acceptance_fractions, axis=1).tolist(),
+                'swap_acceptance_fractions':self.swap_acceptance_fractions.tolist(),
+        }
+
+#%%
+if __name__ == '__main__':
+    pass
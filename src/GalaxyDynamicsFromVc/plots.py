@@ -1,16 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import numpy as np
 import matplotlib.pyplot as plt
 import corner
 
 #%%
 
-def plot_lnlikelihoods(lnlikelihood_lists, saved_figure_name='', **kwargs):
+def plot_lnlikelihoods(lnlikelihood_lists, saved_figure_name='', discard=0, thin=1, **kwargs):
+    # lnlikelihood_lists can be a memory-mapped array: only the plotted steps are read
     plt.xlabel("Step")
     plt.ylabel("ln likelihood")
-    number_of_steps = len(lnlikelihood_lists[0])
-    for lnlikelihood in lnlikelihood_lists:
-        plt.plot([k for k in range(number_of_steps)], lnlikelihood, **kwargs)
+    lnlikelihoods = np.asarray(lnlikelihood_lists)[:, discard::thin]
+    steps = np.arange(discard, np.shape(lnlikelihood_lists)[1], thin)
+    plt.plot(steps, lnlikelihoods.T, **kwargs)
     if saved_figure_name:
         plt.savefig(saved_figure_name)
 
@@ -22,11 +24,49 @@ def plot_acceptance_fraction(acceptance_fraction_list, saved_figure_name='', **k
     if saved_figure_name:
         plt.savefig(saved_figure_name)
     
-def plot_corner_plot(chains, variable_labels,**kwargs):
+def plot_corner_plot(chains, variable_labels, discard=0, thin=1, **kwargs):
     number_of_dimensions = len(variable_labels)
-    samples = chains.reshape((-1,number_of_dimensions))
+    samples = chains[:, discard::thin].reshape((-1,number_of_dimensions))
     fig = corner.corner(samples,labels=variable_labels,**kwargs)
 
+def plot_corner_plot_from_summary(summary, variable_labels=None, saved_figure_name='', show_quantiles=True, cmap='Greys', **kwargs):
+    # corner-style plot from the histograms of an onlinestatistics.Posterior_summary,
+    # without the samples: 1D histograms in the diagonal, 2D ones below it
+    histograms = summary.histograms_2d
+    assert histograms is not None, "the summary has no samples!"
+    number_of_dimensions = summary.number_of_dimensions
+    if variable_labels is None:
+        variable_labels = summary.variable_names
+    edges = histograms.edges
+    quantiles = summary.get_quantiles()
+    fig, axes = plt.subplots(number_of_dimensions, number_of_dimensions, squeeze=False,
+                             figsize=(2.0*number_of_dimensions, 2.0*number_of_dimensions), **kwargs)
+    for i in range(number_of_dimensions):
+        for j in range(number_of_dimensions):
+            ax = axes[i, j]
+            if j > i:
+                ax.set_axis_off()
+                continue
+            if i == j:
+                ax.step(edges[i], np.append(histograms.counts[i], histograms.counts[i][-1]), where='post', color='k')
+                ax.set_yticks([])
+                if show_quantiles:
+                    for value in quantiles[:, i]:
+                        ax.axvline(value, color='k', linestyle='--', linewidth=0.8)
+            else:
+                ax.pcolormesh(edges[j], edges[i], histograms.get_counts(i, j), cmap=cmap)
+            if i < number_of_dimensions-1:
+                ax.set_xticklabels([])
+            elif variable_labels is not None:
+                ax.set_xlabel(variable_labels[j])
+            if 0 < j < i or (j == 0 and i == 0):
+                ax.set_yticklabels([])
+            elif j == 0 and variable_labels is not None:
+                ax.set_ylabel(variable_labels[i])
+    if saved_figure_name:
+        plt.savefig(saved_figure_name)
+    return fig
+
 #%%
 if __name__ == '__main__':
     pass
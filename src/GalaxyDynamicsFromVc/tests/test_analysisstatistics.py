@@ -4,6 +4,8 @@ import numpy as np
 
 from .. import analysisstatistics
 from .. import galaxymodel
+from .. import datahandling
+from .. import onlinestatistics
 
 #%%
 def test_class_Prior():
@@ -152,7 +154,539 @@ def test_class_Analysis_ill_input_galaxy_model_creator(capfd, list_of_variables)
     except TypeError:
         out, err = capfd.readouterr()
         assert "ADVISE: Check that the your galaxy_model_creator accepts a dictionary as its only positional argument" in out
-    
-    
-    
-    
+
+#%%
+
+@pytest.fixture
+def halo_and_disk_analysis():
+    list_of_variables = [
+        analysisstatistics.Variable('Mvir_1e11Msun', prior_function=analysisstatistics.Prior(flat_min=0.0,flat_max=1.0e3).ln_function, value=7.05),
+        analysisstatistics.Variable('cvir', prior_function=analysisstatistics.Prior(flat_min=1.0e-3,flat_max=100.0).ln_function, value=11.5),
+        analysisstatistics.Variable('Mdisk_1e10Msun', prior_function=analysisstatistics.Prior(flat_min=0.1,flat_max=1.0e2,Gaussian_mean=3.9,Gaussian_sigma=0.6).ln_function, value=3.9),
+        analysisstatistics.Variable('Rd_kpc', prior_function=analysisstatistics.Prior(flat_min=0.01,flat_max=10.0).ln_function, value=5.3),
+    ]
+    def galaxy_model_creator(d):
+        halo = galaxymodel.NFW(Mvir_in_1e11Msun=d['Mvir_1e11Msun'].value, cvir=d['cvir'].value)
+        disk = galaxymodel.Miyamoto_Nagai_disk(total_mass_Msun=d['Mdisk_1e10Msun'].value*1.0e10, a_kpc=d['Rd_kpc'].value)
+        return galaxymodel.Galactic_model(halo, disk)
+    return analysisstatistics.Analysis(list_of_variables, galaxy_model_creator)
+
+@pytest.fixture
+def walkers_positions():
+    rng = np.random.RandomState(7)
+    positions = np.array([7.05, 11.5, 3.9, 5.3, 8.122]) + 0.05*rng.randn(6,5)
+    positions[1,0] = -1.0 # out of the flat prior of Mvir
+    return positions
+
+def test_Analysis_ln_likelihood_vectorized_equals_scalar(halo_and_disk_analysis, walkers_positions):
+    analysis = halo_and_disk_analysis
+    ln_likelihoods = analysis.ln_likelihood_vectorized(walkers_positions)
+    assert ln_likelihoods.shape == (len(walkers_positions),)
+    assert ln_likelihoods[1] == -np.infty
+    for values, ln_likelihood in zip(walkers_positions, ln_likelihoods):
+        assert ln_likelihood == pytest.approx(analysis.ln_likelihood(values),1.0e-10)
+
+def test_Analysis_ln_likelihood_vectorized_restores_variable_values(halo_and_disk_analysis, walkers_positions):
+    analysis = halo_and_disk_analysis
+    values_before = [var.value for var in analysis.variables_list]
+    analysis.ln_likelihood_vectorized(walkers_positions)
+    assert [var.value for var in analysis.variables_list] == values_before
+
+def test_Analysis_ln_likelihood_vectorized_with_model_independent_of_variables(list_of_variables, galaxy_model_creator):
+    analysis = analysisstatistics.Analysis(list_of_variables, galaxy_model_creator, R_sun=None)
+    positions = np.zeros((3,2))
+    positions[:] = [1.0, 1.0]
+    analysis._variables_dictionary["x1"]._prior_function = analysisstatistics.Prior().ln_function
+    analysis._variables_dictionary["x2"]._prior_function = analysisstatistics.Prior().ln_function
+    analysis.compile_prior_table()
+    ln_likelihoods = analysis.ln_likelihood_vectorized(positions)
+    assert ln_likelihoods == pytest.approx(analysis.ln_likelihood(positions[0])*np.ones(3),1.0e-10)
+
+def test_Analysis_with_data_loader(list_of_variables, galaxy_model_creator, tmp_path):
+    file_name = str(tmp_path / "curve.csv")
+    np.savetxt(file_name, datahandling.get_data_from_1810_09466().to_data_lists(), delimiter=",")
+    loader = datahandling.Rotation_curve_loader(file_name, cache_directory=str(tmp_path / "cache"))
+    analysis = analysisstatistics.Analysis(list_of_variables, galaxy_model_creator, data=loader)
+    assert not loader.is_loaded
+    assert np.array_equal(analysis.data.inverse_variance, datahandling.get_data_from_1810_09466().inverse_variance)
+    assert loader.is_loaded
+
+#%%
+
+@pytest.fixture
+def halo_and_disk_parameter_maps():
+    return [analysisstatistics.Parameter_map(galaxymodel.NFW, Mvir_in_1e11Msun='Mvir_1e11Msun', cvir='cvir'),
+            analysisstatistics.Parameter_map(galaxymodel.Miyamoto_Nagai_disk, total_mass_Msun=('Mdisk_1e10Msun',1.0e10), a_kpc='Rd_kpc')]
+
+def test_Analysis_parameter_map_equals_galaxy_model_creator(halo_and_disk_analysis, halo_and_disk_parameter_maps, walkers_positions):
+    analysis = halo_and_disk_analysis
+    ln_likelihoods_from_creator = analysis.ln_likelihood_vectorized(walkers_positions)
+    analysis.compile_parameter_map(*halo_and_disk_parameter_maps)
+    assert analysis.ln_likelihood_vectorized(walkers_positions) == pytest.approx(ln_likelihoods_from_creator,1.0e-12)
+    for values, ln_likelihood in zip(walkers_positions, ln_likelihoods_from_creator):
+        assert analysis.ln_likelihood(values) == pytest.approx(ln_likelihood,1.0e-12)
+    analysis.remove_parameter_map()
+    assert analysis.ln_likelihood_vectorized(walkers_positions) == pytest.approx(ln_likelihoods_from_creator,1.0e-12)
+
+def test_Analysis_parameter_map_different_from_galaxy_model_creator(capfd, halo_and_disk_analysis, halo_and_disk_parameter_maps):
+    with pytest.raises(AssertionError):
+        halo_and_disk_analysis.compile_parameter_map(halo_and_disk_parameter_maps[0])
+    out, err = capfd.readouterr()
+    assert "ADVISE: Check that the parameter maps describe the same potentials" in out
+
+def test_Parameter_map_ill_defined(capfd, halo_and_disk_analysis):
+    with pytest.raises(AssertionError):
+        analysisstatistics.Parameter_map(galaxymodel.Galactic_model)
+    with pytest.raises(AssertionError):
+        halo_and_disk_analysis.compile_parameter_map(analysisstatistics.Parameter_map(galaxymodel.Plummer, mass='Mdisk_1e10Msun'))
+    with pytest.raises(KeyError):
+        halo_and_disk_analysis.compile_parameter_map(analysisstatistics.Parameter_map(galaxymodel.Plummer, b_kpc='non_existing_variable'))
+    out, err = capfd.readouterr()
+    assert "ADVISE: Check that the Parameter_map of Plummer only uses the names of your Variables" in out
+
+#%%
+
+def test_Prior_table_equals_Prior_ln_function():
+    priors = [analysisstatistics.Prior(flat_min=-1.0, flat_max=1.0),
+              analysisstatistics.Prior(Gaussian_mean=-1.1, Gaussian_sigma=2.3),
+              analysisstatistics.Prior(flat_min=-2.0, flat_max=-0.7, Gaussian_mean=7.0, Gaussian_sigma=0.2)]
+    def other_prior_function(x):
+        return -float(x)**2
+    prior_functions = [prior.ln_function for prior in priors] + [other_prior_function]
+    table = analysisstatistics.Prior_table(prior_functions)
+    values = np.array([[0.0, 0.0, -1.0, 0.5],
+                       [-0.99, -999.0, -1.9, 1.0],
+                       [2.0, 3.0, -1.0, 0.0],
+                       [0.5, 1.0, -0.7, 0.0]])
+    ln_priors = table.ln_function(values)
+    for row, ln_prior in zip(values, ln_priors):
+        expected = sum(prior_function(value) for prior_function, value in zip(prior_functions, row))
+        assert ln_prior == pytest.approx(expected,1.0e-12)
+    assert ln_priors[2] == -np.infty
+    assert ln_priors[3] == -np.infty
+    assert list(table.inside_flat_bounds(values)) == [True, True, False, False]
+
+def test_Analysis_get_ln_priors_vectorized_equals_scalar(halo_and_disk_analysis, walkers_positions):
+    analysis = halo_and_disk_analysis
+    ln_priors = analysis.get_ln_priors_vectorized(walkers_positions)
+    for values, ln_prior in zip(walkers_positions, ln_priors):
+        assert ln_prior == pytest.approx(analysis.get_ln_priors(values),1.0e-12)
+
+#%%
+
+def _number_of_variables(analysis, item):
+    return (len(analysis.variables_list), item)
+
+def test_Analysis_pool_ln_likelihood_equals_serial(halo_and_disk_analysis, walkers_positions):
+    analysis = halo_and_disk_analysis
+    with analysis:
+        pool = analysis.start_pool(processes=2, chunksize=4)
+        assert pool.processes == 2
+        assert pool.chunksize == 4
+        assert analysis.pool is pool
+        assert pool.ln_likelihood_vectorized(walkers_positions) == pytest.approx(analysis.ln_likelihood_vectorized(walkers_positions),1.0e-12)
+        assert pool.map(_number_of_variables, [1, 2]) == [(5, 1), (5, 2)]
+    assert analysis._pool is None
+
+def _raise_error(analysis, item):
+    raise ValueError(item)
+
+@pytest.mark.parametrize("executor",[("serial"),("thread"),("process"),("cluster")])
+def test_Analysis_executors_equal_serial(halo_and_disk_analysis, walkers_positions, executor):
+    analysis = halo_and_disk_analysis
+    with analysis:
+        pool = analysis.start_pool(processes=2, chunksize=2, executor=executor)
+        assert analysis.executor == executor
+        assert pool.ln_likelihood_vectorized(walkers_positions) == pytest.approx(analysis.ln_likelihood_vectorized(walkers_positions),1.0e-12)
+        assert pool.map(_number_of_variables, [1, 2, 3]) == [(5, 1), (5, 2), (5, 3)]
+        with pytest.raises(ValueError):
+            pool.map(_raise_error, [1, 2, 3])
+        values_before = [var.value for var in analysis.variables_list]
+        analysis.compute_mcmc(12, 3, np.array([7.05, 11.5, 3.9, 5.3, 8.122]) + 1.0e-3*np.random.RandomState(3).randn(12,5))
+        assert [var.value for var in analysis.variables_list] == values_before
+    assert analysis._pool is None
+
+def _scalar_galaxy_model_creator(d):
+    halo = galaxymodel.NFW(Mvir_in_1e11Msun=float(d['Mvir_1e11Msun'].value), cvir=float(d['cvir'].value))
+    disk = galaxymodel.Miyamoto_Nagai_disk(total_mass_Msun=float(d['Mdisk_1e10Msun'].value)*1.0e10, a_kpc=float(d['Rd_kpc'].value))
+    return galaxymodel.Galactic_model(halo, disk)
+
+@pytest.mark.parametrize("executor",[("thread"),("process")])
+def test_Analysis_compute_mcmc_with_scalar_galaxy_model_creator(halo_and_disk_analysis, executor):
+    # without a parameter map the workers call ln_likelihood row by row
+    analysis = analysisstatistics.Analysis(halo_and_disk_analysis.variables_list[:-1], _scalar_galaxy_model_creator)
+    positions = np.array([7.05, 11.5, 3.9, 5.3, 8.122]) + 1.0e-3*np.random.RandomState(3).randn(12,5)
+    with analysis:
+        analysis.start_pool(processes=2, executor=executor)
+        analysis.compute_mcmc(12, 3, positions)
+    assert analysis.sampler.get_chain().shape == (3, 12, 5)
+    assert analysis.sampler.get_log_prob()[0] == pytest.approx([analysis.ln_likelihood(values) for values in analysis.sampler.get_chain()[0]],1.0e-12)
+
+def test_Analysis_auto_executor(halo_and_disk_analysis, walkers_positions):
+    analysis = halo_and_disk_analysis
+    analysis.start_pool(processes=2, executor='auto')
+    timings = analysis.executor_timings
+    assert set(timings) == {'serial', 'thread', 'process'}
+    fastest = min(timings, key=timings.get)
+    assert isinstance(analysis.pool, analysisstatistics.executor_classes[fastest])
+    assert analysis.pool.ln_likelihood_vectorized(walkers_positions) == pytest.approx(analysis.ln_likelihood_vectorized(walkers_positions),1.0e-12)
+    analysis.close_pool()
+    with pytest.raises(AssertionError):
+        analysis.start_pool(executor='gpu')
+
+def test_Analysis_pool_is_restarted_when_the_analysis_changes(halo_and_disk_analysis, halo_and_disk_parameter_maps, walkers_positions):
+    analysis = halo_and_disk_analysis
+    with analysis:
+        pool = analysis.start_pool(processes=1)
+        analysis.compile_parameter_map(*halo_and_disk_parameter_maps)
+        assert analysis.pool is not pool
+        assert analysis.pool.processes == 1
+        assert analysis.pool.ln_likelihood_vectorized(walkers_positions) == pytest.approx(analysis.ln_likelihood_vectorized(walkers_positions),1.0e-12)
+
+#%%
+
+def test_Analysis_compute_mcmc_with_storage_resumes(halo_and_disk_analysis, walkers_positions, tmp_path):
+    analysis = halo_and_disk_analysis
+    directory = str(tmp_path / "run")
+    positions = np.array([7.05, 11.5, 3.9, 5.3, 8.122]) + 1.0e-3*np.random.RandomState(3).randn(12,5)
+    storage = datahandling.Chain_storage(directory, 12, 8, 5, variable_names=analysis.variables_key_list, flush_every=3)
+    analysis.compute_mcmc(12, 8, positions, vectorize=True, storage=storage)
+    assert storage.is_complete
+    assert np.array_equal(storage.chains[:,-1], storage.last_positions)
+    stored_lnlikelihoods = analysis.ln_likelihood_vectorized(storage.chains.reshape((-1,5))).reshape((12,8))
+    assert np.allclose(stored_lnlikelihoods, storage.lnlikelihoods)
+    # simulate a crash after 5 steps by rewinding the manifest
+    storage._manifest['steps_completed'] = 5
+    storage._write_manifest()
+    analysis.compute_mcmc(12, 8, None, vectorize=True, storage=directory)
+    assert analysis.chain_storage.is_complete
+    assert np.array_equal(analysis.chain_storage.chains[:,:5], storage.chains[:,:5])
+
+def test_Analysis_compute_mcmc_updates_summary(halo_and_disk_analysis, tmp_path):
+    analysis = halo_and_disk_analysis
+    positions = np.array([7.05, 11.5, 3.9, 5.3, 8.122]) + 1.0e-3*np.random.RandomState(3).randn(12,5)
+    summary = onlinestatistics.Posterior_summary(5, variable_names=analysis.variables_key_list)
+    analysis.compute_mcmc(12, 10, positions, vectorize=True, summary=summary)
+    samples = analysis.sampler.get_chain(flat=True)
+    assert summary.number_of_samples == len(samples)
+    assert summary.mean == pytest.approx(np.mean(samples, axis=0),1.0e-12)
+    assert summary.covariance == pytest.approx(np.cov(samples.T),1.0e-8)
+    # a resumed run first adds the stored steps
+    directory = str(tmp_path / "run")
+    storage = datahandling.Chain_storage(directory, 12, 10, 5, variable_names=analysis.variables_key_list, flush_every=3)
+    analysis.compute_mcmc(12, 10, positions, vectorize=True, storage=storage)
+    storage._manifest['steps_completed'] = 4
+    storage._write_manifest()
+    summary = onlinestatistics.Posterior_summary(5)
+    analysis.compute_mcmc(12, 10, None, vectorize=True, storage=directory, summary=summary)
+    assert summary.mean == pytest.approx(np.mean(analysis.chain_storage.chains.reshape((-1,5)), axis=0),1.0e-12)
+
+def test_save_results_and_load_results(halo_and_disk_analysis, tmp_path):
+    analysis = halo_and_disk_analysis
+    positions = np.array([7.05, 11.5, 3.9, 5.3, 8.122]) + 1.0e-3*np.random.RandomState(3).randn(12,5)
+    analysis.compute_mcmc(12, 7, positions, vectorize=True)
+    directory = str(tmp_path / "results")
+    datahandling.save_results(analysis, directory, block_size=3)
+    results = datahandling.load_results(directory)
+    assert np.array_equal(results['chains'], np.swapaxes(analysis.sampler.get_chain(),0,1))
+    assert np.array_equal(results['lnlikelihoods'], np.swapaxes(analysis.sampler.get_log_prob(),0,1))
+    assert np.allclose(results['acceptance_fractions'], analysis.sampler.acceptance_fraction)
+    assert results['variable_names'] == analysis.variables_key_list
+
+def test_pickle_results_after_a_run_with_storage(halo_and_disk_analysis, tmp_path):
+    analysis = halo_and_disk_analysis
+    positions = np.array([7.05, 11.5, 3.9, 5.3, 8.122]) + 1.0e-3*np.random.RandomState(3).randn(12,5)
+    analysis.compute_mcmc(12, 7, positions, vectorize=True, storage=str(tmp_path / "run"), flush_every=3)
+    file_name = str(tmp_path / "results.pickle")
+    datahandling.pickle_results(analysis, file_name)
+    results = datahandling.load_pickle_results(file_name)
+    assert np.array_equal(results['chains'], analysis.chain_storage.chains)
+    assert np.array_equal(results['lnlikelihoods'], analysis.chain_storage.lnlikelihoods)
+    assert np.array_equal(results['acceptance_fractions'], analysis.chain_storage.acceptance_fractions)
+    # a later run without storage is the one pickled
+    analysis.compute_mcmc(12, 4, positions, vectorize=True)
+    assert analysis.chain_storage is None
+    datahandling.pickle_results(analysis, file_name)
+    assert np.array_equal(datahandling.load_pickle_results(file_name)['chains'], np.swapaxes(analysis.sampler.get_chain(),0,1))
+
+#%%
+
+def test_Analysis_ln_likelihood_and_grad(halo_and_disk_analysis, halo_and_disk_parameter_maps):
+    analysis = halo_and_disk_analysis
+    assert not analysis.has_analytic_gradient
+    analysis.compile_parameter_map(*halo_and_disk_parameter_maps)
+    assert analysis.has_analytic_gradient
+    values = np.array([7.3, 11.1, 4.1, 5.0, 8.15])
+    ln_likelihood, gradient = analysis.ln_likelihood_and_grad(values)
+    assert ln_likelihood == pytest.approx(analysis.ln_likelihood(values),1.0e-12)
+    for index in range(len(values)):
+        step = 1.0e-6*values[index]
+        upper, lower = values.copy(), values.copy()
+        upper[index] += step
+        lower[index] -= step
+        numerical_derivative = (analysis.ln_likelihood(upper) - analysis.ln_likelihood(lower))/(2.0*step)
+        assert gradient[index] == pytest.approx(numerical_derivative,rel=1.0e-5,abs=1.0e-6)
+    outside_priors = values.copy()
+    outside_priors[0] = -1.0
+    assert analysis.ln_likelihood_and_grad(outside_priors)[0] == -np.infty
+
+def test_Analysis_maximum_likelihood_with_analytic_gradient(halo_and_disk_analysis, halo_and_disk_parameter_maps):
+    analysis = halo_and_disk_analysis
+    maximum_without_gradient = analysis.get_maximum_likelihood_variables()
+    analysis.compile_parameter_map(*halo_and_disk_parameter_maps)
+    maximum_with_gradient = analysis.get_maximum_likelihood_variables()
+    assert analysis.ln_likelihood(maximum_with_gradient) >= analysis.ln_likelihood(maximum_without_gradient) - 1.0e-3
+
+#%%
+
+def test_Prior_table_transform_unit_cube():
+    priors = [analysisstatistics.Prior(flat_min=-1.0, flat_max=3.0),
+              analysisstatistics.Prior(Gaussian_mean=2.0, Gaussian_sigma=0.5),
+              analysisstatistics.Prior(flat_min=1.5, flat_max=2.5, Gaussian_mean=2.0, Gaussian_sigma=5.0),
+              analysisstatistics.Prior(flat_min=0.0)]
+    table = analysisstatistics.Prior_table([prior.ln_function for prior in priors])
+    assert not table.can_transform_unit_cube
+    assert analysisstatistics.Prior_table([prior.ln_function for prior in priors[:3]]).can_transform_unit_cube
+    values = table.transform_unit_cube([[0.25, 0.5, 0.5, 0.5], [1.0, 0.841344746, 0.0, 0.5]])
+    assert values[0,:3] == pytest.approx([0.0, 2.0, 2.0])
+    assert values[1,:3] == pytest.approx([3.0, 2.5, 1.5],1.0e-6)
+    assert np.isnan(values[:,3]).all()
+    samples = table.sample(1000, random_state=1, fallback_values=[0.0, 0.0, 0.0, 10.0])
+    assert np.isfinite(table.ln_function(samples)).all()
+    assert np.mean(samples[:,1]) == pytest.approx(2.0,abs=0.1)
+    assert np.mean(samples[:,3]) == pytest.approx(10.0,abs=0.01)
+
+@pytest.mark.parametrize("use_pool",[(False),(True)])
+def test_Analysis_maximum_likelihood_multistart(halo_and_disk_analysis, use_pool):
+    analysis = halo_and_disk_analysis
+    current_values = analysis.get_current_values()
+    with analysis:
+        analysis.start_pool(processes=2)
+        result = analysis.get_maximum_likelihood_variables_multistart(4, random_state=2, use_pool=use_pool)
+    assert result['solutions'].shape == (4, 5)
+    assert np.array_equal(result['starts'][0], current_values)
+    assert result['ln_likelihood'] == np.max(result['ln_likelihoods'])
+    assert result['ln_likelihood'] == pytest.approx(analysis.ln_likelihood(result['x']))
+    assert result['ln_likelihood'] >= analysis.ln_likelihood(analysis.get_maximum_likelihood_variables()) - 1.0e-3
+    assert result['spread'].shape == (5,)
+
+#%%
+
+def test_gelman_rubin():
+    rng = np.random.RandomState(4)
+    mixed_chains = rng.randn(20, 2000, 2)
+    assert analysisstatistics.gelman_rubin(mixed_chains) == pytest.approx([1.0, 1.0],abs=0.01)
+    separated_chains = mixed_chains + np.arange(20.0)[:,np.newaxis,np.newaxis]
+    assert np.all(analysisstatistics.gelman_rubin(separated_chains) > 2.0)
+
+def test_integrated_autocorrelation_time():
+    rng = np.random.RandomState(5)
+    independent_samples = rng.randn(5000, 4, 1)
+    assert analysisstatistics.integrated_autocorrelation_time(independent_samples)[0] == pytest.approx(1.0,abs=0.3)
+
+@pytest.fixture
+def Gaussian_priors_analysis(list_of_variables, galaxy_model_creator):
+    analysis = analysisstatistics.Analysis(list_of_variables, galaxy_model_creator, R_sun=None)
+    analysis._variables_dictionary["x1"]._prior_function = analysisstatistics.Prior(Gaussian_mean=1.0, Gaussian_sigma=0.1).ln_function
+    analysis._variables_dictionary["x2"]._prior_function = analysisstatistics.Prior(Gaussian_mean=2.0, Gaussian_sigma=0.3).ln_function
+    analysis.compile_prior_table()
+    return analysis
+
+def test_Analysis_adaptive_burntin_and_mcmc(Gaussian_priors_analysis):
+    analysis = Gaussian_priors_analysis
+    np.random.seed(6)
+    report = analysis.compute_mcmc_and_burntin_adaptive(8, 5000, 5000, 500, check_every=100, vectorize=True)
+    for stage in ('burntin', 'mcmc'):
+        assert report[stage]['converged']
+        assert report[stage]['number_of_steps'] + report[stage]['steps_saved'] == 5000
+        assert report[stage]['number_of_steps'] % 100 == 0
+    assert report['mcmc']['effective_sample_size'] >= 500
+    assert analysis.sampler.iteration == report['mcmc']['number_of_steps']
+    samples = analysis.sampler.get_chain(flat=True)
+    assert np.mean(samples, axis=0) == pytest.approx([1.0, 2.0],abs=0.05)
+
+def test_Analysis_adaptive_mcmc_converged_at_the_maximum_number_of_steps(Gaussian_priors_analysis):
+    analysis = Gaussian_priors_analysis
+    positions = np.array([1.0, 2.0]) + 0.01*np.random.RandomState(2).randn(8,2)
+    analysis.compute_mcmc_adaptive(8, 100, positions, 1, check_every=100, vectorize=True, minimum_steps_per_autocorrelation_time=0)
+    assert analysis.adaptive_report['mcmc']['converged']
+    assert analysis.adaptive_report['mcmc']['steps_saved'] == 0
+    analysis.compute_mcmc_adaptive(8, 100, positions, 1.0e6, check_every=100, vectorize=True)
+    assert not analysis.adaptive_report['mcmc']['converged']
+
+@pytest.mark.parametrize("batch_size",[(1),(4)])
+def test_Nested_sampler_evidence_of_Gaussian_likelihood(batch_size):
+    sigma = np.array([0.3, 1.0])
+    def ln_likelihoods_of_unit_cube(u):
+        return -0.5*np.sum(((20.0*u - 10.0)/sigma)**2, axis=1)
+    sampler = analysisstatistics.Nested_sampler(2, ln_likelihoods_of_unit_cube, number_of_live_points=200, batch_size=batch_size, random_state=1)
+    results = sampler.run(dlogz=0.1)
+    assert results['converged']
+    assert results['ln_evidence'] == pytest.approx(np.log(2.0*np.pi*np.prod(sigma)/400.0),abs=3.0*results['ln_evidence_error'])
+    assert np.sum(results['weights']) == pytest.approx(1.0)
+    samples = 20.0*analysisstatistics.resample_equally_weighted(results['unit_cube_samples'], results['weights'], random_state=2) - 10.0
+    assert np.std(samples, axis=0) == pytest.approx(sigma,rel=0.15)
+    # converging exactly at maximum_iterations
+    sampler = analysisstatistics.Nested_sampler(2, ln_likelihoods_of_unit_cube, number_of_live_points=200, batch_size=batch_size, random_state=1)
+    assert sampler.run(dlogz=0.1, maximum_iterations=results['number_of_iterations'])['converged']
+    sampler = analysisstatistics.Nested_sampler(2, ln_likelihoods_of_unit_cube, number_of_live_points=200, batch_size=batch_size, random_state=1)
+    assert not sampler.run(dlogz=0.1, maximum_iterations=results['number_of_iterations'] - 1)['converged']
+
+def test_Analysis_compute_nested_sampling(capfd, halo_and_disk_analysis):
+    analysis = halo_and_disk_analysis
+    results_vectorized = analysis.compute_nested_sampling(number_of_live_points=50, vectorize=True, maximum_iterations=100, random_state=3)
+    with analysis:
+        analysis.start_pool(processes=2, executor='process')
+        results_pool = analysis.compute_nested_sampling(number_of_live_points=50, vectorize=False, batch_size=1, maximum_iterations=100, random_state=3)
+    assert "Nested sampling took" in capfd.readouterr().out
+    assert not results_vectorized['converged']
+    assert results_vectorized['samples'].shape == (100 + 50, len(analysis.variables_list))
+    assert np.all(np.isfinite(analysis.get_ln_priors_vectorized(results_vectorized['equally_weighted_samples'])))
+    assert results_pool['ln_evidence'] == results_vectorized['ln_evidence']
+    assert np.array_equal(results_pool['samples'], results_vectorized['samples'])
+    ln_Bayes_factor, error = analysisstatistics.get_ln_Bayes_factor(results_vectorized, results_pool)
+    assert ln_Bayes_factor == 0.0 and error == pytest.approx(np.sqrt(2.0)*results_pool['ln_evidence_error'])
+    # a RandomState instance gives the same run as its seed
+    results_from_instance = analysis.compute_nested_sampling(number_of_live_points=50, vectorize=True, maximum_iterations=100,
+                                                             random_state=np.random.RandomState(3))
+    assert np.array_equal(results_from_instance['samples'], results_vectorized['samples'])
+
+def test_Analysis_compute_nested_sampling_improper_prior(capfd, list_of_variables, galaxy_model_creator):
+    analysis = analysisstatistics.Analysis(list_of_variables, galaxy_model_creator, R_sun=None)
+    with pytest.raises(AssertionError):
+        analysis.compute_nested_sampling()
+    assert "ADVISE: Nested sampling needs every Variable" in capfd.readouterr().out
+
+#%%
+
+@pytest.mark.parametrize("use_parameter_map",[(False),(True)])
+def test_Analysis_get_model_curves_equals_galactic_model(halo_and_disk_analysis, halo_and_disk_parameter_maps, walkers_positions, use_parameter_map):
+    analysis = halo_and_disk_analysis
+    if use_parameter_map:
+        analysis.compile_parameter_map(*halo_and_disk_parameter_maps)
+    samples = np.delete(walkers_positions, 1, axis=0)
+    R_kpc = np.linspace(0.5, 40.0, 50)
+    Vc = analysis.get_model_curves(samples, R_kpc, chunksize=2)
+    rho = analysis.get_model_curves(samples, R_kpc, quantity='density_GeV_cm3', chunksize=2)
+    halo_rho = analysis.get_model_curves(samples, R_kpc, quantity=lambda GM, R: GM.potentials[0].density_GeV_cm3(R))
+    assert Vc.shape == rho.shape == (len(samples), len(R_kpc))
+    for k, values in enumerate(samples):
+        GM = analysis.set_galaxy_model(values)
+        assert Vc[k] == pytest.approx(GM.circular_velocity_km_s(R_kpc),1.0e-12)
+        assert rho[k] == pytest.approx(GM.density_GeV_cm3(R_kpc),1.0e-12)
+        assert halo_rho[k] == pytest.approx(GM.potentials[0].density_GeV_cm3(R_kpc),1.0e-12)
+
+def test_Analysis_iterate_model_curves_bounds_the_blocks(halo_and_disk_analysis, walkers_positions):
+    analysis = halo_and_disk_analysis
+    R_kpc = np.linspace(0.5, 40.0, 1000)
+    chunksize = int(0.1*2**20/(8*len(R_kpc)*analysis._temporary_arrays_per_block))
+    samples = np.repeat(np.delete(walkers_positions, 1, axis=0), 10, axis=0)
+    blocks = list(analysis.iterate_model_curves(samples, R_kpc, memory_limit_MB=0.1))
+    assert [start for start, block in blocks] == list(range(0, len(samples), chunksize))
+    assert all(len(block) <= chunksize for start, block in blocks)
+    assert np.concatenate([block for start, block in blocks]) == pytest.approx(analysis.get_model_curves(samples, R_kpc),1.0e-14)
+
+def test_Analysis_get_model_bands(halo_and_disk_analysis):
+    analysis = halo_and_disk_analysis
+    rng = np.random.RandomState(3)
+    samples = np.array([7.05, 11.5, 3.9, 5.3, 8.122]) + np.array([1.0, 2.0, 0.5, 0.5, 0.0])*rng.randn(2000,5)
+    R_kpc = np.linspace(0.5, 40.0, 30)
+    bands = analysis.get_model_bands(samples, R_kpc, percentiles=(5.0, 50.0, 95.0), chunksize=300)
+    Vc = analysis.get_model_curves(samples, R_kpc)
+    assert bands['number_of_samples'] == len(samples)
+    assert bands['bands'].shape == (3, len(R_kpc))
+    # the histograms span three times the range of the first block of 300 samples
+    bin_width = 3.0*(bands['maximum'] - bands['minimum'])/1000
+    for band, percentile in zip(bands['bands'], bands['percentiles']):
+        assert np.all(np.abs(band - np.percentile(Vc, percentile, axis=0)) <= 2.0*bin_width)
+    assert bands['mean'] == pytest.approx(np.mean(Vc, axis=0),1.0e-12)
+    assert bands['std'] == pytest.approx(np.std(Vc, axis=0),1.0e-10)
+    assert bands['minimum'] == pytest.approx(np.min(Vc, axis=0),1.0e-14)
+    # the curves are computed once
+    calls = []
+    iterate_model_curves = analysis.iterate_model_curves
+    def counted_iterate_model_curves(*args, **kwargs):
+        calls.append(1)
+        return iterate_model_curves(*args, **kwargs)
+    analysis.iterate_model_curves = counted_iterate_model_curves
+    assert np.array_equal(analysis.get_model_bands(samples, R_kpc, percentiles=(5.0, 50.0, 95.0), chunksize=300)['bands'], bands['bands'])
+    assert len(calls) == 1
+
+#%%
+
+@pytest.fixture
+def results_sampled_from_the_priors(halo_and_disk_analysis):
+    # a chain as those of pickle_results with a flat likelihood, so that it
+    # samples the priors around the values of the variables
+    analysis = halo_and_disk_analysis
+    rng = np.random.RandomState(4)
+    chains = np.array([7.05, 11.5, 3.9, 5.3, 8.122]) + np.array([1.0, 2.0, 0.6, 0.5, 0.031])*rng.randn(20,1000,5)
+    return {
+            'lnlikelihoods':analysis.get_ln_priors_vectorized(chains.reshape((-1,5))).reshape((20,1000)),
+            'chains':chains,
+            'acceptance_fractions':np.full(20, 0.5),
+            'variable_names':analysis.variables_key_list,
+    }
+
+def test_weighted_percentiles():
+    samples = np.random.RandomState(5).randn(4000,2)
+    weights = np.ones(4000)
+    quantiles = analysisstatistics.weighted_percentiles(samples, weights, percentiles=(16.0, 50.0, 84.0))
+    assert quantiles == pytest.approx(np.percentile(samples, (16.0, 50.0, 84.0), axis=0),abs=1.0e-3)
+    # doubling the weight of a sample is the same as repeating it
+    weights[:2000] = 2.0
+    repeated_samples = np.concatenate((samples[:2000], samples))
+    assert analysisstatistics.weighted_percentiles(samples, weights, percentiles=(50.0,))[0] == pytest.approx(
+            np.percentile(repeated_samples, 50.0, axis=0),abs=1.0e-3)
+
+def test_Analysis_reweight_results(monkeypatch, halo_and_disk_analysis, results_sampled_from_the_priors, tmp_path):
+    analysis = halo_and_disk_analysis
+    results = results_sampled_from_the_priors
+    old_prior_table = analysis.prior_table
+    # R_sun is the default Variable of every Analysis
+    monkeypatch.setattr(analysis._variables_dictionary['R_sun'], '_prior_function', analysisstatistics.Prior(Gaussian_mean=8.15, Gaussian_sigma=0.031).ln_function)
+    analysis.compile_prior_table()
+    reweighted = analysis.reweight_results(results, old_prior_table, discard=100, percentiles=(50.0,))
+    assert reweighted['number_of_samples'] == 20*900
+    assert reweighted['weights'].sum() == pytest.approx(1.0)
+    assert 0.2*20*900 < reweighted['effective_sample_size'] < 0.5*20*900
+    assert reweighted['mean'][4] == pytest.approx(8.15,abs=2.0e-3)
+    assert reweighted['std'][4] == pytest.approx(0.031,rel=0.05)
+    assert reweighted['quantiles'][0,4] == pytest.approx(8.15,abs=2.0e-3)
+    # the other variables keep their distribution
+    assert reweighted['mean'][:4] == pytest.approx(np.mean(results['chains'][:, 100:], axis=(0,1))[:4],abs=0.05)
+    assert reweighted['ln_posteriors'] == pytest.approx(analysis.get_ln_priors_vectorized(reweighted['samples']),1.0e-12)
+    # the same results from the file of pickle_results and the directory of save_results
+    file_name = str(tmp_path / "results.pickle")
+    with open(file_name, "wb") as f:
+        datahandling.pickle.dump(results, f)
+    directory = str(tmp_path / "results")
+    storage = datahandling.Chain_storage(directory, 20, 1000, 5, variable_names=analysis.variables_key_list)
+    storage.extend(results['chains'], results['lnlikelihoods'], 0)
+    for source in (file_name, directory, datahandling.load_results(directory)):
+        assert np.array_equal(analysis.reweight_results(source, old_prior_table, discard=100)['weights'], reweighted['weights'])
+
+def test_Analysis_reweight_results_refuses_a_collapsed_effective_sample_size(capfd, monkeypatch, halo_and_disk_analysis, results_sampled_from_the_priors):
+    analysis = halo_and_disk_analysis
+    old_prior_table = analysis.prior_table
+    R_sun_prior_function = analysis._variables_dictionary['R_sun'].prior_function
+    monkeypatch.setattr(analysis._variables_dictionary['R_sun'], '_prior_function', analysisstatistics.Prior(Gaussian_mean=8.5, Gaussian_sigma=0.01).ln_function)
+    analysis.compile_prior_table()
+    with pytest.raises(AssertionError):
+        analysis.reweight_results(results_sampled_from_the_priors, old_prior_table)
+    assert "ADVISE: The effective sample size of the reweighted chain" in capfd.readouterr().out
+    # wider flat bounds are only advised against
+    analysis._variables_dictionary['Rd_kpc']._prior_function = analysisstatistics.Prior(flat_min=0.01,flat_max=20.0).ln_function
+    analysis._variables_dictionary['R_sun']._prior_function = R_sun_prior_function
+    analysis.compile_prior_table()
+    reweighted = analysis.reweight_results(results_sampled_from_the_priors, old_prior_table)
+    assert reweighted['effective_sample_size'] == pytest.approx(20*1000)
+    assert "ADVISE: The new flat bounds are wider" in capfd.readouterr().out
+    with pytest.raises(AssertionError):
+        analysis.reweight_results(results_sampled_from_the_priors, [lambda value: -np.infty]*5)
+    # no sample inside the new priors is refused even without a minimum
+    analysis._variables_dictionary['Rd_kpc']._prior_function = analysisstatistics.Prior(flat_min=1.0e3,flat_max=1.0e4).ln_function
+    analysis.compile_prior_table()
+    with pytest.raises(AssertionError):
+        analysis.reweight_results(results_sampled_from_the_priors, old_prior_table, minimum_effective_sample_size=0)
+    assert "ADVISE: No sample of the chain is inside the support of the new priors" in capfd.readouterr().out
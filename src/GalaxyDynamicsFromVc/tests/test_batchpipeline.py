@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import os
+import pytest
+import numpy as np
+
+from .. import batchpipeline
+from .. import analysisstatistics
+from .. import galaxymodel
+from .. import datahandling
+
+#%%
+
+def halo_creator(d):
+    return galaxymodel.Galactic_model(galaxymodel.NFW(Mvir_in_1e11Msun=d['Mvir_1e11Msun'].value, cvir=d['cvir'].value))
+
+def make_galaxy(Mvir, cvir, number_of_points):
+    R_kpc = np.linspace(1.0, 30.0, number_of_points)
+    vc_km_s = galaxymodel.NFW(Mvir_in_1e11Msun=Mvir, cvir=cvir).circular_velocity_km_s(R_kpc)
+    errors = 0.02*vc_km_s
+    return datahandling.Rotation_curve_data(R_kpc, vc_km_s, errors, errors, np.zeros(number_of_points))
+
+@pytest.fixture
+def galaxies():
+    return {'small':make_galaxy(3.0, 15.0, 8), 'large':make_galaxy(12.0, 9.0, 40), 'medium':make_galaxy(6.0, 12.0, 20)}
+
+@pytest.fixture
+def halo_batch_fit():
+    list_of_variables = [
+        analysisstatistics.Variable('Mvir_1e11Msun', prior_function=analysisstatistics.Prior(flat_min=0.1,flat_max=1.0e2).ln_function, value=5.0),
+        analysisstatistics.Variable('cvir', prior_function=analysisstatistics.Prior(flat_min=1.0,flat_max=50.0).ln_function, value=10.0),
+    ]
+    return batchpipeline.Batch_fit(list_of_variables, halo_creator)
+
+def test_Analysis_with_data(galaxies, halo_batch_fit):
+    analysis = halo_batch_fit.create_analysis(galaxies['small'])
+    assert analysis.data is galaxies['small']
+    assert analysis.variables_key_list == ['Mvir_1e11Msun', 'cvir']
+    assert analysis.ln_likelihood([3.0, 15.0]) == pytest.approx(0.0,abs=1.0e-10)
+    with pytest.raises(AssertionError):
+        analysisstatistics.Analysis(analysis.variables_list, halo_creator, R_sun=None, data=galaxies['small'].to_data_lists())
+
+def test_get_size_counts_data_points_of_loaders(galaxies, tmp_path):
+    file_name = str(tmp_path / "large.csv")
+    np.savetxt(file_name, np.array(galaxies['large'].to_data_lists()), delimiter=",", fmt="%.20e")
+    loader = datahandling.Rotation_curve_loader(file_name, cache_directory=None)
+    # the same unit for loaders and data in memory, whatever the size of the file
+    assert batchpipeline._get_size(loader) == batchpipeline._get_size(galaxies['large']) == 40
+    assert batchpipeline._get_size(galaxies['medium']) < batchpipeline._get_size(loader)
+    assert not loader.is_loaded
+
+@pytest.mark.parametrize("processes",[(1),(2)])
+def test_Batch_fit_run_and_resume(galaxies, halo_batch_fit, tmp_path, processes):
+    output_directory = str(tmp_path / "batch")
+    results = halo_batch_fit.run(galaxies, output_directory, processes=processes)
+    assert sorted(results) == sorted(galaxies)
+    for name, true_values in [('small', [3.0, 15.0]), ('large', [12.0, 9.0]), ('medium', [6.0, 12.0])]:
+        assert results[name]['maximum_likelihood_variables'] == pytest.approx(true_values,1.0e-3)
+        assert results[name]['number_of_data_points'] == len(galaxies[name])
+        assert os.path.isfile(os.path.join(output_directory, name, 'fit.json'))
+    assert batchpipeline.load_batch_results(output_directory) == results
+    # fitted galaxies are not fitted again
+    galaxies['extra'] = make_galaxy(8.0, 10.0, 10)
+    os.remove(os.path.join(output_directory, 'small', 'fit.json'))
+    new_results = halo_batch_fit.run(galaxies, output_directory, processes=processes)
+    assert new_results['large'] == results['large']
+    assert new_results['small']['seconds'] != results['small']['seconds']
+    assert new_results['extra']['maximum_likelihood_variables'] == pytest.approx([8.0, 10.0],1.0e-3)
+
+def test_Batch_fit_with_mcmc_and_failures(galaxies, halo_batch_fit, tmp_path):
+    batch_fit = batchpipeline.Batch_fit(halo_batch_fit._list_of_variables, halo_creator,
+                                        number_of_walkers=8, number_of_steps_burntin=20, number_of_steps_mcmc=30)
+    galaxies['broken'] = datahandling.Rotation_curve_data([1.0, 2.0], [np.nan, 10.0], [1.0, 1.0], [1.0, 1.0], [0.0, 0.0])
+    output_directory = str(tmp_path / "batch")
+    np.random.seed(1)
+    results = batch_fit.run(galaxies, output_directory, processes=1)
+    assert 'error' in results['broken']
+    assert 'broken' not in batchpipeline.load_batch_results(output_directory)
+    stored_results = datahandling.load_results(os.path.join(output_directory, 'large', 'chains'))
+    assert stored_results.number_of_steps == 30
+    assert results['large']['mean'] == pytest.approx(np.mean(stored_results.get_flat_samples(), axis=0).tolist(),1.0e-12)
+
+@pytest.mark.parametrize("number_of_starts",[(1),(3)])
+def test_Batch_fit_burntin_starts_at_the_maximum_likelihood(galaxies, halo_batch_fit, monkeypatch, number_of_starts):
+    batch_fit = batchpipeline.Batch_fit(halo_batch_fit._list_of_variables, halo_creator, number_of_walkers=8,
+                                        number_of_steps_burntin=1, number_of_steps_mcmc=1, number_of_starts=number_of_starts)
+    calls = []
+    maximise_ln_likelihood = analysisstatistics.Analysis.maximise_ln_likelihood
+    def counted_maximise_ln_likelihood(self, initial_values):
+        calls.append(1)
+        return maximise_ln_likelihood(self, initial_values)
+    monkeypatch.setattr(analysisstatistics.Analysis, 'maximise_ln_likelihood', counted_maximise_ln_likelihood)
+    np.random.seed(2)
+    result = batch_fit.fit(galaxies['small'])
+    # the maximum likelihood is searched once, and the walkers start around it
+    assert len(calls) == number_of_starts
+    assert result['mean'] == pytest.approx(result['maximum_likelihood_variables'],abs=0.1)
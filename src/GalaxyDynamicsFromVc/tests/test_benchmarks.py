@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import pytest
+import json
+
+from .. import benchmarks
+
+#%%
+
+def test_benchmark_results_are_machine_readable():
+    results = benchmarks.benchmark_potentials(sizes_of_radius_arrays=(10,), repeat=1, minimum_time=0.001)
+    results += benchmarks.benchmark_galactic_model(numbers_of_components=(2,), number_of_radii=10, repeat=1, minimum_time=0.001)
+    assert len(results) == 4
+    assert results[-1]['parameters'] == {'number_of_components':2, 'number_of_radii':10}
+    for result in results:
+        assert result['seconds_per_call'] > 0.0
+        assert result['calls_per_second'] == pytest.approx(1.0/result['seconds_per_call'])
+    json.dumps({'metadata':benchmarks.get_metadata(), 'results':results})
+
+def test_benchmark_mcmc_keeps_stdout_for_the_results(capsys):
+    results = benchmarks.benchmark_mcmc(numbers_of_processes=(1,), number_of_steps=2)
+    assert [result['parameters']['mode'] for result in results] == ['vectorize', 'pool', 'thread', 'cluster']
+    out, err = capsys.readouterr()
+    assert out == ''
+    assert "MCMC took" in err
+
+def test_compare_benchmarks_reports_only_slowdowns():
+    reference = {'results':[benchmarks._result('a', {'n':1}, 1.0), benchmarks._result('a', {'n':2}, 1.0)]}
+    new = {'results':[benchmarks._result('a', {'n':1}, 1.1), benchmarks._result('a', {'n':2}, 1.5), benchmarks._result('b', {}, 9.0)]}
+    regressions = benchmarks.compare_benchmarks(reference, new, tolerance=0.2)
+    assert len(regressions) == 1
+    assert regressions[0]['parameters'] == {'n':2}
+    assert regressions[0]['slowdown'] == pytest.approx(1.5)
+
+def test_import_does_not_load_plotting_and_sampling_dependencies():
+    results = benchmarks.benchmark_import(repeat=1)
+    assert [result['parameters']['module'] for result in results] == list(benchmarks.import_time_budget_seconds)
+    for result in results:
+        assert result['loaded_deferred_dependencies'] == []
+        assert result['seconds_per_call'] > 0.0
+
+def test_check_import_budget():
+    within_budget = benchmarks._result('import', {'module':'a'}, 0.1)
+    within_budget.update(budget_seconds=0.2, loaded_deferred_dependencies=[])
+    over_budget = benchmarks._result('import', {'module':'b'}, 0.3)
+    over_budget.update(budget_seconds=0.2, loaded_deferred_dependencies=[])
+    loading_scipy = benchmarks._result('import', {'module':'c'}, 0.1)
+    loading_scipy.update(budget_seconds=0.2, loaded_deferred_dependencies=['scipy'])
+    assert benchmarks.check_import_budget([within_budget, over_budget, loading_scipy]) == [over_budget, loading_scipy]
+
+def test_main_writes_only_json_to_stdout(capsys, monkeypatch, tmp_path):
+    over_budget = benchmarks._result('import', {'module':'b'}, 0.3)
+    over_budget.update(budget_seconds=0.2, loaded_deferred_dependencies=[])
+    results = {'metadata':{}, 'results':[over_budget, benchmarks._result('a', {'n':1}, 2.0)]}
+    monkeypatch.setattr(benchmarks, 'run_benchmarks', lambda quick=False: results)
+    reference_file = str(tmp_path / "reference.json")
+    with open(reference_file, 'w') as f:
+        json.dump({'results':[benchmarks._result('a', {'n':1}, 1.0)]}, f)
+    assert benchmarks.main(['--compare', reference_file]) == 1
+    out, err = capsys.readouterr()
+    assert json.loads(out) == results
+    assert "IMPORT BUDGET" in err
+    assert "REGRESSION" in err
+
+def test_submodules_are_imported_lazily():
+    import GalaxyDynamicsFromVc
+    assert GalaxyDynamicsFromVc.onlinestatistics.Running_moments
+    assert 'plots' in dir(GalaxyDynamicsFromVc)
+    with pytest.raises(AttributeError):
+        GalaxyDynamicsFromVc.not_a_module
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import pytest
+import numpy as np
+
+from .. import datahandling
+
+#%%
+
+def test_Rotation_curve_data_from_1810_09466_matches_data_lists():
+    data_lists = datahandling.read_data_from_1810_09466()
+    data = datahandling.get_data_from_1810_09466()
+    assert len(data) == len(data_lists)
+    assert data.to_data_lists() == data_lists
+    for k, element in enumerate(data_lists):
+        sigma_2 = ((element[2]+element[3])/2)**2 + element[4]**2
+        assert data.inverse_variance[k] == pytest.approx(1.0/sigma_2,1.0e-12)
+
+def test_Rotation_curve_data_is_cached_and_read_only():
+    data = datahandling.get_data_from_1810_09466()
+    assert datahandling.get_data_from_1810_09466() is data
+    with pytest.raises(ValueError):
+        data.R_kpc[0] = 0.0
+    assert data.R_kpc.flags['C_CONTIGUOUS']
+
+def test_Rotation_curve_data_ill_defined_columns():
+    with pytest.raises(AssertionError):
+        datahandling.Rotation_curve_data([1.0, 2.0], [200.0], [1.0], [1.0], [1.0])
+
+def test_Rotation_curve_data_npz_round_trip(tmp_path):
+    data = datahandling.get_data_from_1810_09466()
+    file_name = str(tmp_path / "rotation_curve.npz")
+    data.save_npz(file_name)
+    loaded = datahandling.Rotation_curve_data.load_npz(file_name)
+    assert np.array_equal(loaded.R_kpc, data.R_kpc)
+    assert np.array_equal(loaded.inverse_variance, data.inverse_variance)
+
+#%%
+
+def _append_steps(storage, first_step, number_of_steps):
+    for step in range(first_step, first_step+number_of_steps):
+        storage.append(step*np.ones((3,2)), -step*np.ones(3), [True, False, True])
+
+def test_Chain_storage_flushes_every_n_steps_and_resumes(tmp_path):
+    directory = str(tmp_path / "run")
+    storage = datahandling.Chain_storage(directory, 3, 10, 2, variable_names=["x1", "x2"], flush_every=4)
+    _append_steps(storage, 0, 6)
+    assert storage.steps_completed == 4
+    # a new Chain_storage on the same directory only sees the flushed steps
+    resumed = datahandling.Chain_storage(directory, 3, 10, 2, variable_names=["x1", "x2"], flush_every=4)
+    assert resumed.steps_completed == 4
+    assert np.array_equal(resumed.last_positions, 3*np.ones((3,2)))
+    assert np.array_equal(resumed.last_lnlikelihoods, -3*np.ones(3))
+    _append_steps(resumed, 4, 6)
+    assert resumed.is_complete
+    assert resumed.chains.shape == (3, 10, 2)
+    assert np.array_equal(resumed.chains[0,:,1], np.arange(10.0))
+    assert list(resumed.acceptance_fractions) == [1.0, 0.0, 1.0]
+    with pytest.raises(AssertionError):
+        resumed.append(np.ones((3,2)), np.ones(3), [True]*3)
+
+def test_Chain_storage_different_run_in_directory(capfd, tmp_path):
+    directory = str(tmp_path / "run")
+    datahandling.Chain_storage(directory, 3, 10, 2)
+    with pytest.raises(AssertionError):
+        datahandling.Chain_storage(directory, 4, 10, 2)
+    out, err = capfd.readouterr()
+    assert "ADVISE: {} already contains a run with a different number_of_walkers".format(directory) in out
+
+def test_Stored_results_are_memory_mapped_views(tmp_path):
+    directory = str(tmp_path / "run")
+    storage = datahandling.Chain_storage(directory, 3, 10, 2, variable_names=["x1", "x2"], flush_every=5)
+    _append_steps(storage, 0, 7)
+    results = datahandling.load_results(directory)
+    assert results.number_of_steps == 5
+    assert results.variable_names == ["x1", "x2"]
+    assert isinstance(results['chains'], np.memmap)
+    thinned = results.get_chains(discard=1, thin=2)
+    assert np.array_equal(thinned[0,:,0], [1.0, 3.0])
+    assert np.shares_memory(thinned, results.get_chains())
+    assert np.shares_memory(results.get_walker(1), results.get_chains())
+    assert results.get_flat_samples(discard=3).shape == (6, 2)
+    assert list(results['acceptance_fractions']) == [1.0, 0.0, 1.0]
+    with pytest.raises(ValueError):
+        results.get_chains()[0,0,0] = 1.0
+
+#%%
+
+@pytest.fixture
+def table():
+    rng = np.random.RandomState(4)
+    R_kpc = np.linspace(1.0, 25.0, 30)
+    return np.column_stack([R_kpc, 200.0 + rng.randn(30), 1.0 + rng.rand(30), 1.0 + rng.rand(30), 0.1*rng.rand(30)])
+
+@pytest.mark.parametrize("extension",[(".csv"),(".dat"),(".npy"),(".npz")])
+def test_Rotation_curve_loader_formats(table, tmp_path, extension):
+    file_name = str(tmp_path / ("curve" + extension))
+    if extension == ".csv":
+        np.savetxt(file_name, table, delimiter=",", header="R,vc,sigma-,sigma+,syst")
+    elif extension == ".dat":
+        np.savetxt(file_name, table, header="R vc sigma- sigma+ syst")
+    elif extension == ".npy":
+        np.save(file_name, table)
+    else:
+        datahandling.Rotation_curve_data.from_table(table).save_npz(file_name)
+    loader = datahandling.Rotation_curve_loader(file_name, cache_directory=str(tmp_path / "cache"))
+    assert not loader.is_loaded
+    data = loader.get_data()
+    assert loader.is_loaded
+    assert loader.data is data
+    assert np.array_equal(np.array(data.to_data_lists()), table)
+
+@pytest.mark.parametrize("extension",[(".csv"),(".dat"),(".npy"),(".npz")])
+def test_Rotation_curve_loader_number_of_points_without_loading(table, tmp_path, extension):
+    file_name = str(tmp_path / ("curve" + extension))
+    if extension == ".csv":
+        np.savetxt(file_name, table, delimiter=",", header="R,vc,sigma-,sigma+,syst")
+    elif extension == ".dat":
+        np.savetxt(file_name, table, header="R vc sigma- sigma+ syst", footer="end of table")
+    elif extension == ".npy":
+        np.save(file_name, table)
+    else:
+        datahandling.Rotation_curve_data.from_table(table).save_npz(file_name)
+    loader = datahandling.Rotation_curve_loader(file_name, cache_directory=None)
+    assert loader.get_number_of_points() == len(table)
+    assert not loader.is_loaded
+    assert len(loader) == len(table)
+    assert loader.get_number_of_points() == len(table)
+
+def test_Rotation_curve_data_from_table_with_fewer_columns(table):
+    data = datahandling.Rotation_curve_data.from_table(table[:,:3])
+    assert np.array_equal(data.sigma_plus_km_s, table[:,2])
+    assert np.array_equal(data.syst_km_s, np.zeros(len(table)))
+    with pytest.raises(AssertionError):
+        datahandling.Rotation_curve_data.from_table(table[:,:2])
+
+def test_Rotation_curve_loader_caches_by_file_hash(table, tmp_path, monkeypatch):
+    file_name = str(tmp_path / "curve.csv")
+    cache_directory = str(tmp_path / "cache")
+    np.savetxt(file_name, table, delimiter=",")
+    datahandling.Rotation_curve_loader(file_name, cache_directory=cache_directory).get_data()
+    assert len(list((tmp_path / "cache").iterdir())) == 1
+    # a second loader reads the cached copy instead of parsing the text
+    def fail(*args, **kwargs):
+        raise AssertionError("the table was parsed again!")
+    monkeypatch.setitem(datahandling.loaders, 'csv', fail)
+    data = datahandling.Rotation_curve_loader(file_name, cache_directory=cache_directory).get_data()
+    assert np.array_equal(np.array(data.to_data_lists()), table)
+    # a modified file is parsed again
+    np.savetxt(file_name, table[:10], delimiter=",")
+    with pytest.raises(AssertionError):
+        datahandling.Rotation_curve_loader(file_name, cache_directory=cache_directory).get_data()
+
+def test_register_loader(table, tmp_path):
+    def load_reversed_columns(file_name):
+        return datahandling.Rotation_curve_data.from_table(np.loadtxt(file_name)[:, ::-1])
+    datahandling.register_loader('reversed', load_reversed_columns, extensions=('.rev',))
+    try:
+        file_name = str(tmp_path / "curve.rev")
+        np.savetxt(file_name, table[:, ::-1])
+        loader = datahandling.Rotation_curve_loader(file_name, cache_directory=None)
+        # without a row counter the number of points comes from the loaded data
+        assert loader.get_number_of_points() == len(table)
+        assert loader.is_loaded
+        data = datahandling.get_rotation_curve_data(loader)
+        assert np.array_equal(np.array(data.to_data_lists()), table)
+    finally:
+        del datahandling.loaders['reversed']
+        del datahandling.loader_extensions['.rev']
+    with pytest.raises(AssertionError):
+        datahandling.Rotation_curve_loader(str(tmp_path / "curve.unknown"))
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import pytest
+import numpy as np
+
+from .. import analysisstatistics
+from .. import galaxymodel
+from .. import emulator
+
+#%%
+
+def _curved_chi2(array_of_values):
+    x, y = array_of_values[:, 0], array_of_values[:, 1]
+    return 10.0 + (x - 1.0)**2/0.5 + (y - x**2)**2/0.25
+
+@pytest.fixture
+def curved_chi2_emulator():
+    design_points = np.random.RandomState(0).uniform([-1.0, -1.0], [2.0, 3.0], size=(80, 2))
+    return emulator.Chi2_emulator(design_points, _curved_chi2(design_points))
+
+def test_Chi2_emulator_interpolates_chi2(curved_chi2_emulator):
+    design_points = curved_chi2_emulator.design_points
+    chi2, chi2_std = curved_chi2_emulator.predict(design_points, return_std=True)
+    assert chi2 == pytest.approx(_curved_chi2(design_points),rel=1.0e-3)
+    test_points = np.random.RandomState(1).uniform([-0.5, -0.5], [1.5, 2.0], size=(200, 2))
+    errors = curved_chi2_emulator.get_errors(test_points, _curved_chi2(test_points))
+    assert np.median(errors) < 0.05
+    assert np.max(chi2_std) < 1.0e-2*curved_chi2_emulator.predict([[10.0, 10.0]], return_std=True)[1][0]
+
+def test_Chi2_emulator_caps_chi2_and_tends_to_maximum_chi2():
+    design_points = np.random.RandomState(2).uniform(-5.0, 5.0, size=(60, 2))
+    chi2_values = np.sum(design_points**2, axis=1)/0.1
+    chi2_emulator = emulator.Chi2_emulator(design_points, chi2_values, maximum_delta_chi2=30.0)
+    assert chi2_emulator.maximum_chi2 == pytest.approx(np.min(chi2_values) + 30.0)
+    assert chi2_emulator.predict(design_points) == pytest.approx(np.minimum(chi2_values, chi2_emulator.maximum_chi2),abs=1.0e-3)
+    assert chi2_emulator.predict([[1.0e3, -1.0e3]]) == pytest.approx(chi2_emulator.maximum_chi2)
+    assert list(chi2_emulator.is_inside_domain([[0.0, 0.0], [1.0e3, -1.0e3]])) == [True, False]
+
+def test_Chi2_emulator_save_and_load(curved_chi2_emulator, tmp_path):
+    file_name = str(tmp_path/'emulator.npz')
+    curved_chi2_emulator.save(file_name)
+    loaded_emulator = emulator.Chi2_emulator.load(file_name)
+    test_points = np.random.RandomState(3).uniform(-1.0, 2.0, size=(20, 2))
+    assert np.array_equal(loaded_emulator.length_scales, curved_chi2_emulator.length_scales)
+    assert loaded_emulator.predict(test_points) == pytest.approx(curved_chi2_emulator.predict(test_points),rel=1.0e-12)
+
+def test_Chi2_emulator_logarithmic_variables():
+    with pytest.raises(AssertionError):
+        emulator.Chi2_emulator(np.random.RandomState(4).uniform(-1.0, 1.0, size=(10, 2)), np.ones(10), logarithmic=[True, False])
+
+#%%
+
+@pytest.fixture
+def halo_and_disk_analysis():
+    list_of_variables = [
+        analysisstatistics.Variable('Mvir_1e11Msun', prior_function=analysisstatistics.Prior(flat_min=0.0,flat_max=1.0e3).ln_function, value=7.05),
+        analysisstatistics.Variable('cvir', prior_function=analysisstatistics.Prior(flat_min=1.0e-3,flat_max=100.0).ln_function, value=11.5),
+        analysisstatistics.Variable('Mdisk_1e10Msun', prior_function=analysisstatistics.Prior(flat_min=0.1,flat_max=1.0e2,Gaussian_mean=3.9,Gaussian_sigma=0.6).ln_function, value=3.9),
+        analysisstatistics.Variable('Rd_kpc', prior_function=analysisstatistics.Prior(flat_min=0.01,flat_max=10.0).ln_function, value=5.3),
+    ]
+    def galaxy_model_creator(d):
+        halo = galaxymodel.NFW(Mvir_in_1e11Msun=d['Mvir_1e11Msun'].value, cvir=d['cvir'].value)
+        disk = galaxymodel.Miyamoto_Nagai_disk(total_mass_Msun=d['Mdisk_1e10Msun'].value*1.0e10, a_kpc=d['Rd_kpc'].value)
+        return galaxymodel.Galactic_model(halo, disk)
+    return analysisstatistics.Analysis(list_of_variables, galaxy_model_creator)
+
+def test_Analysis_fit_chi2_emulator(capfd, halo_and_disk_analysis):
+    analysis = halo_and_disk_analysis
+    report = analysis.fit_chi2_emulator(maximum_number_of_points=80, number_of_steps=50, vectorize=True, random_state=0)
+    assert "Fitting the chi2 emulator took" in capfd.readouterr().out
+    chi2_emulator = analysis.chi2_emulator
+    assert report['number_of_points'] == chi2_emulator.number_of_points <= 80
+    assert report['number_of_exact_evaluations'] >= chi2_emulator.number_of_points
+    assert list(chi2_emulator.logarithmic) == [True, True, True, True, False]
+    positions = chi2_emulator.design_points[:5]
+    assert analysis.ln_likelihood_emulated_vectorized(positions) == pytest.approx(analysis.get_ln_priors_vectorized(positions) - chi2_emulator.predict(positions)/2)
+    assert analysis.ln_likelihood_emulated_vectorized([[7.05, 11.5, 3.9, 5.3, 1.0e3]])[0] == -np.infty
+    # refining the emulator
+    analysis.fit_chi2_emulator(maximum_number_of_points=90, number_of_steps=50, vectorize=True, random_state=1)
+    assert 80 < analysis.chi2_emulator.number_of_points <= 90
+
+@pytest.mark.parametrize("vectorize",[(True),(False)])
+def test_Analysis_compute_mcmc_with_emulator(capfd, halo_and_disk_analysis, vectorize):
+    analysis = halo_and_disk_analysis
+    with pytest.raises(AssertionError):
+        analysis.compute_mcmc_with_emulator(12, 10, None)
+    assert "ADVISE: Run fit_chi2_emulator" in capfd.readouterr().out
+    analysis.fit_chi2_emulator(maximum_number_of_points=80, number_of_steps=50, vectorize=True, random_state=0)
+    positions = analysis.chi2_emulator.design_points[np.argsort(analysis.chi2_emulator.chi2_values)[:12]]
+    with analysis:
+        if not vectorize:
+            analysis.start_pool(processes=2, executor='process')
+        report = analysis.compute_mcmc_with_emulator(12, 30, positions, validate_every=10, number_of_validation_points=3,
+                                                     tolerance=1.0e-12, vectorize=vectorize, random_state=2)
+    out = capfd.readouterr().out
+    assert "MCMC with the chi2 emulator took" in out
+    assert len(report['maximum_errors']) == 3
+    assert report['number_of_exact_evaluations'] == 9
+    assert report['number_of_refits'] == 3
+    assert report['number_of_points'] == analysis.chi2_emulator.number_of_points == 80 + 9
+    # only the steps after the last refit are kept, none here
+    assert report['last_refit_step'] == 30
+    assert analysis.sampler.iteration == 0
+    assert "ADVISE: The last validation refined the chi2 emulator" in out
+    report = analysis.compute_mcmc_with_emulator(12, 30, report['walkers_positions'], validate_every=10, number_of_validation_points=3,
+                                                 tolerance=1.0e12, vectorize=True, random_state=3)
+    assert report['number_of_refits'] == 0 and report['last_refit_step'] == 0
+    assert analysis.sampler.get_chain().shape == (30, 12, 5)
+    assert "ADVISE" not in capfd.readouterr().out
+
+def test_Analysis_chi2_emulator_is_kept_when_the_priors_change(halo_and_disk_analysis, tmp_path):
+    analysis = halo_and_disk_analysis
+    analysis.fit_chi2_emulator(maximum_number_of_points=80, number_of_steps=50, vectorize=True, random_state=0)
+    positions = analysis.chi2_emulator.design_points[:5]
+    ln_data_likelihoods = analysis.ln_likelihood_emulated_vectorized(positions) - analysis.get_ln_priors_vectorized(positions)
+    analysis._variables_dictionary['R_sun']._prior_function = analysisstatistics.Prior(Gaussian_mean=8.2, Gaussian_sigma=0.1).ln_function
+    analysis.compile_prior_table()
+    ln_priors = analysis.get_ln_priors_vectorized(positions)
+    assert analysis.ln_likelihood_emulated_vectorized(positions) == pytest.approx(ln_priors + ln_data_likelihoods,1.0e-12)
+    file_name = str(tmp_path/'emulator.npz')
+    analysis.chi2_emulator.save(file_name)
+    analysis.remove_chi2_emulator()
+    assert analysis.chi2_emulator is None
+    analysis.set_chi2_emulator(emulator.Chi2_emulator.load(file_name))
+    assert analysis.ln_likelihood_emulated_vectorized(positions) - analysis.get_ln_priors_vectorized(positions) == pytest.approx(-analysis.chi2_emulator.predict(positions)/2)
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import os
 import pytest
 import numpy as np
 
@@ -98,3 +99,149 @@ def test_Galactic_model_circular_velocity_equals_sum_from_components(r):
     
     
     
+
+@pytest.mark.parametrize("r",[(5.0),(8.0),(30.0)])
+def test_squared_circular_velocity_from_parameters_equals_instance(r):
+    halo = galaxymodel.NFW(10.5, 12.8, Delta_vir=220.2, h_cosmo=0.77)
+    assert galaxymodel.NFW.squared_circular_velocity_from_parameters_km2_s2(r, 10.5, 12.8, Delta_vir=220.2, h_cosmo=0.77) == halo.squared_circular_velocity_km2_s2(r)
+    disk = galaxymodel.Miyamoto_Nagai_disk(total_mass_Msun=1.7e10, a_kpc=2.1, b_kpc=0.27)
+    assert galaxymodel.Miyamoto_Nagai_disk.squared_circular_velocity_from_parameters_km2_s2(r, 1.7e10, 2.1, 0.27) == disk.squared_circular_velocity_km2_s2(r)
+    bulge = galaxymodel.Plummer(total_mass_Msun=1.3e10, b_kpc=0.27)
+    assert galaxymodel.Plummer.squared_circular_velocity_from_parameters_km2_s2(r, 1.3e10, 0.27) == bulge.squared_circular_velocity_km2_s2(r)
+
+def _numerical_gradient(function, parameters, relative_step=1.0e-6):
+    gradient = {}
+    for name, value in parameters.items():
+        step = relative_step*abs(value)
+        upper = dict(parameters, **{name:value+step})
+        lower = dict(parameters, **{name:value-step})
+        gradient[name] = (function(**upper) - function(**lower))/(2.0*step)
+    return gradient
+
+@pytest.mark.parametrize("potential_class,parameters",[
+    (galaxymodel.NFW, {'Mvir_in_1e11Msun':10.5, 'cvir':12.8, 'Delta_vir':220.2, 'h_cosmo':0.77}),
+    (galaxymodel.Miyamoto_Nagai_disk, {'total_mass_Msun':1.7e10, 'a_kpc':2.1, 'b_kpc':0.27}),
+    (galaxymodel.Plummer, {'total_mass_Msun':1.3e10, 'b_kpc':0.27}),
+])
+def test_squared_circular_velocity_gradient_equals_numerical_gradient(potential_class, parameters):
+    r = np.array([0.5, 5.0, 8.0, 30.0])
+    gradient = potential_class.squared_circular_velocity_gradient_from_parameters_km2_s2(r, **parameters)
+    numerical_gradient = _numerical_gradient(lambda **p: potential_class.squared_circular_velocity_from_parameters_km2_s2(r, **p), parameters)
+    assert set(gradient) == set(parameters)
+    for name in parameters:
+        assert gradient[name] == pytest.approx(numerical_gradient[name],1.0e-6)
+    instance_gradient = potential_class(**parameters).squared_circular_velocity_gradient_km2_s2(r)
+    for name in parameters:
+        assert np.array_equal(instance_gradient[name], gradient[name])
+
+def test_halo_derived_quantities_are_cached():
+    galaxymodel.clear_cache()
+    halo = galaxymodel.NFW(10.5, 12.8)
+    for r in (5.0, 8.0, 30.0):
+        halo.squared_circular_velocity_km2_s2(r)
+        galaxymodel.NFW.squared_circular_velocity_from_parameters_km2_s2(r, 10.5, 12.8)
+        galaxymodel.NFW(10.5, 12.8)
+    assert galaxymodel._halo_derived_quantities.cache_info().hits == 6
+    assert galaxymodel._halo_derived_quantities.cache_info().currsize == 1
+    halo.update_cvir(7.0)
+    assert galaxymodel._halo_derived_quantities.cache_info().currsize == 2
+    assert halo.squared_circular_velocity_km2_s2(8.0) == galaxymodel.NFW(10.5, 7.0).squared_circular_velocity_km2_s2(8.0)
+
+def test_halo_derived_quantities_with_arrays_of_parameters():
+    galaxymodel.clear_cache()
+    Mvir = np.array([[8.0], [10.5]])
+    cvir = np.array([[14.0], [12.8]])
+    r = np.array([5.0, 8.0, 30.0])
+    Vc2 = galaxymodel.NFW.squared_circular_velocity_from_parameters_km2_s2(r, Mvir, cvir)
+    assert galaxymodel._halo_derived_quantities.cache_info().currsize == 0
+    assert Vc2.shape == (2, 3)
+    for k in range(2):
+        assert Vc2[k] == pytest.approx(galaxymodel.NFW(Mvir[k,0], cvir[k,0]).squared_circular_velocity_km2_s2(r),1.0e-14)
+    halo = galaxymodel.NFW(Mvir, cvir)
+    assert halo.density_GeV_cm3(r) == pytest.approx(np.array([galaxymodel.NFW(Mvir[k,0], cvir[k,0]).density_GeV_cm3(r) for k in range(2)]),1.0e-14)
+
+@pytest.mark.parametrize("r",[(0.5),(8.0),(30.0)])
+def test_Plummer_density_is_derivative_of_enclosed_mass(r):
+    bulge = galaxymodel.Plummer()
+    step = 1.0e-5*r
+    dM_dr = (bulge.enclosed_mass_in_Msun(r+step) - bulge.enclosed_mass_in_Msun(r-step))/(2.0*step)
+    assert bulge.density_Msun_kpc3(r) == pytest.approx(dM_dr/(4.0*np.pi*r**2),1.0e-6)
+
+def test_Galactic_model_density_equals_sum_from_components():
+    potentials = [galaxymodel.NFW(), galaxymodel.Miyamoto_Nagai_disk(), galaxymodel.Plummer()]
+    GM = galaxymodel.Galactic_model(*potentials)
+    assert GM.potentials == tuple(potentials)
+    r = np.array([0.5, 8.0, 30.0])
+    assert GM.density_GeV_cm3(r) == pytest.approx(sum([pot.density_GeV_cm3(r) for pot in potentials]),1.0e-12)
+
+@pytest.fixture
+def table_cache_directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(galaxymodel.Tabulated_halo, 'table_cache_directory', str(tmp_path))
+    monkeypatch.setattr(galaxymodel.Tabulated_halo, '_tables', {})
+    return str(tmp_path)
+
+def test_Generalised_NFW_with_gamma_1_equals_NFW(table_cache_directory):
+    r = np.logspace(-2, 2.5, 50)
+    halo = galaxymodel.Generalised_NFW(9.0, 14.0, gamma=1.0)
+    NFW = galaxymodel.NFW(9.0, 14.0)
+    assert halo.squared_circular_velocity_km2_s2(r) == pytest.approx(NFW.squared_circular_velocity_km2_s2(r),1.0e-5)
+    assert halo.density_Msun_kpc3(r) == pytest.approx(NFW.density_Msun_kpc3(r),1.0e-5)
+    assert halo.enclosed_mass_in_Msun(halo.rvir_kpc) == pytest.approx(halo.Mvir_in_Msun,1.0e-12)
+
+@pytest.mark.parametrize("gamma",[(0.0),(0.37),(1.53)])
+def test_Generalised_NFW_table_equals_numerical_integration(table_cache_directory, gamma):
+    from scipy.integrate import quad
+    table = galaxymodel.Generalised_NFW.get_table()
+    x = np.array([1.0e-3, 0.1, 1.0, 20.0, 1.0e3])
+    m = [quad(lambda y: y**(2.0-gamma)*(1.0+y)**(gamma-3.0), 0.0, xx, limit=200)[0] for xx in x]
+    assert table.enclosed_mass(x, gamma) == pytest.approx(np.array(m),1.0e-4)
+
+@pytest.mark.parametrize("alpha",[(0.0731),(0.17),(0.5)])
+def test_Einasto_table_equals_closed_form(table_cache_directory, alpha):
+    from scipy.special import gamma, gammainc
+    table = galaxymodel.Einasto.get_table()
+    x = np.array([1.0e-2, 0.1, 1.0, 20.0, 1.0e3])
+    m = np.exp(2.0/alpha)/alpha*(alpha/2.0)**(3.0/alpha)*gamma(3.0/alpha)*gammainc(3.0/alpha, 2.0*x**alpha/alpha)
+    assert table.enclosed_mass(x, alpha) == pytest.approx(m,1.0e-4)
+
+def test_tabulated_halo_vectorized_and_out_of_range(table_cache_directory):
+    r = np.array([0.5, 8.0, 30.0])
+    Mvir, cvir, alpha = np.array([[8.0],[12.0]]), np.array([[10.0],[15.0]]), np.array([[0.15],[0.3]])
+    Vc2 = galaxymodel.Einasto.squared_circular_velocity_from_parameters_km2_s2(r, Mvir, cvir, alpha)
+    for k in range(2):
+        halo = galaxymodel.Einasto(Mvir[k,0], cvir[k,0], alpha=alpha[k,0])
+        assert Vc2[k] == pytest.approx(halo.squared_circular_velocity_km2_s2(r),1.0e-12)
+    assert np.all(np.isnan(galaxymodel.Einasto(alpha=2.0).squared_circular_velocity_km2_s2(r)))
+
+def test_tabulated_halo_needs_a_dimensionless_density():
+    with pytest.raises(AssertionError, match="Tabulated_halo must define dimensionless_density"):
+        galaxymodel.Tabulated_halo(8.0, 10.0, 0.5)
+    with pytest.raises(NotImplementedError):
+        galaxymodel.Tabulated_halo.dimensionless_density(1.0, 0.5)
+
+def test_tabulated_halo_table_is_cached_on_disk(table_cache_directory):
+    table = galaxymodel.Generalised_NFW.get_table()
+    cache_file = table._get_cache_file()
+    assert os.path.isfile(cache_file)
+    galaxymodel.Tabulated_halo._tables.clear()
+    np.savez(cache_file, ln_m=np.zeros_like(table.ln_m))
+    assert np.all(galaxymodel.Generalised_NFW.get_table().ln_m == 0.0)
+
+def test_tabulated_halo_table_shared_by_threads(table_cache_directory):
+    # the single-shape row cache of the shared table must not mix shapes
+    import concurrent.futures
+    table = galaxymodel.Einasto.get_table()
+    ln_x = np.log(np.array([0.01, 1.0, 30.0]))
+    alphas = [0.12, 0.17, 0.25, 0.4]*250
+    expected = {alpha: table.ln_enclosed_mass(ln_x, np.full(len(ln_x), alpha)) for alpha in set(alphas)}
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(lambda alpha: table.ln_enclosed_mass(ln_x, alpha), alphas))
+    for alpha, result in zip(alphas, results):
+        assert result == pytest.approx(expected[alpha],1.0e-12)
+
+def test_Galactic_model_with_tabulated_halo(table_cache_directory):
+    r = np.array([0.5, 8.0, 30.0])
+    halo = galaxymodel.Einasto()
+    disk = galaxymodel.Miyamoto_Nagai_disk()
+    GM = galaxymodel.Galactic_model(halo, disk)
+    assert GM.squared_circular_velocity_km2_s2(r) == pytest.approx(halo.squared_circular_velocity_km2_s2(r) + disk.squared_circular_velocity_km2_s2(r),1.0e-12)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import json
+import pstats
+import pytest
+import numpy as np
+
+from .. import analysisstatistics
+from .. import galaxymodel
+
+#%%
+
+@pytest.fixture
+def halo_and_disk_analysis():
+    list_of_variables = [
+        analysisstatistics.Variable('Mvir_1e11Msun', prior_function=analysisstatistics.Prior(flat_min=0.0,flat_max=1.0e3).ln_function, value=7.05),
+        analysisstatistics.Variable('cvir', prior_function=analysisstatistics.Prior(flat_min=1.0e-3,flat_max=100.0).ln_function, value=11.5),
+        analysisstatistics.Variable('Mdisk_1e10Msun', prior_function=analysisstatistics.Prior(flat_min=0.1,flat_max=1.0e2,Gaussian_mean=3.9,Gaussian_sigma=0.6).ln_function, value=3.9),
+        analysisstatistics.Variable('Rd_kpc', prior_function=analysisstatistics.Prior(flat_min=0.01,flat_max=10.0).ln_function, value=5.3),
+    ]
+    def galaxy_model_creator(d):
+        halo = galaxymodel.NFW(Mvir_in_1e11Msun=d['Mvir_1e11Msun'].value, cvir=d['cvir'].value)
+        disk = galaxymodel.Miyamoto_Nagai_disk(total_mass_Msun=d['Mdisk_1e10Msun'].value*1.0e10, a_kpc=d['Rd_kpc'].value)
+        return galaxymodel.Galactic_model(halo, disk)
+    return analysisstatistics.Analysis(list_of_variables, galaxy_model_creator)
+
+@pytest.fixture
+def walkers_positions():
+    positions = np.array([7.05, 11.5, 3.9, 5.3, 8.122]) + 0.05*np.random.RandomState(7).randn(6,5)
+    positions[1,0] = -1.0 # out of the flat prior of Mvir
+    return positions
+
+def test_instrumented_likelihood_equals_likelihood(halo_and_disk_analysis, walkers_positions):
+    analysis = halo_and_disk_analysis
+    ln_likelihoods = analysis.ln_likelihood_vectorized(walkers_positions)
+    instrumentation = analysis.start_instrumentation()
+    assert analysis.instrumentation is instrumentation
+    assert analysis.ln_likelihood_vectorized(walkers_positions) == pytest.approx(ln_likelihoods,1.0e-12)
+    for values, ln_likelihood in zip(walkers_positions, ln_likelihoods):
+        assert analysis.ln_likelihood(values) == pytest.approx(ln_likelihood,1.0e-12)
+    assert analysis.stop_instrumentation() is instrumentation
+    assert analysis.instrumentation is None
+    assert instrumentation.likelihood_calls == 1 + len(walkers_positions)
+    assert instrumentation.likelihood_evaluations == 2*len(walkers_positions)
+    sections = instrumentation.sections
+    assert sections['prior']['evaluations'] == 2*len(walkers_positions)
+    assert sections['model']['evaluations'] == sections['chi2']['evaluations'] == 2*(len(walkers_positions) - 1)
+    assert sections['model']['calls'] == 1 + len(walkers_positions) - 1
+    assert all(section['seconds'] > 0.0 for section in sections.values())
+
+def test_instrumentation_times_the_fused_kernel(halo_and_disk_analysis, walkers_positions):
+    analysis = halo_and_disk_analysis
+    analysis.compile_parameter_map(analysisstatistics.Parameter_map(galaxymodel.NFW, Mvir_in_1e11Msun='Mvir_1e11Msun', cvir='cvir'),
+                                   analysisstatistics.Parameter_map(galaxymodel.Miyamoto_Nagai_disk, total_mass_Msun=('Mdisk_1e10Msun',1.0e10), a_kpc='Rd_kpc'))
+    analysis.compile_fused_kernel(backend='numpy')
+    ln_likelihoods = analysis.ln_likelihood_vectorized(walkers_positions)
+    instrumentation = analysis.start_instrumentation()
+    assert analysis.ln_likelihood_vectorized(walkers_positions) == pytest.approx(ln_likelihoods,1.0e-12)
+    analysis.stop_instrumentation()
+    # the model is only computed inside the fused kernel
+    sections = instrumentation.sections
+    assert sections['model']['calls'] == 0
+    assert sections['chi2']['evaluations'] == len(walkers_positions) - 1
+
+def test_instrumentation_report_of_mcmc(tmp_path, halo_and_disk_analysis):
+    analysis = halo_and_disk_analysis
+    positions = np.array([7.05, 11.5, 3.9, 5.3, 8.122]) + 1.0e-3*np.random.RandomState(3).randn(12,5)
+    instrumentation = analysis.start_instrumentation(profile=True)
+    analysis.compute_mcmc(12, 5, positions, vectorize=True)
+    analysis.stop_instrumentation()
+    report = instrumentation.get_report()
+    assert report['steps']['number_of_steps'] == 5
+    assert len(instrumentation.step_seconds) == 5
+    assert report['likelihood_evaluations'] == 12 + 5*12 # the initial state and two halves of the ensemble per step
+    assert sum(section['fraction'] for section in report['sections'].values()) == pytest.approx(1.0)
+    assert 'executor' not in report
+    instrumentation.save_json(str(tmp_path / 'trace.json'))
+    with open(str(tmp_path / 'trace.json'), 'r') as f:
+        trace = json.load(f)
+    assert trace['step_seconds'] == pytest.approx(list(instrumentation.step_seconds))
+    instrumentation.save_profile(str(tmp_path / 'profile.pstats'))
+    assert pstats.Stats(str(tmp_path / 'profile.pstats')).total_calls > 0
+
+@pytest.mark.parametrize("executor",[("serial"),("process")])
+def test_instrumentation_of_executor(halo_and_disk_analysis, walkers_positions, executor):
+    analysis = halo_and_disk_analysis
+    positions = np.array([7.05, 11.5, 3.9, 5.3, 8.122]) + 1.0e-3*np.random.RandomState(3).randn(12,5)
+    with analysis:
+        analysis.start_pool(processes=2, executor=executor)
+        instrumentation = analysis.start_instrumentation()
+        analysis.compute_mcmc(12, 3, positions)
+        analysis.stop_instrumentation()
+    report = instrumentation.get_report()
+    assert report['executor']['workers'] == (1 if executor == 'serial' else 2)
+    assert report['executor']['batches'] == 1 + 2*3
+    assert report['sections']['model']['evaluations'] == 12 + 3*12
+    assert report['executor']['idle_seconds'] >= 0.0
+    assert report['steps']['number_of_steps'] == 3
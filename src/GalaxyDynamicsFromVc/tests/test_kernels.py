@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import pytest
+import numpy as np
+
+from .. import analysisstatistics
+from .. import galaxymodel
+from .. import kernels
+
+#%%
+
+@pytest.fixture
+def halo_disk_and_bulge_analysis():
+    list_of_variables = [
+        analysisstatistics.Variable('Mvir_1e11Msun', prior_function=analysisstatistics.Prior(flat_min=0.0,flat_max=1.0e3).ln_function, value=7.05),
+        analysisstatistics.Variable('cvir', prior_function=analysisstatistics.Prior(flat_min=1.0e-3,flat_max=100.0).ln_function, value=11.5),
+        analysisstatistics.Variable('Mdisk_1e10Msun', prior_function=analysisstatistics.Prior(flat_min=0.1,flat_max=1.0e2).ln_function, value=3.9),
+        analysisstatistics.Variable('Rd_kpc', prior_function=analysisstatistics.Prior(flat_min=0.01,flat_max=10.0).ln_function, value=5.3),
+        analysisstatistics.Variable('Mbulge_1e10Msun', prior_function=analysisstatistics.Prior(flat_min=0.01,flat_max=1.0e2).ln_function, value=1.1),
+    ]
+    def galaxy_model_creator(d):
+        halo = galaxymodel.NFW(Mvir_in_1e11Msun=d['Mvir_1e11Msun'].value, cvir=d['cvir'].value)
+        disk = galaxymodel.Miyamoto_Nagai_disk(total_mass_Msun=d['Mdisk_1e10Msun'].value*1.0e10, a_kpc=d['Rd_kpc'].value)
+        bulge = galaxymodel.Plummer(total_mass_Msun=d['Mbulge_1e10Msun'].value*1.0e10)
+        return galaxymodel.Galactic_model(halo, disk, bulge)
+    parameter_maps = [analysisstatistics.Parameter_map(galaxymodel.NFW, Mvir_in_1e11Msun='Mvir_1e11Msun', cvir='cvir'),
+                      analysisstatistics.Parameter_map(galaxymodel.Miyamoto_Nagai_disk, total_mass_Msun=('Mdisk_1e10Msun',1.0e10), a_kpc='Rd_kpc'),
+                      analysisstatistics.Parameter_map(galaxymodel.Plummer, total_mass_Msun=('Mbulge_1e10Msun',1.0e10))]
+    return analysisstatistics.Analysis(list_of_variables, galaxy_model_creator, parameter_maps=parameter_maps)
+
+@pytest.fixture
+def walkers_positions():
+    positions = np.array([7.05, 11.5, 3.9, 5.3, 1.1, 8.122]) + 0.05*np.random.RandomState(7).randn(8,6)
+    positions[1,0] = -1.0 # out of the flat prior of Mvir
+    return positions
+
+def test_numpy_fused_kernel_is_identical_to_reference(halo_disk_and_bulge_analysis, walkers_positions):
+    analysis = halo_disk_and_bulge_analysis
+    ln_likelihoods = analysis.ln_likelihood_vectorized(walkers_positions)
+    assert analysis.compile_fused_kernel(backend='numpy') == 'numpy'
+    for k in range(2): # the second call reuses the buffers
+        assert np.array_equal(analysis.ln_likelihood_vectorized(walkers_positions), ln_likelihoods)
+    assert np.array_equal(analysis.ln_likelihood_vectorized(walkers_positions[:3]), ln_likelihoods[:3])
+    analysis.remove_fused_kernel()
+    assert analysis.fused_kernel is None
+
+def test_single_pass_kernel_equals_reference(halo_disk_and_bulge_analysis, walkers_positions, monkeypatch):
+    # the loops compiled by numba, run here as plain Python
+    analysis = halo_disk_and_bulge_analysis
+    positions = np.delete(walkers_positions, 1, axis=0)
+    ln_priors = analysis.get_ln_priors_vectorized(positions)
+    ln_likelihoods = analysis.ln_likelihood_vectorized(positions)
+    monkeypatch.setattr(kernels, '_numba_kernel', kernels._fused_chi2_loops)
+    data = analysis.data
+    fused_chi2 = kernels.Fused_chi2(analysis._compiled_parameter_map, data.R_kpc, data.vc_km_s, data.inverse_variance, backend='numba')
+    assert ln_priors - fused_chi2.chi2(positions)/2 == pytest.approx(ln_likelihoods,1.0e-12)
+
+def test_fused_kernel_falls_back_for_other_potentials(tmp_path, monkeypatch):
+    monkeypatch.setattr(galaxymodel.Tabulated_halo, 'table_cache_directory', str(tmp_path))
+    compiled_parameter_map = [(galaxymodel.Einasto.squared_circular_velocity_from_parameters_km2_s2, ((0, 1.0), (None, 12.0), (None, 0.2), (None, 200.0), (None, 0.678))),
+                              (galaxymodel.Plummer.squared_circular_velocity_from_parameters_km2_s2, ((1, 1.0e10), (None, 0.3)))]
+    R_kpc = np.linspace(1.0, 30.0, 20)
+    fused_chi2 = kernels.Fused_chi2(compiled_parameter_map, R_kpc, 200.0 + 0.0*R_kpc, 0.01 + 0.0*R_kpc)
+    assert fused_chi2.backend == 'numpy'
+    values = np.array([[8.0, 2.0], [10.0, 1.0]])
+    for k in range(2):
+        Vc2 = (galaxymodel.Einasto(values[k,0], 12.0, alpha=0.2).squared_circular_velocity_km2_s2(R_kpc)
+               + galaxymodel.Plummer(values[k,1]*1.0e10).squared_circular_velocity_km2_s2(R_kpc))
+        assert fused_chi2.chi2(values)[k] == pytest.approx(np.sum((200.0 - np.sqrt(Vc2))**2*0.01),1.0e-12)
+    with pytest.raises(AssertionError):
+        kernels.Fused_chi2(compiled_parameter_map, R_kpc, R_kpc, R_kpc, backend='numba')
+
+def test_fused_kernel_needs_parameter_map(halo_disk_and_bulge_analysis):
+    analysis = halo_disk_and_bulge_analysis
+    analysis.compile_fused_kernel()
+    analysis.remove_parameter_map()
+    assert analysis.fused_kernel is None
+    with pytest.raises(AssertionError):
+        analysis.compile_fused_kernel()
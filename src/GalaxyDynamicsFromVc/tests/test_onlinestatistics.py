@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import pytest
+import numpy as np
+
+from .. import onlinestatistics
+
+#%%
+
+@pytest.fixture
+def samples():
+    rng = np.random.RandomState(2)
+    return np.column_stack([rng.randn(5000), 1.0 + 3.0*rng.exponential(size=5000), rng.uniform(-2.0, 2.0, size=5000)])
+
+def test_Running_moments_equals_numpy(samples):
+    running_moments = onlinestatistics.Running_moments(3)
+    for block in np.array_split(samples, 17):
+        running_moments.update(block)
+    assert running_moments.number_of_values == len(samples)
+    assert running_moments.mean == pytest.approx(np.mean(samples, axis=0),1.0e-12)
+    assert running_moments.covariance == pytest.approx(np.cov(samples.T),1.0e-10)
+    assert running_moments.std == pytest.approx(np.std(samples, axis=0, ddof=1),1.0e-10)
+
+def test_P2_quantiles_approximate_numpy(samples):
+    percentiles = [5.0, 50.0, 95.0]
+    P2_quantiles = onlinestatistics.P2_quantiles(percentiles, 3)
+    P2_quantiles.update(samples[:3])
+    assert P2_quantiles.get_quantiles() == pytest.approx(np.percentile(samples[:3], percentiles, axis=0))
+    P2_quantiles.update(samples[3:])
+    spread = np.percentile(samples, 95.0, axis=0) - np.percentile(samples, 5.0, axis=0)
+    assert np.all(np.abs(P2_quantiles.get_quantiles() - np.percentile(samples, percentiles, axis=0)) < 0.02*spread)
+
+def test_Binned_percentiles_of_constant_and_uniform_columns():
+    rng = np.random.RandomState(5)
+    values = np.column_stack([np.full(10000, 2.0), rng.uniform(size=10000)])
+    binned_percentiles = onlinestatistics.Binned_percentiles(values.min(axis=0), values.max(axis=0), number_of_bins=100)
+    for block in np.array_split(values, 7):
+        binned_percentiles.add(block)
+    percentiles = binned_percentiles.get_percentiles([10.0, 50.0, 90.0])
+    assert binned_percentiles.number_of_values == 10000
+    assert percentiles[:,0] == pytest.approx([2.0, 2.0, 2.0])
+    assert percentiles[:,1] == pytest.approx(np.percentile(values[:,1], [10.0, 50.0, 90.0]),abs=0.01)
+
+def test_Binned_percentiles_counts_values_outside_the_range():
+    binned_percentiles = onlinestatistics.Binned_percentiles([0.0], [1.0], number_of_bins=4)
+    binned_percentiles.add(np.array([[-1.0], [0.1], [0.6], [1.0], [3.0], [np.nan]]))
+    assert list(binned_percentiles.counts[0]) == [1, 0, 1, 1]
+    assert binned_percentiles.number_below[0] == 1
+    assert binned_percentiles.number_above[0] == 2
+    assert binned_percentiles.get_percentiles([1.0, 99.0])[:,0] == pytest.approx([0.0, 1.0])
+
+def test_Histograms_2d_equal_numpy(samples):
+    minimum, maximum = [-3.0, 1.0, -2.0], [3.0, 20.0, 2.0]
+    histograms = onlinestatistics.Histograms_2d(minimum, maximum, number_of_bins=20)
+    for block in np.array_split(samples, 9):
+        histograms.add(block)
+    edges = histograms.edges
+    for i, j in [(0, 1), (2, 0)]:
+        counts, x_edges, y_edges = np.histogram2d(samples[:,i], samples[:,j], bins=[edges[i], edges[j]])
+        assert np.array_equal(histograms.get_counts(i, j), counts)
+    assert np.array_equal(histograms.counts[1], np.histogram(samples[:,1], bins=edges[1])[0])
+
+@pytest.mark.parametrize("quantile_method",[("histogram"),("P2")])
+def test_Posterior_summary_from_chains(samples, quantile_method):
+    chains = samples.reshape((10, 500, 3))
+    summary = onlinestatistics.Posterior_summary(3, variable_names=['a', 'b', 'c'], percentiles=(16.0, 50.0, 84.0), quantile_method=quantile_method)
+    summary.update_from_chains(chains, discard=100, thin=2, steps_per_block=30)
+    flat_samples = chains[:, 100::2].reshape((-1, 3))
+    table = summary.get_table()
+    assert table['number_of_samples'] == len(flat_samples)
+    assert table['mean'] == pytest.approx(np.mean(flat_samples, axis=0),1.0e-12)
+    spread = np.percentile(flat_samples, 84.0, axis=0) - np.percentile(flat_samples, 16.0, axis=0)
+    assert np.all(np.abs(table['quantiles'] - np.percentile(flat_samples, [16.0, 50.0, 84.0], axis=0)) < 0.05*spread)
+    assert summary.histograms_2d.get_counts(0, 2).sum() <= len(flat_samples)
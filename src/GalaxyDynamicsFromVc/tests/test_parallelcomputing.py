@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import pytest
+import numpy as np
+
+from .. import parallelcomputing
+
+#%%
+
+@pytest.mark.parametrize("number_of_chunks,chunksize,expected_lengths",[(3,None,[4,4,2]),(None,3,[3,3,3,1]),(20,None,[1]*10)])
+def test_split_in_chunks(number_of_chunks, chunksize, expected_lengths):
+    values = np.arange(30.0).reshape((10,3))
+    chunks = parallelcomputing.split_in_chunks(values, number_of_chunks=number_of_chunks, chunksize=chunksize)
+    assert [len(chunk) for chunk in chunks] == expected_lengths
+    assert np.array_equal(np.concatenate(chunks), values)
+
+def test_Process_pool_ill_defined_settings():
+    with pytest.raises(AssertionError):
+        parallelcomputing.Process_pool(None, processes=0)
+    with pytest.raises(AssertionError):
+        parallelcomputing.Process_pool(None, processes=1, chunksize=2.5)
+
+def test_get_number_of_available_cores_honours_the_scheduler(monkeypatch):
+    monkeypatch.delenv("SLURM_CPUS_PER_TASK", raising=False)
+    monkeypatch.delenv("NSLOTS", raising=False)
+    number_of_cores = parallelcomputing.get_number_of_available_cores()
+    monkeypatch.setenv("SLURM_CPUS_PER_TASK", "1")
+    assert parallelcomputing.get_number_of_available_cores() == 1
+    monkeypatch.setenv("SLURM_CPUS_PER_TASK", str(number_of_cores+5))
+    assert parallelcomputing.get_number_of_available_cores() == number_of_cores
+
+def test_create_executor_ill_defined_settings():
+    with pytest.raises(AssertionError):
+        parallelcomputing.create_executor('gpu', None)
+    with pytest.raises(AssertionError):
+        parallelcomputing.create_executor('cluster', None, processes=0)
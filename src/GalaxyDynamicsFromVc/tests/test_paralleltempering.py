@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import pytest
+import numpy as np
+
+from .. import analysisstatistics
+from .. import galaxymodel
+from .. import paralleltempering
+from .. import datahandling
+
+#%%
+
+def _two_separated_modes(array_of_values):
+    ln_priors = np.where(np.all(np.abs(array_of_values) < 10.0, axis=1), 0.0, -np.infty)
+    ln_likelihoods = np.logaddexp(-0.5*np.sum((array_of_values - 3.0)**2, axis=1)/0.3**2,
+                                  -0.5*np.sum((array_of_values + 3.0)**2, axis=1)/0.3**2)
+    return ln_priors, ln_likelihoods
+
+def test_temperature_ladder():
+    betas = paralleltempering.get_temperature_ladder(5, 2, maximum_temperature=16.0)
+    assert betas == pytest.approx([1.0, 0.5, 0.25, 0.125, 0.0625])
+    assert paralleltempering.get_temperature_ladder(3, 8) == pytest.approx([1.0, 1.0/1.5, 1.0/2.25])
+
+def test_parallel_tempering_visits_both_modes():
+    initial_positions = 3.0 + 0.1*np.random.RandomState(0).randn(16, 2)
+    fractions_in_positive_mode = []
+    for number_of_temperatures in (1, 6):
+        betas = paralleltempering.get_temperature_ladder(number_of_temperatures, 2, maximum_temperature=100.0)
+        sampler = paralleltempering.Parallel_tempering_sampler(16, 2, _two_separated_modes, betas, random_state=1)
+        sampler.run_mcmc(initial_positions, 1000)
+        assert sampler.get_chain().shape == (1000, 16, 2)
+        assert sampler.number_of_likelihood_evaluations == number_of_temperatures*16*(1 + 1000)
+        fractions_in_positive_mode.append(np.mean(sampler.get_chain(flat=True, discard=100)[:, 0] > 0.0))
+    assert fractions_in_positive_mode[0] == 1.0 # a single temperature stays in its mode
+    assert fractions_in_positive_mode[1] == pytest.approx(0.5, abs=0.15)
+    assert np.all(sampler.swap_acceptance_fractions > 0.2)
+    assert sampler.get_log_prob().shape == (1000, 16)
+
+def test_parallel_tempering_chain_has_the_posterior_ln_likelihood():
+    # the ln probability stored at beta = 1 is ln prior + ln likelihood of the position
+    sampler = paralleltempering.Parallel_tempering_sampler(8, 2, _two_separated_modes, [1.0, 0.5], random_state=2)
+    sampler.run_mcmc(3.0 + 0.1*np.random.RandomState(0).randn(8, 2), 20)
+    ln_priors, ln_likelihoods = _two_separated_modes(sampler.get_chain(flat=True))
+    assert sampler.get_log_prob(flat=True) == pytest.approx(ln_priors + ln_likelihoods, 1.0e-12)
+    with pytest.raises(AssertionError):
+        paralleltempering.Parallel_tempering_sampler(8, 2, _two_separated_modes, [0.5, 1.0])
+
+@pytest.fixture
+def halo_and_disk_analysis():
+    list_of_variables = [
+        analysisstatistics.Variable('Mvir_1e11Msun', prior_function=analysisstatistics.Prior(flat_min=0.0,flat_max=1.0e3).ln_function, value=7.05),
+        analysisstatistics.Variable('cvir', prior_function=analysisstatistics.Prior(flat_min=1.0e-3,flat_max=100.0).ln_function, value=11.5),
+        analysisstatistics.Variable('Mdisk_1e10Msun', prior_function=analysisstatistics.Prior(flat_min=0.1,flat_max=1.0e2,Gaussian_mean=3.9,Gaussian_sigma=0.6).ln_function, value=3.9),
+        analysisstatistics.Variable('Rd_kpc', prior_function=analysisstatistics.Prior(flat_min=0.01,flat_max=10.0).ln_function, value=5.3),
+    ]
+    def galaxy_model_creator(d):
+        halo = galaxymodel.NFW(Mvir_in_1e11Msun=d['Mvir_1e11Msun'].value, cvir=d['cvir'].value)
+        disk = galaxymodel.Miyamoto_Nagai_disk(total_mass_Msun=d['Mdisk_1e10Msun'].value*1.0e10, a_kpc=d['Rd_kpc'].value)
+        return galaxymodel.Galactic_model(halo, disk)
+    return analysisstatistics.Analysis(list_of_variables, galaxy_model_creator)
+
+def test_Analysis_ln_priors_and_ln_data_likelihoods_sum_to_ln_likelihood(halo_and_disk_analysis):
+    analysis = halo_and_disk_analysis
+    positions = np.array([7.05, 11.5, 3.9, 5.3, 8.122]) + 0.05*np.random.RandomState(7).randn(6,5)
+    positions[1,0] = -1.0 # out of the flat prior of Mvir
+    ln_priors, ln_data_likelihoods = analysis.get_ln_priors_and_ln_data_likelihoods_vectorized(positions)
+    assert ln_data_likelihoods[1] == 0.0
+    assert ln_priors + ln_data_likelihoods == pytest.approx(analysis.ln_likelihood_vectorized(positions),1.0e-12)
+
+@pytest.mark.parametrize("vectorize",[(True),(False)])
+def test_Analysis_compute_parallel_tempering(capfd, halo_and_disk_analysis, vectorize):
+    analysis = halo_and_disk_analysis
+    positions = np.array([7.05, 11.5, 3.9, 5.3, 8.122]) + 1.0e-2*np.random.RandomState(3).randn(12,5)
+    with analysis:
+        if not vectorize:
+            analysis.start_pool(processes=2, executor='process')
+        report = analysis.compute_parallel_tempering(12, 10, walkers_positions=positions, number_of_temperatures=3,
+                                                     number_of_steps_burntin=5, vectorize=vectorize, random_state=0)
+    out, err = capfd.readouterr()
+    assert "Parallel tempering took" in out
+    assert len(report['betas']) == 3 and report['betas'][0] == 1.0
+    assert len(report['swap_acceptance_fractions']) == 2
+    assert report['number_of_steps'] == 10
+    assert report['number_of_likelihood_evaluations'] == 3*12*10
+    assert report['effective_sample_size'] > 0.0
+    chain = analysis.sampler.get_chain(flat=True)
+    assert chain.shape == (120, 5)
+    assert analysis.sampler.get_log_prob(flat=True) == pytest.approx(analysis.ln_likelihood_vectorized(chain),1.0e-10)
+
+def test_pickle_results_after_parallel_tempering(halo_and_disk_analysis, tmp_path):
+    analysis = halo_and_disk_analysis
+    positions = np.array([7.05, 11.5, 3.9, 5.3, 8.122]) + 1.0e-2*np.random.RandomState(3).randn(12,5)
+    analysis.compute_parallel_tempering(12, 10, walkers_positions=positions, number_of_temperatures=2, vectorize=True, random_state=0)
+    file_name = str(tmp_path / "results.pickle")
+    datahandling.pickle_results(analysis, file_name)
+    results = datahandling.load_pickle_results(file_name)
+    assert np.array_equal(results['chains'], np.swapaxes(analysis.sampler.get_chain(),0,1))
+    assert np.array_equal(results['lnlikelihoods'], np.swapaxes(analysis.sampler.get_log_prob(),0,1))
+    assert np.array_equal(results['acceptance_fractions'], analysis.sampler.acceptance_fraction)
+
+def test_Analysis_compute_parallel_tempering_with_a_RandomState(halo_and_disk_analysis):
+    analysis = halo_and_disk_analysis
+    positions = np.array([7.05, 11.5, 3.9, 5.3, 8.122]) + 1.0e-2*np.random.RandomState(3).randn(12,5)
+    analysis.compute_parallel_tempering(12, 10, walkers_positions=positions, number_of_temperatures=2, vectorize=True, random_state=0)
+    chain = analysis.sampler.get_chain()
+    analysis.compute_parallel_tempering(12, 10, walkers_positions=positions, number_of_temperatures=2, vectorize=True,
+                                        random_state=np.random.RandomState(0))
+    assert np.array_equal(analysis.sampler.get_chain(), chain)
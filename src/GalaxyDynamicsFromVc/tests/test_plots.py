@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import pytest
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+from .. import plots
+from .. import datahandling
+from .. import onlinestatistics
+
+#%%
+
+@pytest.fixture
+def stored_results(tmp_path):
+    directory = str(tmp_path / "run")
+    storage = datahandling.Chain_storage(directory, 4, 20, 2, variable_names=["x1", "x2"], flush_every=20)
+    rng = np.random.RandomState(1)
+    storage.extend(rng.randn(4,20,2), -rng.rand(4,20), [10, 12, 8, 9])
+    return datahandling.load_results(directory)
+
+def test_plot_lnlikelihoods_with_thinned_views(stored_results):
+    plt.figure()
+    plots.plot_lnlikelihoods(stored_results['lnlikelihoods'], discard=5, thin=3)
+    lines = plt.gca().get_lines()
+    assert len(lines) == stored_results.number_of_walkers
+    assert list(lines[0].get_xdata()) == [5, 8, 11, 14, 17]
+    assert np.array_equal(lines[2].get_ydata(), stored_results.get_lnlikelihoods(discard=5, thin=3)[2])
+    plt.close()
+
+def test_plot_corner_plot_with_thinned_views(stored_results):
+    plots.plot_corner_plot(stored_results['chains'], stored_results.variable_names, discard=10, thin=2)
+    plt.close("all")
+
+def test_plot_corner_plot_from_summary(stored_results):
+    summary = onlinestatistics.Posterior_summary(2, variable_names=stored_results.variable_names, number_of_bins=10)
+    summary.update_from_chains(stored_results['chains'], discard=5)
+    fig = plots.plot_corner_plot_from_summary(summary)
+    axes = np.array(fig.axes).reshape((2,2))
+    assert not axes[0,1].axison
+    assert axes[1,0].get_xlabel() == "x1"
+    assert axes[1,0].get_ylabel() == "x2"
+    plt.close("all")